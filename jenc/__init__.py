@@ -11,29 +11,31 @@
 
 """
 
-import getpass
+import collections
 #import locale
 import logging
-import optparse
 import os
 import sys
+import threading
 import time
 
-# https://github.com/Legrandin/pycryptodome - PyCryptodome (safer/modern PyCrypto)
-# http://www.dlitz.net/software/pycrypto/ - PyCrypto - The Python Cryptography Toolkit
-import Crypto  # known to work with pycryptodome-3.21.0 and Python 3.12
-from Crypto.Protocol.KDF import PBKDF2
-from Crypto.Hash import SHA1
-from Crypto.Hash import SHA512
-from Crypto.Cipher import AES
+# NOTE keep imports at module level cheap, `import jenc` should be fast for library and command line users.
+# Crypto libraries are loaded on first use by jenc.backends, command line only modules (optparse, getpass, etc.) in main().
+from . import backends
+from . import metrics
+from . import tracing
+from ._version import __version__, __version_info__
 
-from Crypto.Random import get_random_bytes
 
-from ._version import __version__, __version_info__
+def get_random_bytes(length):
+    """Returns `length` cryptographically secure random bytes (same source as Crypto.Random.get_random_bytes)"""
+    return os.urandom(length)
 
 
 is_py3 = sys.version_info >= (3,)
 
+_monotonic = getattr(time, 'monotonic', time.time)  # py3.3+
+
 
 class JencException(Exception):
     '''Base jenc exception'''
@@ -46,29 +48,39 @@ class JencDecryptError(JencException):
 
 
 
-# create log
+# create log, no handlers configured at import time (library), see setup_logging()
 log = logging.getLogger("jenc")
-log.setLevel(logging.DEBUG)
+log.addHandler(logging.NullHandler())
 disable_logging = True
 #disable_logging = False  # DEBUG
-if disable_logging:
-    log.setLevel(logging.NOTSET)  # only logs; WARNING, ERROR, CRITICAL
-
-ch = logging.StreamHandler()  # use stdio
-
-if sys.version_info >= (2, 5):
-    # 2.5 added function name tracing
-    logging_fmt_str = "%(process)d %(thread)d %(asctime)s - %(name)s %(filename)s:%(lineno)d %(funcName)s() - %(levelname)s - %(message)s"
-else:
-    if JYTHON_RUNTIME_DETECTED:
-        # process is None under Jython 2.2
-        logging_fmt_str = "%(thread)d %(asctime)s - %(name)s %(filename)s:%(lineno)d - %(levelname)s - %(message)s"
+
+
+_log_handler = None  # installed by setup_logging()
+
+def setup_logging():
+    """Configure jenc log to write to stderr, used by command line tool.
+    The handler is only added once, main() may be called many times in one process"""
+    global _log_handler
+    if not disable_logging:
+        log.setLevel(logging.DEBUG)
+    if not disable_logging or os.environ.get('JENC_TRACE'):
+        tracing.enable_tracing()
+    if _log_handler is not None and _log_handler in log.handlers:
+        return _log_handler
+
+    ch = logging.StreamHandler()  # use stdio
+
+    if sys.version_info >= (2, 5):
+        # 2.5 added function name tracing
+        logging_fmt_str = "%(process)d %(thread)d %(asctime)s - %(name)s %(filename)s:%(lineno)d %(funcName)s() - %(levelname)s - %(message)s"
     else:
         logging_fmt_str = "%(process)d %(thread)d %(asctime)s - %(name)s %(filename)s:%(lineno)d - %(levelname)s - %(message)s"
 
-formatter = logging.Formatter(logging_fmt_str)
-ch.setFormatter(formatter)
-log.addHandler(ch)
+    formatter = logging.Formatter(logging_fmt_str)
+    ch.setFormatter(formatter)
+    log.addHandler(ch)
+    _log_handler = ch
+    return ch
 
 # FIXME - DeprecationWarning: 'locale.getdefaultlocale' is deprecated and slated for removal in Python 3.15. Use setlocale(), getencoding() and getlocale() instead.
 #log.debug('encodings %r', (sys.getdefaultencoding(), sys.getfilesystemencoding(), locale.getdefaultlocale()))
@@ -77,6 +89,8 @@ log.addHandler(ch)
 JENC_PBKDF2WithHmacSHA1 = 'PBKDF2WithHmacSHA1'
 JENC_PBKDF2WithHmacSHA512 = 'PBKDF2WithHmacSHA512'
 JENC_AES_GCM_NoPadding = 'AES/GCM/NoPadding'
+JENC_AES_GCM_SEGMENTED = 'AES/GCM/Segmented'  # jenc-py only, NOT supported by Markor / jpencconverter, see jenc.segmented
+JENC_AES_GCM_COMPRESSED = 'AES/GCM/Compressed'  # jenc-py only, NOT supported by Markor / jpencconverter, see jenc.compression
 
 """
      * 4 bytes - define the version.
@@ -118,11 +132,35 @@ jenc_version_details = {
         'cipher': JENC_AES_GCM_NoPadding,
         'nonceLenth': 32,  # nonceLenth (sic.) == Nonce Length, i.e. IV length  # in bytes
     },
+    'S001': {  # jenc-py extension, seekable; V001 key derivation, independently authenticated segments
+        'keyFactory': JENC_PBKDF2WithHmacSHA512,
+        'keyIterationCount': 10000,
+        'keyLength': 256,
+        'keyAlgorithm': 'AES',
+        'keySaltLength': 64,  # in bytes
+        'cipher': JENC_AES_GCM_SEGMENTED,
+        'nonceLenth': 32,  # in bytes
+        'segmentSize': 256 * 1024,  # in bytes, plaintext per segment
+    },
+    'C001': {  # jenc-py extension, compress-then-encrypt; V001 key derivation and cipher, algorithm id in the content
+        'keyFactory': JENC_PBKDF2WithHmacSHA512,
+        'keyIterationCount': 10000,
+        'keyLength': 256,
+        'keyAlgorithm': 'AES',
+        'keySaltLength': 64,  # in bytes
+        'cipher': JENC_AES_GCM_COMPRESSED,
+        'nonceLenth': 32,  # in bytes
+        'compression': 'zlib',  # default for new files, see jenc.compression.set_algorithm()
+    },
 }
 AUTH_TAG_LENGTH = 16  # i.e. 16 * 8 == 128-bits ; Markor / jpencconverter JavaPasswordbasedCryption.java : getCipher(); GCMParameterSpec spec = new GCMParameterSpec(16 * 8, nonce);
 
 
 DEFAULT_JENC_VERSION = 'V001'
+DEFAULT_CHUNK_SIZE = 64 * 1024  # in bytes, read size used by the streaming API
+PROFILE_LINE_COUNT = 25  # number of functions reported by --profile
+JENC_FILENAME_EXTENSION = '.jenc'
+DEPRECATED_JENC_VERSIONS = ('U001',)
 
 def jenc_version_check(jenc_version):
     if isinstance(jenc_version, bytes):
@@ -130,79 +168,431 @@ def jenc_version_check(jenc_version):
     if jenc_version not in jenc_version_details:
         raise UnsupportedMetaData('jenc version %r', jenc_version)
 
-def decrypt(password, encrypt_bytes, skip_hmac_check=False):
-    """Takes in:
-        password string (not bytes)
-        encrypt_bytes
-    Returns plaintext_bytes.
-    DO NOT USE skip_hmac_check! For debug only
+class DerivedKeyCache(object):
+    """In-process cache of derived keys, avoids re-running PBKDF2 when the same
+    password is used with the same salt (i.e. re-reading the same file).
+
+    Keyed on (keyFactory, keyIterationCount, keyLength, salt, password digest),
+    the password itself is never stored, only an HMAC of it with a random
+    per-cache secret. Bounded by max_entries (least recently used evicted
+    first) and ttl seconds (None for no expiry).
+    Evicted/cleared keys are overwritten with zeros (best effort, Python may
+    have made other copies).
 
     Sample code:
 
         import jenc
 
-        password = 'geheim'
-        encrypted_bytes = jenc.encrypt(password, b"Hello World")
-        plaintext_bytes = jenc.decrypt(password, encrypted_bytes)
+        cache = jenc.enable_key_cache(max_entries=128, ttl=300)
+        plaintext_bytes = jenc.decrypt(password, encrypted_bytes)  # miss, runs PBKDF2
+        plaintext_bytes = jenc.decrypt(password, encrypted_bytes)  # hit
+        print(cache.stats())
+        jenc.disable_key_cache()  # clears and zeroizes
     """
+
+    def __init__(self, max_entries=256, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._entries = collections.OrderedDict()  # cache key -> (expiry time or None, bytearray derived_key)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _password_digest(self, password):
+        if isinstance(password, bytes):
+            password_bytes = b'b' + password
+        else:
+            password_bytes = b's' + password.encode('utf-8')
+        import hashlib
+        import hmac
+        return hmac.new(self._secret, password_bytes, hashlib.sha256).digest()
+
+    def make_key(self, password, salt_bytes, this_file_meta):
+        return (this_file_meta['keyFactory'], this_file_meta['keyIterationCount'], this_file_meta['keyLength'], bytes(salt_bytes), self._password_digest(password))
+
+    def get(self, cache_key):
+        """Returns derived key bytes or None"""
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                expiry, derived_key = entry
+                if expiry is not None and expiry <= _monotonic():
+                    self._discard(cache_key)
+                    entry = None
+                else:
+                    self._entries.move_to_end(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return bytes(derived_key)
+
+    def contains(self, cache_key):
+        """Returns True if cache_key has an unexpired entry. Unlike get(), hit/miss counts
+        and LRU order are not changed (e.g. for jenc.kdf.prime_key_cache())"""
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            return entry is not None and (entry[0] is None or entry[0] > _monotonic())
+
+    def put(self, cache_key, derived_key):
+        if self.max_entries <= 0:
+            return
+        expiry = None
+        if self.ttl is not None:
+            expiry = _monotonic() + self.ttl
+        with self._lock:
+            if cache_key in self._entries:
+                self._discard(cache_key)
+            self._entries[cache_key] = (expiry, bytearray(derived_key))
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _discard(self, cache_key):
+        expiry, derived_key = self._entries.pop(cache_key)
+        _zeroize(derived_key)
+
+    def derive(self, password, salt_bytes, this_file_meta, derive_function):
+        cache_key = self.make_key(password, salt_bytes, this_file_meta)
+        derived_key = self.get(cache_key)
+        if derived_key is None:
+            derived_key = derive_function(password, salt_bytes, this_file_meta)
+            self.put(cache_key, derived_key)
+        return derived_key
+
+    def clear(self):
+        """Remove (and zeroize) all cached keys"""
+        with self._lock:
+            for cache_key in list(self._entries):
+                self._discard(cache_key)
+
+    zeroize = clear
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+def _zeroize(buffer):
+    for i in range(len(buffer)):
+        buffer[i] = 0
+
+derived_key_cache = None  # opt-in, see enable_key_cache()
+
+def enable_key_cache(max_entries=256, ttl=None):
+    """Enable in-process derived key cache for all encrypt/decrypt calls.
+    Returns the DerivedKeyCache instance (for stats)."""
+    global derived_key_cache
+    disable_key_cache()
+    derived_key_cache = DerivedKeyCache(max_entries=max_entries, ttl=ttl)
+    return derived_key_cache
+
+def disable_key_cache():
+    """Disable derived key cache, cached keys are zeroized"""
+    global derived_key_cache
+    if derived_key_cache is not None:
+        derived_key_cache.clear()
+    derived_key_cache = None
+
+def _derive_key(password, salt_bytes, this_file_meta, key_cache=None):
+    if key_cache is None:
+        key_cache = derived_key_cache
+    if key_cache is not None:
+        derived_key = key_cache.derive(password, salt_bytes, this_file_meta, _pbkdf2_derive_key)
+    else:
+        derived_key = _pbkdf2_derive_key(password, salt_bytes, this_file_meta)
+    metrics.current().lap('kdf')
+    return derived_key
+
+_key_factory_hash_names = {
+    # jenc_version_details keyFactory -> jenc.backends KDF hash name
+    JENC_PBKDF2WithHmacSHA1: backends.KDF_SHA1,
+    JENC_PBKDF2WithHmacSHA512: backends.KDF_SHA512,
+}
+
+def _pbkdf2_derive_key(password, salt_bytes, this_file_meta):
+    try:
+        hash_name = _key_factory_hash_names[this_file_meta['keyFactory']]
+    except KeyError:
+        raise UnsupportedMetaData('keyFactory %r' % this_file_meta['keyFactory'])
+    return backends.pbkdf2(password, salt_bytes, this_file_meta['keyLength'] // 8, this_file_meta['keyIterationCount'], hash_name)
+
+def _new_cipher(password, salt_bytes, nonce_bytes, this_file_meta, key_cache=None):
+    derived_key = _derive_key(password, salt_bytes, this_file_meta, key_cache=key_cache)
+    return _new_cipher_from_key(derived_key, nonce_bytes, this_file_meta)
+
+def _new_cipher_from_key(derived_key, nonce_bytes, this_file_meta):
+    if this_file_meta['cipher'] == JENC_AES_GCM_NoPadding:
+        cipher = backends.new_aes_gcm(derived_key, nonce_bytes)
+    elif this_file_meta['cipher'] == JENC_AES_GCM_SEGMENTED:
+        from . import segmented
+        cipher = segmented.SegmentedAesGcm(derived_key, nonce_bytes, this_file_meta['segmentSize'])
+    elif this_file_meta['cipher'] == JENC_AES_GCM_COMPRESSED:
+        from . import compression
+        cipher = compression.CompressedAesGcm(derived_key, nonce_bytes, this_file_meta['compression'])
+    else:
+        raise UnsupportedMetaData('cipher %r' % this_file_meta['cipher'])
+    return cipher
+
+def _split_buffer(encrypt_bytes):
+    """Split encrypted bytes (or any buffer-protocol object; bytearray, memoryview, mmap) into header and content.
+    Content is a memoryview, i.e. NOT copied.
+    Returns tuple of; jenc_version (string), meta data dict, nonce_bytes, salt_bytes, content memoryview, auth_tag
+    """
+    encrypt_view = memoryview(encrypt_bytes)
     start_offset, end_offset = 0, 4  # Markor / jpencconverter JavaPasswordbasedCryption.java enum Version NAME_LENGTH
-    jenc_version = encrypt_bytes[:end_offset]
-    log.debug('jenc_version %r', jenc_version)
+    jenc_version = bytes(encrypt_view[:end_offset])
     jenc_version_check(jenc_version)
     jenc_version = jenc_version.decode('us-ascii')
     this_file_meta = jenc_version_details[jenc_version]
 
     start_offset, end_offset = end_offset, end_offset + this_file_meta['nonceLenth']
-    nonce_bytes = encrypt_bytes[start_offset:end_offset]
-
-    log.debug('%d nonce_bytes %r', len(nonce_bytes), nonce_bytes)
-    log.debug('%d nonce_bytes hex %r', len(nonce_bytes), nonce_bytes.hex())
+    nonce_bytes = bytes(encrypt_view[start_offset:end_offset])
 
     start_offset, end_offset = end_offset, end_offset + this_file_meta['keySaltLength']
-    salt_bytes = encrypt_bytes[start_offset:end_offset]
+    salt_bytes = bytes(encrypt_view[start_offset:end_offset])
+
+    if len(encrypt_view) < end_offset + AUTH_TAG_LENGTH:
+        raise JencDecryptError('truncated')
+    content_bytes = encrypt_view[end_offset:-AUTH_TAG_LENGTH]
+    auth_tag = bytes(encrypt_view[-AUTH_TAG_LENGTH:])
+    return jenc_version, this_file_meta, nonce_bytes, salt_bytes, content_bytes, auth_tag
+
+def _header_length(this_file_meta):
+    return 4 + this_file_meta['nonceLenth'] + this_file_meta['keySaltLength']
+
+def _plaintext_length(this_file_meta, content_length):
+    """Returns plaintext size for content_length bytes between header and (final) auth tag, None if not valid"""
+    if this_file_meta['cipher'] == JENC_AES_GCM_SEGMENTED:
+        from . import segmented
+        return segmented.plaintext_length(content_length, this_file_meta['segmentSize'])
+    if this_file_meta['cipher'] == JENC_AES_GCM_COMPRESSED:
+        raise UnsupportedMetaData('plaintext length of compressed jenc versions is only known after decrypting')
+    return content_length
+
+def encrypted_length(plaintext_length, jenc_version=None):
+    """Returns size in bytes of encrypted output for plaintext_length bytes of plaintext, see encrypt_into()"""
+    jenc_version = jenc_version or DEFAULT_JENC_VERSION
+    jenc_version_check(jenc_version)
+    this_file_meta = jenc_version_details[jenc_version]
+    if this_file_meta['cipher'] == JENC_AES_GCM_SEGMENTED:
+        from . import segmented
+        return _header_length(this_file_meta) + segmented.encrypted_content_length(plaintext_length, this_file_meta['segmentSize'])
+    if this_file_meta['cipher'] == JENC_AES_GCM_COMPRESSED:
+        raise UnsupportedMetaData('encrypted length of compressed jenc versions is only known after encrypting')
+    return _header_length(this_file_meta) + plaintext_length + AUTH_TAG_LENGTH
+
+def decrypted_length(encrypt_bytes):
+    """Returns size in bytes of plaintext for encrypted bytes (or buffer), see decrypt_into()"""
+    jenc_version, this_file_meta, nonce_bytes, salt_bytes, content_bytes, auth_tag = _split_buffer(encrypt_bytes)
+    content_length = _plaintext_length(this_file_meta, len(content_bytes))
+    if content_length is None:
+        raise JencDecryptError('truncated')
+    return content_length
+
+class JencHeader(object):
+    """Parsed jenc header (meta data), does not require the password.
+
+    Attributes:
+        jenc_version - string, None if unknown/unsupported
+        nonce_bytes
+        salt_bytes
+        header_length - in bytes
+        total_length - size of encrypted data in bytes, None if unknown
+        content_length - size of plaintext in bytes (for V001/U001 also the ciphertext size, excluding header and auth tag), None if unknown (always for C001)
+        valid - True if structurally valid (does NOT check auth tag)
+        error - string describing why not valid, else None
+    """
+    __slots__ = ('jenc_version', 'nonce_bytes', 'salt_bytes', 'header_length', 'total_length', 'content_length', 'valid', 'error')
+
+    def __init__(self, header_bytes, total_length=None):
+        """header_bytes, at least MAX_HEADER_LENGTH bytes (if available) from start of encrypted data"""
+        self.jenc_version = None
+        self.nonce_bytes = self.salt_bytes = None
+        self.header_length = self.content_length = None
+        self.total_length = total_length
+        self.valid = False
+        self.error = None
+        jenc_version = bytes(header_bytes[:4])
+        try:
+            jenc_version_check(jenc_version)
+        except (UnsupportedMetaData, UnicodeDecodeError):
+            self.error = 'unsupported jenc version %r' % jenc_version
+            return
+        self.jenc_version = jenc_version.decode('us-ascii')
+        this_file_meta = jenc_version_details[self.jenc_version]
+        self.header_length = _header_length(this_file_meta)
+        if len(header_bytes) < self.header_length:
+            self.error = 'truncated header'
+            return
+        self.nonce_bytes = bytes(header_bytes[4:4 + this_file_meta['nonceLenth']])
+        self.salt_bytes = bytes(header_bytes[4 + this_file_meta['nonceLenth']:self.header_length])
+        if total_length is not None:
+            self.content_length = total_length - self.header_length - AUTH_TAG_LENGTH
+            if self.content_length < 0:
+                self.content_length = None
+                self.error = 'truncated, missing auth tag'
+                return
+            if this_file_meta['cipher'] == JENC_AES_GCM_COMPRESSED:
+                self.content_length = None  # only known after decompressing
+            else:
+                self.content_length = _plaintext_length(this_file_meta, self.content_length)
+                if self.content_length is None:
+                    self.error = 'truncated segment'
+                    return
+        self.valid = True
+
+    @property
+    def deprecated(self):
+        return self.jenc_version in DEPRECATED_JENC_VERSIONS
+
+    def as_dict(self):
+        result = dict((name, getattr(self, name)) for name in self.__slots__)
+        for name in ('nonce_bytes', 'salt_bytes'):
+            if result[name] is not None:
+                result[name] = result[name].hex()
+        result['deprecated'] = self.deprecated
+        return result
+
+    def __repr__(self):
+        return 'JencHeader(jenc_version=%r, total_length=%r, content_length=%r, valid=%r, error=%r)' % (self.jenc_version, self.total_length, self.content_length, self.valid, self.error)
+
+def max_header_length():
+    return max(_header_length(this_file_meta) for this_file_meta in jenc_version_details.values())
+
+def inspect(path_or_bytes):
+    """Read jenc meta data without decrypting (no password or KDF needed).
+    Takes in either a filename or encrypted bytes (or buffer), only the
+    header (first 100 bytes for V001/U001) is read from files.
+    Returns JencHeader instance, check .valid before using.
 
-    log.debug('%d salt_bytes %r', len(salt_bytes), salt_bytes)
-    log.debug('%d salt_bytes hex %r', len(salt_bytes), salt_bytes.hex())
+    Sample code:
 
-    start_offset, end_offset = end_offset, -AUTH_TAG_LENGTH
-    content_bytes = encrypt_bytes[start_offset:end_offset]
-    log.debug('%d content_bytes %r', len(content_bytes), content_bytes)
-    log.debug('%d content_bytes hex %r', len(content_bytes), content_bytes.hex())
+        import jenc
 
-    auth_tag = encrypt_bytes[-AUTH_TAG_LENGTH:]
-    log.debug('%d auth_tag %r', len(auth_tag), auth_tag)
-    log.debug('%d auth_tag hex %r', len(auth_tag), auth_tag.hex())
+        header = jenc.inspect('Test3.md.jenc')
+        print('%r %r %r' % (header.jenc_version, header.content_length, header.valid))
+    """
+    if isinstance(path_or_bytes, (str, getattr(os, 'PathLike', str))):
+        f = open(path_or_bytes, 'rb', buffering=0)
+        try:
+            header_bytes = f.read(max_header_length())
+            total_length = os.fstat(f.fileno()).st_size
+        finally:
+            f.close()
+        return JencHeader(header_bytes, total_length)
+    encrypt_view = memoryview(path_or_bytes)
+    return JencHeader(encrypt_view[:max_header_length()], len(encrypt_view))
+
+def scan_files(filenames, out_file=None):
+    """Write a (tab separated) report of jenc meta data for each file in filenames, does not decrypt.
+    Columns; filename, version, nonce length, salt length, ciphertext length, status.
+    Returns number of invalid files.
+    """
+    out_file = out_file or sys.stdout
+    invalid_count = 0
+    version_counts = {}
+    for filename in filenames:
+        try:
+            header = inspect(filename)
+        except EnvironmentError as info:
+            invalid_count += 1
+            out_file.write('%s\t\t\t\t\tINVALID %s\n' % (filename, info))
+            continue
+        if header.valid:
+            status = 'ok'
+            if header.deprecated:
+                status = 'DEPRECATED'
+            version_counts[header.jenc_version] = version_counts.get(header.jenc_version, 0) + 1
+        else:
+            status = 'INVALID %s' % header.error
+            invalid_count += 1
+        out_file.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+            filename,
+            header.jenc_version or '',
+            '' if header.nonce_bytes is None else len(header.nonce_bytes),
+            '' if header.salt_bytes is None else len(header.salt_bytes),
+            '' if header.content_length is None else header.content_length,
+            status))
+    out_file.flush()
+    sys.stderr.write('%d files, %d invalid, versions %r\n' % (len(filenames), invalid_count, sorted(version_counts.items())))
+    return invalid_count
+
+def _read_header(file_object):
+    """Read jenc header (version, nonce, salt) from file-like object, leaving file positioned at start of content bytes.
+    Returns tuple of; jenc_version (string), meta data dict, nonce_bytes, salt_bytes
+    """
+    jenc_version = file_object.read(4)  # Markor / jpencconverter JavaPasswordbasedCryption.java enum Version NAME_LENGTH
+    jenc_version_check(jenc_version)
+    jenc_version = jenc_version.decode('us-ascii')
+    this_file_meta = jenc_version_details[jenc_version]
+    nonce_bytes = file_object.read(this_file_meta['nonceLenth'])
+    salt_bytes = file_object.read(this_file_meta['keySaltLength'])
+    if len(nonce_bytes) != this_file_meta['nonceLenth'] or len(salt_bytes) != this_file_meta['keySaltLength']:
+        raise JencDecryptError('truncated header')
+    return jenc_version, this_file_meta, nonce_bytes, salt_bytes
 
-    # https://pycryptodome.readthedocs.io/en/latest/src/protocol/kdf.html
-    log.debug('password %r', password)
-    if this_file_meta['keyFactory'] == JENC_PBKDF2WithHmacSHA512:
-        derived_key = PBKDF2(password, salt_bytes, this_file_meta['keyLength'] // 8, count=this_file_meta['keyIterationCount'], hmac_hash_module=SHA512)
-    elif this_file_meta['keyFactory'] == JENC_PBKDF2WithHmacSHA1:
-        derived_key = PBKDF2(password, salt_bytes, this_file_meta['keyLength'] // 8, count=this_file_meta['keyIterationCount'], hmac_hash_module=SHA1)
-    else:
-        raise UnsupportedMetaData('keyFactory %r' % this_file_meta['keyFactory'])
-    log.debug('derived_key %r', derived_key)
-    log.debug('derived_key len %r', len(derived_key))
+@metrics.instrumented('decrypt')
+def decrypt(password, encrypt_bytes, skip_hmac_check=False, key_cache=None):
+    """Takes in:
+        password string (not bytes)
+        encrypt_bytes, bytes or any buffer-protocol object (bytearray, memoryview, mmap) which is not copied
+        key_cache, optional DerivedKeyCache to use instead of the module level one (see enable_key_cache())
+    Returns plaintext_bytes.
+    DO NOT USE skip_hmac_check! For debug only
 
-    if this_file_meta['cipher'] == JENC_AES_GCM_NoPadding:
-        cipher = AES.new(derived_key, AES.MODE_GCM, nonce=nonce_bytes)
-    else:
-        raise UnsupportedMetaData('cipher %r' % this_file_meta['cipher'])
+    Sample code:
 
-    log.debug('cipher %r', cipher)
-    log.debug('content_bytes %r', content_bytes)
-    if skip_hmac_check:
-        plaintext_bytes = cipher.decrypt(content_bytes)  # if you want to decrypt BUT skip MAC check
-    else:
+        import jenc
+
+        password = 'geheim'
+        encrypted_bytes = jenc.encrypt(password, b"Hello World")
+        plaintext_bytes = jenc.decrypt(password, encrypted_bytes)
+    """
+    stats = metrics.current()
+    jenc_version, this_file_meta, nonce_bytes, salt_bytes, content_bytes, auth_tag = _split_buffer(encrypt_bytes)
+    stats.set_version(jenc_version)
+    stats.add_bytes(_header_length(this_file_meta) + len(content_bytes) + AUTH_TAG_LENGTH, len(content_bytes))
+    stats.lap('parse')
+    if tracing.enabled:
+        tracing.trace('decrypt', jenc_version=jenc_version, nonce=nonce_bytes, salt=salt_bytes, content=content_bytes, auth_tag=auth_tag, password=password)
+
+    # https://pycryptodome.readthedocs.io/en/latest/src/protocol/kdf.html
+    derived_key = _derive_key(password, salt_bytes, this_file_meta, key_cache=key_cache)
+    cipher = _new_cipher_from_key(derived_key, nonce_bytes, this_file_meta)
+    if tracing.enabled:
+        tracing.trace('decrypt cipher', derived_key=derived_key, cipher=cipher)
+
+    if not skip_hmac_check and hasattr(cipher, 'authenticate_first'):  # compressed, check the tag before decompressing
         try:
-            plaintext_bytes = cipher.decrypt_and_verify(content_bytes, auth_tag)  # TODO catch ValueError: MAC check failed
+            cipher.authenticate_first([content_bytes], auth_tag)
         except ValueError as info:
             raise JencDecryptError(info)
-    log.debug('plaintext_bytes %r', plaintext_bytes)
-    original_length = len(content_bytes)
+        stats.lap('verify')
+    plaintext_bytes = cipher.decrypt(content_bytes)
+    stats.lap('cipher')
+    if not skip_hmac_check:  # skip_hmac_check if you want to decrypt BUT skip MAC check
+        try:
+            cipher.verify(auth_tag)
+        except ValueError as info:
+            raise JencDecryptError(info)
+        stats.lap('verify')
+    if tracing.enabled:
+        tracing.trace('decrypt done', plaintext=plaintext_bytes)
     return plaintext_bytes
 
 
+@metrics.instrumented('encrypt')
 def encrypt(password, plaintext_bytes, jenc_version=None):
     """Takes in:
         file-like object
@@ -218,34 +608,120 @@ def encrypt(password, plaintext_bytes, jenc_version=None):
         password = 'geheim'
         encrypted_bytes = jenc.encrypt(password, b"Hello World")
     """
+    stats = metrics.current()
     jenc_version = jenc_version or DEFAULT_JENC_VERSION
     jenc_version_check(jenc_version)
     this_file_meta = jenc_version_details[jenc_version]
     nonce_bytes = get_random_bytes(this_file_meta['nonceLenth'])
     salt_bytes = get_random_bytes(this_file_meta['keySaltLength'])
+    stats.set_version(jenc_version)
+    stats.lap('parse')
+    if tracing.enabled:
+        tracing.trace('encrypt', jenc_version=jenc_version, nonce=nonce_bytes, salt=salt_bytes, plaintext=plaintext_bytes, password=password)
 
-    log.debug('password %r', password)
-    if this_file_meta['keyFactory'] == JENC_PBKDF2WithHmacSHA512:
-        derived_key = PBKDF2(password, salt_bytes, this_file_meta['keyLength'] // 8, count=this_file_meta['keyIterationCount'], hmac_hash_module=SHA512)
-    elif this_file_meta['keyFactory'] == JENC_PBKDF2WithHmacSHA1:
-        derived_key = PBKDF2(password, salt_bytes, this_file_meta['keyLength'] // 8, count=this_file_meta['keyIterationCount'], hmac_hash_module=SHA1)
-    else:
-        raise UnsupportedMetaData('keyFactory %r' % this_file_meta['keyFactory'])
-    log.debug('derived_key %r', derived_key)
-    log.debug('derived_key len %r', len(derived_key))
+    derived_key = _derive_key(password, salt_bytes, this_file_meta)
+    cipher = _new_cipher_from_key(derived_key, nonce_bytes, this_file_meta)
+    if tracing.enabled:
+        tracing.trace('encrypt cipher', derived_key=derived_key, cipher=cipher)
 
-    if this_file_meta['cipher'] == JENC_AES_GCM_NoPadding:
-        cipher = AES.new(derived_key, AES.MODE_GCM, nonce=nonce_bytes)
-    else:
-        raise UnsupportedMetaData('cipher %r' % this_file_meta['cipher'])
+    crypted_bytes, auth_tag = cipher.encrypt_and_digest(plaintext_bytes)
+    stats.lap('cipher')
 
-    log.debug('cipher %r', cipher)
+    encrypt_bytes = b''.join((jenc_version.encode('us-ascii'), nonce_bytes, salt_bytes, crypted_bytes, auth_tag))  # single copy
+    stats.add_bytes(len(crypted_bytes), len(encrypt_bytes))
+    stats.lap('write')
+    return encrypt_bytes
 
-    crypted_bytes, auth_tag = cipher.encrypt_and_digest(plaintext_bytes)
 
-    return jenc_version.encode('us-ascii') + nonce_bytes + salt_bytes + crypted_bytes + auth_tag
+@metrics.instrumented('decrypt_into')
+def decrypt_into(password, encrypt_bytes, out_buffer, skip_hmac_check=False):
+    """Takes in:
+        password string (not bytes)
+        encrypt_bytes, bytes or any buffer-protocol object (bytearray, memoryview, mmap) which is not copied
+        out_buffer, writable buffer (bytearray, memoryview, mmap) at least decrypted_length(encrypt_bytes) bytes long
+    Decrypts directly into out_buffer, returns number of plaintext bytes written.
+    If the auth tag check fails out_buffer is zeroed and JencDecryptError raised.
+    DO NOT USE skip_hmac_check! For debug only
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        encrypted_bytes = jenc.encrypt(password, b"Hello World")
+        out_buffer = bytearray(jenc.decrypted_length(encrypted_bytes))
+        jenc.decrypt_into(password, encrypted_bytes, out_buffer)
+    """
+    stats = metrics.current()
+    jenc_version, this_file_meta, nonce_bytes, salt_bytes, content_bytes, auth_tag = _split_buffer(encrypt_bytes)
+    content_length = _plaintext_length(this_file_meta, len(content_bytes))
+    if content_length is None:
+        raise JencDecryptError('truncated')
+    out_view = memoryview(out_buffer)
+    if len(out_view) < content_length:
+        raise JencException('out_buffer too small, need %d bytes' % content_length)
+    out_view = out_view[:content_length]
+    stats.set_version(jenc_version)
+    stats.add_bytes(_header_length(this_file_meta) + len(content_bytes) + AUTH_TAG_LENGTH, content_length)
+    stats.lap('parse')
+    cipher = _new_cipher(password, salt_bytes, nonce_bytes, this_file_meta)
+    cipher.decrypt(content_bytes, output=out_view)
+    stats.lap('cipher')
+    if not skip_hmac_check:
+        try:
+            cipher.verify(auth_tag)
+        except ValueError as info:
+            out_view[:] = bytes(content_length)  # do not leave unauthenticated plaintext behind
+            raise JencDecryptError(info)
+        stats.lap('verify')
+    return content_length
 
 
+@metrics.instrumented('encrypt_into')
+def encrypt_into(password, plaintext_bytes, out_buffer, jenc_version=None):
+    """Takes in:
+        password string (not bytes)
+        plaintext_bytes, bytes or any buffer-protocol object (bytearray, memoryview, mmap) which is not copied
+        out_buffer, writable buffer (bytearray, memoryview, mmap) at least encrypted_length(len(plaintext_bytes), jenc_version) bytes long
+        version (string)
+    Encrypts directly into out_buffer, returns number of bytes written.
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        plaintext_bytes = b"Hello World"
+        out_buffer = bytearray(jenc.encrypted_length(len(plaintext_bytes)))
+        jenc.encrypt_into(password, plaintext_bytes, out_buffer)
+    """
+    stats = metrics.current()
+    jenc_version = jenc_version or DEFAULT_JENC_VERSION
+    jenc_version_check(jenc_version)
+    this_file_meta = jenc_version_details[jenc_version]
+    plaintext_view = memoryview(plaintext_bytes)
+    plaintext_length = len(plaintext_view)
+    total_length = encrypted_length(plaintext_length, jenc_version=jenc_version)
+    out_view = memoryview(out_buffer)
+    if len(out_view) < total_length:
+        raise JencException('out_buffer too small, need %d bytes' % total_length)
+    nonce_bytes = get_random_bytes(this_file_meta['nonceLenth'])
+    salt_bytes = get_random_bytes(this_file_meta['keySaltLength'])
+    stats.set_version(jenc_version)
+    stats.add_bytes(plaintext_length, total_length)
+    stats.lap('parse')
+    cipher = _new_cipher(password, salt_bytes, nonce_bytes, this_file_meta)
+
+    header_bytes = jenc_version.encode('us-ascii') + nonce_bytes + salt_bytes
+    header_length = len(header_bytes)
+    out_view[:header_length] = header_bytes
+    cipher.encrypt(plaintext_view, output=out_view[header_length:total_length - AUTH_TAG_LENGTH])
+    out_view[total_length - AUTH_TAG_LENGTH:total_length] = cipher.digest()
+    stats.lap('cipher')
+    return total_length
+
+
+@metrics.instrumented('encrypt_file_handle')
 def encrypt_file_handle(file_object, password, plaintext_bytes, jenc_version=None):
     """Takes in:
         file-like object
@@ -264,13 +740,16 @@ def encrypt_file_handle(file_object, password, plaintext_bytes, jenc_version=Non
     """
     encrypt_bytes = encrypt(password, plaintext_bytes, jenc_version=jenc_version)
     file_object.write(encrypt_bytes)
+    metrics.current().lap('write')
 
 
+@metrics.instrumented('decrypt_file_handle')
 def decrypt_file_handle(file_object, password):
     """Takes in:
         file-like object
         password string (not bytes)
     And return plain text bytes. Java version of jenc uses utf-8 for string.
+    Raises JencDecryptError if the auth tag check fails (or the file is truncated).
 
     Sample code:
 
@@ -288,26 +767,13 @@ def decrypt_file_handle(file_object, password):
         print('%r' % plaintext)
         print('%s' % plaintext)
     """
-    jenc_version = file_object.read(4)
-
-    log.debug('jenc_version %r', jenc_version)
-    jenc_version_check(jenc_version)
-    jenc_version = jenc_version.decode('us-ascii')
-    this_file_meta = jenc_version_details[jenc_version]
-    nonce_bytes = file_object.read(this_file_meta['nonceLenth'])
-    salt_bytes = file_object.read(this_file_meta['keySaltLength'])
-    content_bytes = file_object.read()  # until EOF
-    auth_tag = content_bytes[-AUTH_TAG_LENGTH:]
-    content_bytes = content_bytes[:-AUTH_TAG_LENGTH]  # FIXME inefficient, consider reading entire file and calling decrypt() instead
-
-    log.debug('%d nonce_bytes %r', len(nonce_bytes), nonce_bytes)
-    log.debug('%d nonce_bytes hex %r', len(nonce_bytes), nonce_bytes.hex())
-
-    log.debug('%d salt_bytes %r', len(salt_bytes), salt_bytes)
-    log.debug('%d salt_bytes hex %r', len(salt_bytes), salt_bytes.hex())
-
-    log.debug('%d auth_tag %r', len(auth_tag), auth_tag)
-    log.debug('%d auth_tag hex %r', len(auth_tag), auth_tag.hex())
+    stats = metrics.current()
+    jenc_version, this_file_meta, nonce_bytes, salt_bytes = _read_header(file_object)
+    stats.set_version(jenc_version)
+    stats.add_bytes(_header_length(this_file_meta), 0)
+    stats.lap('parse')
+    if tracing.enabled:
+        tracing.trace('decrypt_file_handle', jenc_version=jenc_version, nonce=nonce_bytes, salt=salt_bytes, password=password)
 
     #  64 salt_bytes hex '05fa11953346421ea3698beca3f2142e53f538743cc522ea5f3a68f41e2a1a8e6c373d55f41fcf9915846707c72d2610fcfe8690cbe28dbfa1716023f851f6dd'
     """
@@ -335,38 +801,629 @@ def decrypt_file_handle(file_object, password):
 
     """
 
+    derived_key = _derive_key(password, salt_bytes, this_file_meta)
+    cipher = _new_cipher_from_key(derived_key, nonce_bytes, this_file_meta)
+    if tracing.enabled:
+        tracing.trace('decrypt_file_handle cipher', derived_key=derived_key, cipher=cipher)
+    # content is read and decrypted in chunks (ciphertext is never held in full), auth tag checked at EOF
+    plaintext_bytes = b''.join(_decrypt_chunks(cipher, file_object, False, DEFAULT_CHUNK_SIZE))
+    if tracing.enabled:
+        tracing.trace('decrypt_file_handle done', plaintext=plaintext_bytes)
+    return plaintext_bytes
 
-    # https://pycryptodome.readthedocs.io/en/latest/src/protocol/kdf.html
-    log.debug('password %r', password)
-    if this_file_meta['keyFactory'] == JENC_PBKDF2WithHmacSHA512:
-        derived_key = PBKDF2(password, salt_bytes, this_file_meta['keyLength'] // 8, count=this_file_meta['keyIterationCount'], hmac_hash_module=SHA512)
-    elif this_file_meta['keyFactory'] == JENC_PBKDF2WithHmacSHA1:
-        derived_key = PBKDF2(password, salt_bytes, this_file_meta['keyLength'] // 8, count=this_file_meta['keyIterationCount'], hmac_hash_module=SHA1)
-    else:
-        raise UnsupportedMetaData('keyFactory %r' % this_file_meta['keyFactory'])
-    log.debug('derived_key %r', derived_key)
-    log.debug('derived_key len %r', len(derived_key))
 
-    if this_file_meta['cipher'] == JENC_AES_GCM_NoPadding:
-        cipher = AES.new(derived_key, AES.MODE_GCM, nonce=nonce_bytes)
+@metrics.instrumented_generator('encrypt_stream')
+def encrypt_stream_generator(password, in_file_object, jenc_version=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Takes in:
+        password string (not bytes)
+        file-like object to read plaintext bytes from, until EOF
+        version (string)
+        chunk_size, number of bytes to read at a time
+    Yields encrypted bytes; header first, auth tag last.
+    The concatenated output is the same format as encrypt(), memory use is bounded by chunk_size.
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        in_file = open('Test3.md', 'rb')
+        for encrypted_bytes in jenc.encrypt_stream_generator(password, in_file):
+            print('%r' % encrypted_bytes)
+        in_file.close()
+    """
+    jenc_version = jenc_version or DEFAULT_JENC_VERSION
+    jenc_version_check(jenc_version)
+    this_file_meta = jenc_version_details[jenc_version]
+    nonce_bytes = get_random_bytes(this_file_meta['nonceLenth'])
+    salt_bytes = get_random_bytes(this_file_meta['keySaltLength'])
+    metrics.current().set_version(jenc_version)
+    metrics.current().lap('parse')
+
+    cipher = _new_cipher(password, salt_bytes, nonce_bytes, this_file_meta)
+    for encrypted_bytes in _encrypt_chunks(cipher, jenc_version.encode('us-ascii') + nonce_bytes + salt_bytes, in_file_object, chunk_size):
+        yield encrypted_bytes
+
+
+def _encrypt_chunks(cipher, header_bytes, in_file_object, chunk_size):
+    stats = metrics.current()
+    stats.add_bytes(0, len(header_bytes) + AUTH_TAG_LENGTH)
+    yield header_bytes
+    while True:
+        plaintext_bytes = in_file_object.read(chunk_size)
+        stats.lap('read')
+        if not plaintext_bytes:
+            break
+        encrypted_bytes = cipher.encrypt(plaintext_bytes)
+        stats.lap('cipher')
+        stats.add_bytes(len(plaintext_bytes), len(encrypted_bytes))
+        yield encrypted_bytes
+    auth_tag = cipher.digest()
+    stats.lap('cipher')
+    yield auth_tag
+
+
+@metrics.instrumented_generator('decrypt_stream')
+def decrypt_stream_generator(password, in_file_object, skip_hmac_check=False, chunk_size=DEFAULT_CHUNK_SIZE, key_cache=None):
+    """Takes in:
+        password string (not bytes)
+        file-like object to read encrypted bytes from, until EOF
+        chunk_size, number of bytes to read at a time
+        key_cache, optional DerivedKeyCache to use instead of the module level one (see enable_key_cache())
+    Yields plaintext bytes, memory use is bounded by chunk_size.
+    DO NOT USE skip_hmac_check! For debug only
+
+    NOTE yielded plaintext has NOT been authenticated until the generator
+    is exhausted without raising JencDecryptError; callers must discard
+    output if an exception is raised.
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        in_file = open('Test3.md.jenc', 'rb')
+        plaintext_bytes = b''.join(jenc.decrypt_stream_generator(password, in_file))
+        in_file.close()
+    """
+    stats = metrics.current()
+    jenc_version, this_file_meta, nonce_bytes, salt_bytes = _read_header(in_file_object)
+    stats.set_version(jenc_version)
+    stats.add_bytes(_header_length(this_file_meta), 0)
+    stats.lap('parse')
+    cipher = _new_cipher(password, salt_bytes, nonce_bytes, this_file_meta, key_cache=key_cache)
+    for plaintext_bytes in _decrypt_chunks(cipher, in_file_object, skip_hmac_check, chunk_size):
+        yield plaintext_bytes
+
+
+def _seekable(file_object):
+    try:
+        return file_object.seekable()
+    except AttributeError:
+        return False
+
+
+def _read_content(in_file_object, chunk_size, tail_holder):
+    """Yields content (memoryview) read from in_file_object (positioned after the header),
+    once exhausted the auth tag is appended to tail_holder"""
+    # rolling buffer, the last AUTH_TAG_LENGTH bytes read may be the auth tag so hold them back
+    tail = b''
+    while True:
+        content_bytes = in_file_object.read(chunk_size)
+        if not content_bytes:
+            break
+        if tail:
+            content_bytes = tail + content_bytes
+        if len(content_bytes) <= AUTH_TAG_LENGTH:
+            tail = content_bytes
+            continue
+        content_view = memoryview(content_bytes)
+        tail = bytes(content_view[-AUTH_TAG_LENGTH:])
+        yield content_view[:-AUTH_TAG_LENGTH]
+    if len(tail) != AUTH_TAG_LENGTH:
+        raise JencDecryptError('truncated, missing auth tag')
+    tail_holder.append(tail)
+
+
+def _decrypt_chunks(cipher, in_file_object, skip_hmac_check, chunk_size):
+    """Yields plaintext for content and auth tag read from in_file_object (positioned after the header)"""
+    stats = metrics.current()
+    if not skip_hmac_check and hasattr(cipher, 'authenticate_first') and _seekable(in_file_object):
+        # compressed, check the tag before decompressing anything then go back and decrypt
+        position = in_file_object.tell()
+        tail_holder = []
+        try:
+            cipher.authenticate_first(_read_content(in_file_object, chunk_size, tail_holder), lambda: tail_holder[0])
+        except ValueError as info:
+            raise JencDecryptError(info)
+        in_file_object.seek(position)
+        stats.lap('verify')
+    tail_holder = []
+    for content_view in _read_content(in_file_object, chunk_size, tail_holder):
+        stats.lap('read')
+        stats.add_bytes(len(content_view), 0)
+        plaintext_bytes = cipher.decrypt(content_view)
+        stats.lap('cipher')
+        stats.add_bytes(0, len(plaintext_bytes))
+        yield plaintext_bytes
+    stats.add_bytes(AUTH_TAG_LENGTH, 0)
+    if not skip_hmac_check:
+        try:
+            cipher.verify(tail_holder[0])
+        except ValueError as info:
+            raise JencDecryptError(info)
+        stats.lap('verify')
+
+
+@metrics.instrumented('encrypt_stream')
+def encrypt_stream(password, in_file_object, out_file_object, jenc_version=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Takes in:
+        password string (not bytes)
+        file-like object to read plaintext bytes from, until EOF
+        file-like object to write encrypted bytes to
+        version (string)
+        chunk_size, number of bytes to read at a time
+    Returns number of bytes written.
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        in_file = open('Test3.md', 'rb')
+        out_file = open('Test3.md.jenc', 'wb')
+        jenc.encrypt_stream(password, in_file, out_file)
+        out_file.close()
+        in_file.close()
+    """
+    stats = metrics.current()
+    byte_count = 0
+    for encrypted_bytes in encrypt_stream_generator(password, in_file_object, jenc_version=jenc_version, chunk_size=chunk_size):
+        out_file_object.write(encrypted_bytes)
+        stats.lap('write')
+        byte_count += len(encrypted_bytes)
+    return byte_count
+
+
+@metrics.instrumented('decrypt_stream')
+def decrypt_stream(password, in_file_object, out_file_object, skip_hmac_check=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Takes in:
+        password string (not bytes)
+        file-like object to read encrypted bytes from, until EOF
+        file-like object to write plaintext bytes to
+        chunk_size, number of bytes to read at a time
+    Returns number of bytes written.
+    DO NOT USE skip_hmac_check! For debug only
+
+    NOTE plaintext is written before the auth tag is checked, if
+    JencDecryptError is raised the contents of out_file_object must be discarded.
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        in_file = open('Test3.md.jenc', 'rb')
+        out_file = open('Test3.md', 'wb')
+        jenc.decrypt_stream(password, in_file, out_file)
+        out_file.close()
+        in_file.close()
+    """
+    stats = metrics.current()
+    byte_count = 0
+    for plaintext_bytes in decrypt_stream_generator(password, in_file_object, skip_hmac_check=skip_hmac_check, chunk_size=chunk_size):
+        out_file_object.write(plaintext_bytes)
+        stats.lap('write')
+        byte_count += len(plaintext_bytes)
+    return byte_count
+
+
+class JencSession(object):
+    """Encrypt many files with the same password, running the KDF once per salt
+    rather than once per file.
+
+    Each .jenc file stores its own salt, so files sharing a salt (and derived
+    key) but with a fresh random nonce each are still regular .jenc files that
+    decrypt with decrypt() and with Markor/jpencconverter.
+    A new salt (and key) is used after max_files files or max_bytes plaintext
+    bytes, None for no limit.
+
+    Sample code:
+
+        import jenc
+
+        password = 'geheim'
+        with jenc.JencSession(password) as session:
+            for plaintext_bytes in (b"Hello World", b"Hello again"):
+                encrypted_bytes = session.encrypt(plaintext_bytes)
+                print(jenc.decrypt(password, encrypted_bytes))
+    """
+
+    def __init__(self, password, jenc_version=None, max_files=1000, max_bytes=None):
+        jenc_version = jenc_version or DEFAULT_JENC_VERSION
+        jenc_version_check(jenc_version)
+        self.password = password
+        self.jenc_version = jenc_version
+        self.this_file_meta = jenc_version_details[jenc_version]
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.key_derivation_count = 0
+        self._lock = threading.Lock()
+        self._derived_key = None
+
+    def _rotate(self):
+        self.salt_bytes = get_random_bytes(self.this_file_meta['keySaltLength'])
+        self._derived_key = bytearray(_derive_key(self.password, self.salt_bytes, self.this_file_meta))
+        self.key_derivation_count += 1
+        self.file_count = 0
+        self.byte_count = 0
+
+    def _new_file_cipher(self, plaintext_length=0):
+        """Returns tuple of header_bytes and cipher for the next file"""
+        metrics.current().set_version(self.jenc_version)
+        with self._lock:
+            if self._derived_key is None or \
+                    (self.max_files is not None and self.file_count >= self.max_files) or \
+                    (self.max_bytes is not None and self.byte_count + plaintext_length > self.max_bytes and self.file_count):
+                self.close()
+                self._rotate()
+            self.file_count += 1
+            self.byte_count += plaintext_length
+            nonce_bytes = get_random_bytes(self.this_file_meta['nonceLenth'])
+            cipher = _new_cipher_from_key(bytes(self._derived_key), nonce_bytes, self.this_file_meta)
+            header_bytes = self.jenc_version.encode('us-ascii') + nonce_bytes + self.salt_bytes
+        return header_bytes, cipher
+
+    @metrics.instrumented('encrypt')
+    def encrypt(self, plaintext_bytes):
+        """Same as jenc.encrypt(), returns encrypted bytes"""
+        stats = metrics.current()
+        header_bytes, cipher = self._new_file_cipher(len(plaintext_bytes))
+        stats.lap('parse')
+        crypted_bytes, auth_tag = cipher.encrypt_and_digest(plaintext_bytes)
+        stats.lap('cipher')
+        encrypt_bytes = header_bytes + crypted_bytes + auth_tag
+        stats.add_bytes(len(crypted_bytes), len(encrypt_bytes))
+        stats.lap('write')
+        return encrypt_bytes
+
+    @metrics.instrumented('encrypt_file_handle')
+    def encrypt_file_handle(self, file_object, plaintext_bytes):
+        """Same as jenc.encrypt_file_handle()"""
+        file_object.write(self.encrypt(plaintext_bytes))
+        metrics.current().lap('write')
+
+    @metrics.instrumented('encrypt_stream')
+    def encrypt_stream(self, in_file_object, out_file_object, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Same as jenc.encrypt_stream(), returns number of bytes written.
+        NOTE plaintext length is unknown up front so max_bytes is checked at the start of the next file"""
+        stats = metrics.current()
+        header_bytes, cipher = self._new_file_cipher()
+        stats.lap('parse')
+        byte_count = 0
+        for encrypted_bytes in _encrypt_chunks(cipher, header_bytes, in_file_object, chunk_size):
+            out_file_object.write(encrypted_bytes)
+            stats.lap('write')
+            byte_count += len(encrypted_bytes)
+        with self._lock:
+            self.byte_count += byte_count - len(header_bytes) - AUTH_TAG_LENGTH
+        return byte_count
+
+    @metrics.instrumented('encrypt_stream')
+    def encrypt_chunks(self, plaintext_chunks, out_file_object):
+        """Same as encrypt_stream() but plaintext comes from an iterable of bytes (e.g. decrypt_stream_generator()),
+        returns number of bytes written"""
+        stats = metrics.current()
+        header_bytes, cipher = self._new_file_cipher()
+        out_file_object.write(header_bytes)
+        stats.lap('write')
+        plaintext_length = 0
+        for plaintext_bytes in plaintext_chunks:
+            stats.skip()
+            encrypted_bytes = cipher.encrypt(plaintext_bytes)
+            stats.lap('cipher')
+            out_file_object.write(encrypted_bytes)
+            stats.lap('write')
+            plaintext_length += len(plaintext_bytes)
+        auth_tag = cipher.digest()
+        out_file_object.write(auth_tag)
+        byte_count = len(header_bytes) + plaintext_length + len(auth_tag)
+        stats.add_bytes(0, byte_count)  # input bytes are counted by the producer of plaintext_chunks
+        with self._lock:
+            self.byte_count += plaintext_length
+        return byte_count
+
+    def close(self):
+        """Zeroize current derived key, a new salt/key is used if the session is used again"""
+        if self._derived_key is not None:
+            _zeroize(self._derived_key)
+            self._derived_key = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AtomicFileWriter(object):
+    """Write-only file object that replaces `filename` atomically.
+
+    Output goes to a temporary file in the same directory, commit() flushes,
+    fsyncs and renames it over filename; abort() (or an exception inside a
+    with block) removes it, leaving any existing filename untouched.
+    New files are created owner read/write only, when replacing an existing
+    file its permission bits are kept. With overwrite=False commit() never
+    replaces an existing filename (even one created while writing), it
+    raises JencException instead.
+
+    Sample code:
+
+        import jenc
+
+        with jenc.AtomicFileWriter('notes.md.jenc') as out_file:
+            jenc.encrypt_file_handle(out_file, 'geheim', b"Hello World")
+    """
+
+    def __init__(self, filename, fsync=True, overwrite=True):
+        import tempfile
+        self.filename = filename
+        self.fsync = fsync
+        self.overwrite = overwrite
+        directory, basename = os.path.split(os.path.abspath(filename))
+        fd, self.temp_filename = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp', dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+        if os.path.exists(filename):
+            import stat
+            os.chmod(self.temp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def commit(self):
+        """Make written data visible under filename"""
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        if self.overwrite:
+            os.replace(self.temp_filename, self.filename)
+        else:
+            self._commit_no_replace()
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            # persist the rename, not supported on Windows
+            fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _commit_no_replace(self):
+        import errno
+        try:
+            os.link(self.temp_filename, self.filename)  # atomic, fails if filename exists
+        except OSError as info:
+            if info.errno == errno.EEXIST:
+                os.remove(self.temp_filename)
+                raise JencException('output file already exists %r' % self.filename)
+            # no hard link support (e.g. FAT), reserve the name then replace the placeholder
+            try:
+                os.close(os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+            except OSError as info:
+                os.remove(self.temp_filename)
+                if info.errno == errno.EEXIST:
+                    raise JencException('output file already exists %r' % self.filename)
+                raise
+            os.replace(self.temp_filename, self.filename)
+        else:
+            os.remove(self.temp_filename)
+
+    def abort(self):
+        """Discard written data, filename is left untouched"""
+        self.file.close()
+        if os.path.exists(self.temp_filename):
+            os.remove(self.temp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def find_files(paths, decrypt_mode, recursive=False):
+    """Takes in list of file and directory names.
+    Returns list of filenames to process, directories are searched
+    for .jenc files when decrypting, and non-.jenc files when encrypting.
+    """
+    result = []
+    for path in paths:
+        if not os.path.isdir(path):
+            result.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(JENC_FILENAME_EXTENSION) == decrypt_mode:
+                    result.append(os.path.join(dirpath, filename))
+            if not recursive:
+                break
+    return result
+
+
+def output_filename(in_filename, decrypt_mode):
+    """Returns filename for output next to in_filename, .jenc extension added or stripped"""
+    if not decrypt_mode:
+        return in_filename + JENC_FILENAME_EXTENSION
+    if not in_filename.endswith(JENC_FILENAME_EXTENSION):
+        raise JencException('missing %s extension, can not determine output filename' % JENC_FILENAME_EXTENSION)
+    return in_filename[:-len(JENC_FILENAME_EXTENSION)]
+
+
+_worker_state = {}  # per process state for process_files()
+
+def _process_files_init(password, jenc_version, collect_metrics=False):
+    _worker_state['password'] = password
+    _worker_state['session'] = JencSession(password, jenc_version=jenc_version)
+    if collect_metrics:
+        metrics.enable_metrics()
+
+def _process_file(job):
+    """Encrypt/decrypt one file for process_files(), returns tuple of;
+    (in_filename, out_filename, error or None, number of bytes read, metrics.OperationStats or None)
+    """
+    in_filename, decrypt_mode = job
+    with metrics.operation(decrypt_mode and 'decrypt_file' or 'encrypt_file') as stats:
+        result = _process_one_file(in_filename, decrypt_mode)
+        if result[2] is not None:
+            stats.set_error(result[2])
+    if not isinstance(stats, metrics.OperationStats):
+        stats = None
+    return result + (stats,)
+
+def _process_one_file(in_filename, decrypt_mode):
+    out_filename = None
+    try:
+        out_filename = output_filename(in_filename, decrypt_mode)
+        if os.path.exists(out_filename):
+            raise JencException('output file already exists %r' % out_filename)  # early out, commit() checks again atomically
+        in_file = open(in_filename, 'rb')
+        try:
+            # temporary file until complete (and for decrypt verified), never replaces an existing file
+            out_file = AtomicFileWriter(out_filename, overwrite=False)
+            try:
+                if decrypt_mode:
+                    decrypt_stream(_worker_state['password'], in_file, out_file)
+                else:
+                    _worker_state['session'].encrypt_stream(in_file, out_file)
+            except:
+                out_file.abort()
+                raise
+            out_file.commit()
+            return in_filename, out_filename, None, in_file.tell()
+        finally:
+            in_file.close()
+    except Exception as info:
+        return in_filename, out_filename, info, 0
+
+
+def process_files(password, filenames, decrypt_mode, jenc_version=None, jobs=None, verbose=False):
+    """Encrypt/decrypt multiple files, output written next to each input
+    with .jenc extension added (encrypt) or stripped (decrypt).
+    Existing output files are NOT overwritten.
+    Work is spread across `jobs` worker processes (defaults to CPU count),
+    password is only passed in once per worker.
+    Reports per file success/failure and throughput on stderr.
+    Returns 0 on success, 1 if any file failed (process exit code).
+    """
+    import multiprocessing
+    jobs = jobs or multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(filenames)))
+    work = [(filename, decrypt_mode) for filename in filenames]
+    collector = metrics.collector
+    start_time = time.time()
+    if jobs == 1:
+        _process_files_init(password, jenc_version)
+        results = map(_process_file, work)
+        pool = None
     else:
-        raise UnsupportedMetaData('cipher %r' % this_file_meta['cipher'])
+        pool = multiprocessing.Pool(processes=jobs, initializer=_process_files_init, initargs=(password, jenc_version, collector is not None))
+        results = pool.imap_unordered(_process_file, work)
+    failure_count = 0
+    byte_count = 0
+    try:
+        for in_filename, out_filename, error, file_byte_count, file_stats in results:
+            if pool is not None and collector is not None and file_stats is not None:
+                collector.record(file_stats)  # from worker process
+            if error is None:
+                byte_count += file_byte_count
+                if verbose:
+                    sys.stderr.write('ok     %s -> %s\n' % (in_filename, out_filename))
+            else:
+                failure_count += 1
+                sys.stderr.write('FAILED %s %r\n' % (in_filename, error))
+    finally:
+        if pool is None:
+            _worker_state['session'].close()
+        _worker_state.clear()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    stop_time = time.time()
+    elapsed = stop_time - start_time
+    sys.stderr.write('%d files, %d ok, %d failed, %d bytes in %f secs (%.2f MB/sec) using %d jobs\n' % (
+        len(filenames), len(filenames) - failure_count, failure_count, byte_count, elapsed, byte_count / (elapsed or 1e-9) / (1024 * 1024), jobs))
+    sys.stderr.flush()
+    if failure_count:
+        return 1
+    return 0
 
-    log.debug('cipher %r', cipher)
-    log.debug('content_bytes %r', content_bytes)
-    #plaintext_bytes = cipher.decrypt(content_bytes)  # if you want to decrypt BUT skip MAC check
-    plaintext_bytes = cipher.decrypt_and_verify(content_bytes, auth_tag)  # TODO catch ValueError: MAC check failed
-    log.debug('plaintext_bytes %r', plaintext_bytes)
-    original_length = len(content_bytes)
-    return plaintext_bytes
+
+def search(pattern, paths, password, **kwargs):
+    """Search .jenc files for lines matching pattern (regex), without writing plaintext to disk.
+    Yields SearchMatch(filename, line_number, line) tuples, see jenc.grep.search() for options.
+
+    Sample code:
+
+        import jenc
+
+        for match in jenc.search(b'TODO', ['my_notes_dir'], 'geheim'):
+            print('%s:%d:%r' % match)
+    """
+    from . import grep
+    return grep.search(pattern, paths, password, **kwargs)
+
+
+def _resolve_password(password=None, password_file=None, envvar=None):
+    """Returns password from (in order); password, contents of password_file (trailing blanks are ignored),
+    OS environment variable envvar. None if none are set"""
+    if password:
+        return password
+    if password_file:
+        f = open(password_file, 'rb')
+        password_file_bytes = f.read()
+        f.close()
+        return password_file_bytes.strip()
+    if envvar:
+        return os.environ.get(envvar) or None
+    return None
 
 
 def main(argv=None):
+    import getpass
+    import optparse
+
     if argv is None:
         argv = sys.argv
+    setup_logging()
+
+    if argv[1:2] == ['agent']:
+        # python -m jenc agent
+        from . import agent
+        return agent.main(argv[1:])
+    if argv[1:2] == ['grep']:
+        # python -m jenc grep
+        from . import grep
+        return grep.main(argv[1:])
+    if argv[1:2] == ['sync']:
+        # python -m jenc sync
+        from . import sync
+        return sync.main(argv[1:])
 
     # python -m jenc
-    usage = "usage: %prog [options] in_filename"
+    usage = "usage: %prog [options] in_filename [in_filename_or_directory ...]"
     parser = optparse.OptionParser(
         usage=usage,
         version="%prog " + __version__,
@@ -380,32 +1437,186 @@ def main(argv=None):
     parser.add_option("-p", "--password", help="password, if omitted but OS env JENC_PASSWORD is set use that, if missing prompt - unsafe")
     parser.add_option("-P", "--password_file", help="file name where password is to be read from, trailing blanks are ignored")
     parser.add_option("-j", "--jenc-version", "--jenc_version", help="jenc version to use, case sensitive")
+    parser.add_option("--compression", help="encrypt, compress before encrypting with ALGORITHM (zlib or lzma), implies -j C001 which Markor can NOT read", metavar="ALGORITHM")
+    parser.add_option("--max-expansion-ratio", "--max_expansion_ratio", help="decrypt, compressed (C001) input that can not be authenticated first (stdin, --pipeline) may decompress to at most RATIO times its size, 0 for no limit (defaults to OS env JENC_MAX_EXPANSION_RATIO or 100)", type="float", metavar="RATIO")
     parser.add_option("-v", "--verbose", action="store_true")
     parser.add_option("-s", "--silent", help="if specified do not warn about stdin using", action="store_false", default=True)
+    parser.add_option("-r", "--recursive", help="multi-file mode, process directories recursively", action="store_true")
+    parser.add_option("--scan", help="report meta data (version, lengths, structural validity) of .jenc files/directories without decrypting, no password needed", action="store_true")
+    parser.add_option("--jobs", help="multi-file mode, number of worker processes (defaults to CPU count)", type="int")
+    parser.add_option("--no-agent", "--no_agent", help="do not use the jenc agent (OS env JENC_AGENT_SOCK) when no password is given, see `python -m jenc agent`", action="store_true")
+    parser.add_option("--rekey", help="rewrite .jenc files/directories in place with a new password (see --new_password), resumable", action="store_true")
+    parser.add_option("--migrate-to", "--migrate_to", help="rewrite .jenc files/directories in place as jenc VERSION (e.g. V001), files already at VERSION are skipped", metavar="VERSION")
+    parser.add_option("--new_password", help="--rekey new password, if omitted but OS env JENC_NEW_PASSWORD is set use that, if missing prompt - unsafe")
+    parser.add_option("--new_password_file", help="--rekey file name where new password is to be read from, trailing blanks are ignored")
+    parser.add_option("--journal", help="--rekey/--migrate-to checkpoint journal FILE, completed files are skipped when re-run (defaults to .jenc_rewrite_journal in the first directory)", metavar="FILE")
+    parser.add_option("--stats", help="print per-phase (read, parse, kdf, cipher, verify, write) timings and byte counts to stderr", action="store_true")
+    parser.add_option("--stats-format", "--stats_format", help="format for --stats; text, json or prometheus (defaults to %default)", type="choice", choices=['text', 'json', 'prometheus'], default='text')
+    parser.add_option("--profile", help="run under cProfile, print profile and per-phase timings to stderr", action="store_true")
+    parser.add_option("--pipeline", help="single file mode, stream with separate reader/cipher/writer stages instead of reading all input into memory, see --chunk-size and --release", action="store_true")
+    parser.add_option("--chunk-size", "--chunk_size", help="--pipeline read size, K/M suffix supported (defaults to %default)", default='1M', metavar="SIZE")
+    parser.add_option("--release", help="--pipeline decrypt output policy; verify (write only after auth tag verified, plaintext held in memory) or stream (write immediately, discard output on error) (defaults to %default)", type="choice", choices=['verify', 'stream'], default='verify')
 
     (options, args) = parser.parse_args(argv[1:])
     #print('%r' % ((options, args),))
     verbose = options.verbose
     if verbose:
         print(sys.version.replace('\n', ' '))
+        print('jenc %s backends %r' % (__version__, backends.active_backends()))
+
+    if options.scan:
+        if scan_files(find_files(args or ['.'], True, recursive=options.recursive)):
+            return 1
+        return 0
+
+    if options.migrate_to:
+        try:
+            jenc_version_check(options.migrate_to)
+        except UnsupportedMetaData:
+            parser.error('--migrate-to unsupported jenc version %r' % options.migrate_to)
+
+    if options.compression:
+        from . import compression
+        try:
+            compression.set_algorithm(options.compression)
+        except UnsupportedMetaData as info:
+            parser.error('--compression %s' % info)
+        options.jenc_version = options.jenc_version or compression.COMPRESSED_JENC_VERSION
+        if jenc_version_details.get(options.jenc_version, {}).get('cipher') != JENC_AES_GCM_COMPRESSED:
+            parser.error('--compression needs a compressed jenc version, e.g. %s' % compression.COMPRESSED_JENC_VERSION)
+
+    if options.max_expansion_ratio is not None:
+        if options.max_expansion_ratio < 0:
+            parser.error('--max-expansion-ratio must be 0 (no limit) or more')
+        from . import compression
+        compression.set_limits(max_ratio=options.max_expansion_ratio)
+
+    if options.pipeline:
+        from .bench import parse_size
+        try:
+            options.chunk_size = parse_size(options.chunk_size)
+        except ValueError:
+            options.chunk_size = 0
+        if options.chunk_size <= 0:
+            parser.error('--chunk-size invalid size')
+
+    password = _resolve_password(options.password, options.password_file, options.envvar or 'JENC_PASSWORD')
+    agent_client = None
+    agent_socket_path = os.environ.get('JENC_AGENT_SOCK')
+    single_file_mode = not (len(args) > 1 or options.recursive or (args and os.path.isdir(args[0])) or options.rekey or options.migrate_to)
+    if password is None and agent_socket_path and single_file_mode and not options.no_agent and not options.pipeline:  # agent has no streaming interface
+        # ssh-agent style, keys held by `python -m jenc agent`
+        from . import agent
+        agent_client = agent.AgentClient(agent_socket_path)
+    elif password is None:
+        password = getpass.getpass("Password:")
+    new_password = None
+    if options.rekey:
+        new_password = _resolve_password(options.new_password, options.new_password_file, 'JENC_NEW_PASSWORD')
+        if not new_password:
+            new_password = getpass.getpass("New password:")
+            if new_password != getpass.getpass("New password (again):"):
+                parser.error('new passwords do not match')
+    collector = None
+    if options.stats or options.profile:
+        collector = metrics.enable_metrics()
+    profiler = None
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return _main_command(parser, options, args, password, new_password, agent_client)
+    finally:
+        if agent_client is not None:
+            agent_client.close()
+        if profiler is not None:
+            import pstats
+            profiler.disable()
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(PROFILE_LINE_COUNT)
+        if collector is not None:
+            sys.stderr.write('\n')
+            if options.stats_format == 'json':
+                sys.stderr.write(collector.to_json(indent=4) + '\n')
+            elif options.stats_format == 'prometheus':
+                sys.stderr.write(collector.to_prometheus())
+            else:
+                sys.stderr.write(collector.phase_report())
+            sys.stderr.flush()
+            metrics.disable_metrics()
+
+
+def _pipeline_command(options, password, in_file, out_file, decrypt_mode):
+    """--pipeline single file mode, see jenc.pipeline"""
+    from . import pipeline
+
+    start_time = time.time()
+    failed = True
+    with metrics.operation(decrypt_mode and 'decrypt_file' or 'encrypt_file') as stats:  # read/cipher/write overlap, so no per-phase laps
+        try:
+            if decrypt_mode:
+                release = options.release
+                if isinstance(out_file, AtomicFileWriter):
+                    release = pipeline.RELEASE_STREAM  # no need to hold plaintext in memory, out_file is not committed unless verified
+                pipeline.decrypt(password, in_file, out_file, release=release, chunk_size=options.chunk_size)
+            else:
+                pipeline.encrypt(password, in_file, out_file, jenc_version=options.jenc_version, chunk_size=options.chunk_size)
+            if isinstance(out_file, AtomicFileWriter):
+                out_file.commit()
+            failed = False
+        except JencException as info:
+            print("JencException %r" % (info,))
+            stats.set_error(info)
+        except Exception as info:
+            print("Exception %r" % (info,))
+            stats.set_error(info)
+        finally:
+            if in_file is not sys.stdin and in_file is not getattr(sys.stdin, 'buffer', None):
+                in_file.close()
+            if isinstance(out_file, AtomicFileWriter):
+                if failed:
+                    out_file.abort()
+            elif out_file is not sys.stdout and out_file is not getattr(sys.stdout, 'buffer', None):
+                out_file.close()
+    stop_time = time.time()
+    sys.stderr.write('\ntook %f secs' % (stop_time - start_time,))
+    sys.stderr.flush()
+
+    if failed:
+        return 1
+    return 0
+
+
+def _main_command(parser, options, args, password, new_password=None, agent_client=None):
+    import mmap
 
     try:
         in_filename = args[0]
     except IndexError:
         # no filename specified so default to stdin
         in_filename = '-'
-
-    if options.password_file:
-        f = open(options.password_file, 'rb')
-        password_file = f.read()
-        f.close()
-        password_file = password_file.strip()
-    else:
-        password_file = None
-    password = options.password or password_file or os.environ.get(options.envvar or 'JENC_PASSWORD') or getpass.getpass("Password:")
+    verbose = options.verbose
     decrypt_mode = options.decrypt  # TODO possible additional heuristics; filename extension, read the first bytes and sniff/magic value match it
     out_filename = options.out_filename
 
+    if options.rekey or options.migrate_to:
+        # rewrite .jenc files in place
+        from . import rewrite
+        if out_filename != '-':
+            parser.error('-o/--output can not be used with --rekey/--migrate-to')
+        if not args:
+            parser.error('--rekey/--migrate-to need files or directories')
+        journal_filename = options.journal
+        if journal_filename is None and os.path.isdir(in_filename):
+            journal_filename = os.path.join(in_filename, rewrite.JOURNAL_FILENAME)
+        return rewrite.rewrite_files(password, find_files(args, True, recursive=options.recursive), new_password=new_password, jenc_version=options.migrate_to, jobs=options.jobs, journal_filename=journal_filename, verbose=verbose)
+
+    if len(args) > 1 or options.recursive or os.path.isdir(in_filename):
+        # multi-file mode, output written next to input
+        if out_filename != '-':
+            parser.error('-o/--output can not be used with multiple files or directories')
+        return process_files(password, find_files(args, decrypt_mode, recursive=options.recursive), decrypt_mode, jenc_version=options.jenc_version, jobs=options.jobs, verbose=verbose)
+
     if in_filename == '-':
         if is_py3:
             in_file = sys.stdin.buffer
@@ -424,34 +1635,70 @@ def main(argv=None):
             out_file = sys.stdout
         # handle string versus bytes....?
     else:
-        out_file = open(out_filename, 'wb')
-
-    in_file_bytes = in_file.read()  # read all in at once
-    start_time = time.time()
-    failed = True
-    try:
-        if decrypt_mode:
-            #import pdb ; pdb.set_trace()
-            test_plaintext_bytes = decrypt(password, in_file_bytes)
-            out_file.write(test_plaintext_bytes)
-            failed = False
-        else:
-            # encrypt
-            if options.jenc_version:
-                encrypted_bytes = encrypt(password, in_file_bytes, jenc_version=options.jenc_version)
+        out_file = AtomicFileWriter(out_filename)  # out_filename only replaced once complete, and for decrypt verified
+
+    if options.pipeline:
+        return _pipeline_command(options, password, in_file, out_file, decrypt_mode)
+
+    with metrics.operation(decrypt_mode and 'decrypt_file' or 'encrypt_file') as stats:  # read/write of CLI files are phases of the operation
+        in_file_bytes = None
+        # decrypt to disk in chunks, constant memory. Safe as out_file is only committed after the auth tag is verified
+        stream_decrypt = decrypt_mode and agent_client is None and isinstance(out_file, AtomicFileWriter)
+        if not stream_decrypt and in_file is not sys.stdin and in_file is not getattr(sys.stdin, 'buffer', None):
+            try:
+                # map input file rather than reading a copy into memory
+                in_file_bytes = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                pass  # for example; empty file, pipe, or unsupported platform
+        if in_file_bytes is None and not stream_decrypt:
+            in_file_bytes = in_file.read()  # read all in at once
+        stats.lap('read')
+        start_time = time.time()
+        failed = True
+        try:
+            if decrypt_mode:
+                #import pdb ; pdb.set_trace()
+                if stream_decrypt:
+                    decrypt_stream(password, in_file, out_file)
+                else:
+                    if agent_client is not None:
+                        test_plaintext_bytes = agent_client.decrypt(in_file_bytes)
+                    else:
+                        test_plaintext_bytes = decrypt(password, in_file_bytes)
+                    out_file.write(test_plaintext_bytes)
+                if isinstance(out_file, AtomicFileWriter):
+                    out_file.commit()
+                stats.lap('write')
+                failed = False
             else:
-                encrypted_bytes = encrypt(password, in_file_bytes)
-            out_file.write(encrypted_bytes)
-            failed = False
-    except JencException as info:  # TODO catch additional specific jenc exceptions
-        print("JencException %r" % (info,))
-    except Exception as info:  # TODO catch specific jenc exceptions
-        print("Exception %r" % (info,))
-    finally:
-        if in_file != sys.stdin:
-            in_file.close()
-        if out_file != sys.stdout:
-            out_file.close()
+                # encrypt
+                if agent_client is not None:
+                    encrypted_bytes = agent_client.encrypt(in_file_bytes, jenc_version=options.jenc_version)
+                elif options.jenc_version:
+                    encrypted_bytes = encrypt(password, in_file_bytes, jenc_version=options.jenc_version)
+                else:
+                    encrypted_bytes = encrypt(password, in_file_bytes)
+                out_file.write(encrypted_bytes)
+                if isinstance(out_file, AtomicFileWriter):
+                    out_file.commit()
+                stats.lap('write')
+                failed = False
+        except JencException as info:  # TODO catch additional specific jenc exceptions
+            print("JencException %r" % (info,))
+            stats.set_error(info)
+        except Exception as info:  # TODO catch specific jenc exceptions
+            print("Exception %r" % (info,))
+            stats.set_error(info)
+        finally:
+            if isinstance(in_file_bytes, mmap.mmap):
+                in_file_bytes.close()
+            if in_file != sys.stdin:
+                in_file.close()
+            if isinstance(out_file, AtomicFileWriter):
+                if failed:
+                    out_file.abort()  # leave any existing out_filename untouched
+            elif out_file != sys.stdout:
+                out_file.close()
     stop_time = time.time()
     sys.stderr.write('\ntook %f secs' % (stop_time - start_time,))
     sys.stderr.flush()
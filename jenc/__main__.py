@@ -1,3 +1,5 @@
+import sys
+
 from jenc import main
 
-main()
+sys.exit(main())
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""ssh-agent style jenc agent, unlock once and encrypt/decrypt over a Unix domain socket.
+
+The agent holds the password and derived keys (per salt, with a TTL) in
+memory, so clients skip the password prompt and PBKDF2; a request costs a
+socket round trip plus AES-GCM.
+
+Start the agent, it prints the socket path to export:
+
+    python -m jenc agent -P password.txt --ttl 600
+    JENC_AGENT_SOCK=/run/user/1000/jenc/agent.sock; export JENC_AGENT_SOCK;
+
+The socket directory must be owned by the user and private (mode 0700),
+agent and clients refuse to use it otherwise.
+
+With JENC_AGENT_SOCK set and no password given, `python -m jenc` uses the agent:
+
+    python -m jenc Test3.md.jenc
+
+Sample code:
+
+    import jenc.agent
+
+    client = jenc.agent.AgentClient()  # JENC_AGENT_SOCK
+    encrypted_bytes = client.encrypt(b"Hello World")
+    print(client.decrypt(encrypted_bytes))
+    print(client.decrypt_many([encrypted_bytes] * 10))  # pipelined
+    client.close()
+
+Protocol, frames are a 4 byte big-endian length followed by that many bytes.
+Request frame: 1 byte operation then operation specific data:
+
+  * OP_ENCRYPT - 4 byte jenc version (NUL bytes for default) then plaintext bytes
+  * OP_DECRYPT - .jenc bytes
+  * OP_STATUS - nothing, response is JSON
+  * OP_STOP - nothing, agent forgets keys and exits
+
+Response frame: 1 byte status then data (result bytes, or utf-8 error message).
+Requests on a connection are processed in order, clients may send more
+requests before reading responses (pipelining).
+
+"""
+
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import threading
+
+import jenc
+
+
+AGENT_SOCKET_ENVVAR = 'JENC_AGENT_SOCK'
+DEFAULT_TTL = 600  # in seconds, derived keys are forgotten this long after being derived
+DEFAULT_MAX_ENTRIES = 1024  # derived keys held
+DEFAULT_WINDOW = 32  # pipelined requests in flight per client
+MAX_FRAME_LENGTH = 1024 * 1024 * 1024  # in bytes
+INITIAL_FRAME_ALLOCATION = 1024 * 1024  # in bytes, frame buffers grow (doubling) as data arrives, not from the length prefix alone
+
+OP_ENCRYPT = b'E'
+OP_DECRYPT = b'D'
+OP_STATUS = b'S'
+OP_STOP = b'Q'
+
+STATUS_OK = b'K'
+STATUS_DECRYPT_ERROR = b'D'
+STATUS_UNSUPPORTED = b'U'
+STATUS_ERROR = b'X'
+
+_length_struct = struct.Struct('>I')
+_default_version = b'\x00' * 4
+
+
+class AgentError(jenc.JencException):
+    '''Agent not reachable or protocol error'''
+
+
+def default_socket_path():
+    """Returns socket path from JENC_AGENT_SOCK, else per user path in
+    XDG_RUNTIME_DIR or (if not set) the temp directory"""
+    socket_path = os.environ.get(AGENT_SOCKET_ENVVAR)
+    if socket_path:
+        return socket_path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'jenc', 'agent.sock')
+    import tempfile
+    user_id = getattr(os, 'getuid', lambda: 0)()
+    return os.path.join(tempfile.gettempdir(), 'jenc-%d' % user_id, 'agent.sock')
+
+
+def check_socket_directory(socket_path):
+    """Raises AgentError unless the directory containing socket_path is a
+    real directory (not a symlink) owned by the current user with no
+    group/other access. The default path is in the shared temp directory,
+    another user could create it first and replace the socket to capture
+    passwords.
+    """
+    if not hasattr(os, 'getuid'):
+        return  # no POSIX ownership/permissions
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    try:
+        directory_stat = os.lstat(directory)
+    except OSError as info:
+        raise AgentError('unable to check socket directory %r %r' % (directory, info))
+    if not stat.S_ISDIR(directory_stat.st_mode):
+        raise AgentError('socket directory %r is not a directory (symlink?)' % directory)
+    if directory_stat.st_uid != os.getuid():
+        raise AgentError('socket directory %r is not owned by the current user' % directory)
+    if directory_stat.st_mode & 0o077:
+        raise AgentError('socket directory %r is accessible by other users, mode %o' % (directory, stat.S_IMODE(directory_stat.st_mode)))
+
+
+def _recv_exact(sock, length):
+    """Returns `length` bytes from sock, None on EOF before any byte.
+    The buffer starts at INITIAL_FRAME_ALLOCATION bytes and grows as data
+    arrives, a peer cannot make us allocate MAX_FRAME_LENGTH by sending a
+    length prefix alone"""
+    buffer = bytearray(min(length, INITIAL_FRAME_ALLOCATION))
+    view = memoryview(buffer)
+    offset = 0
+    while offset < length:
+        if offset == len(buffer):
+            view.release()  # bytearray can not be resized while exported
+            buffer.extend(bytes(min(length, 2 * len(buffer)) - len(buffer)))
+            view = memoryview(buffer)
+        received = sock.recv_into(view[offset:], len(buffer) - offset)
+        if not received:
+            if offset == 0:
+                return None
+            raise AgentError('connection closed mid frame')
+        offset += received
+    view.release()
+    return buffer
+
+
+def _recv_frame(sock):
+    """Returns frame payload (bytearray) or None on EOF"""
+    header = _recv_exact(sock, _length_struct.size)
+    if header is None:
+        return None
+    (length,) = _length_struct.unpack(bytes(header))
+    if length > MAX_FRAME_LENGTH:
+        raise AgentError('frame too large %d' % length)
+    if length == 0:
+        return bytearray()
+    payload = _recv_exact(sock, length)
+    if payload is None:
+        raise AgentError('connection closed mid frame')
+    return payload
+
+
+def _send_frame(sock, prefix, data=b''):
+    """Send frame of prefix + data, data (any buffer) is not copied"""
+    data_length = len(memoryview(data))
+    sock.sendall(_length_struct.pack(len(prefix) + data_length) + prefix)
+    if data_length:
+        sock.sendall(data)
+
+
+class JencAgent(object):
+    """Serves encrypt/decrypt requests on a Unix domain socket, see module docs.
+    Decryption keys are kept in a jenc.DerivedKeyCache (per salt, TTL),
+    encryption uses a jenc.JencSession which is replaced after ttl seconds.
+    """
+
+    def __init__(self, password, socket_path=None, ttl=DEFAULT_TTL, jenc_version=None, max_entries=DEFAULT_MAX_ENTRIES):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise AgentError('Unix domain sockets not supported on this platform')
+        self.password = password
+        self.socket_path = socket_path or default_socket_path()
+        self.ttl = ttl
+        self.jenc_version = jenc_version or jenc.DEFAULT_JENC_VERSION
+        jenc.jenc_version_check(self.jenc_version)
+        self.key_cache = jenc.DerivedKeyCache(max_entries=max_entries, ttl=ttl)
+        self._sessions = {}  # jenc_version -> (expiry time, JencSession)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.request_count = 0
+        self.listen_socket = None
+
+    def _session(self, jenc_version):
+        now = jenc._monotonic()
+        with self._lock:
+            entry = self._sessions.get(jenc_version)
+            if entry is not None and self.ttl is not None and entry[0] <= now:
+                entry[1].close()
+                entry = None
+            if entry is None:
+                expiry = None
+                if self.ttl is not None:
+                    expiry = now + self.ttl
+                entry = self._sessions[jenc_version] = (expiry, jenc.JencSession(self.password, jenc_version=jenc_version, max_files=None))
+        return entry[1]
+
+    def encrypt(self, plaintext_bytes, jenc_version=None):
+        return self._session(jenc_version or self.jenc_version).encrypt(plaintext_bytes)
+
+    def decrypt(self, encrypt_bytes):
+        return jenc.decrypt(self.password, encrypt_bytes, key_cache=self.key_cache)
+
+    def status(self):
+        return {
+            'jenc': jenc.__version__,
+            'pid': os.getpid(),
+            'requests': self.request_count,
+            'jenc_version': self.jenc_version,
+            'key_cache': self.key_cache.stats(),
+        }
+
+    def handle_request(self, request):
+        """Returns (status byte, response data) for request frame payload"""
+        with self._lock:  # called from one thread per client
+            self.request_count += 1
+        operation, data = bytes(request[:1]), memoryview(request)[1:]
+        try:
+            if operation == OP_DECRYPT:
+                return STATUS_OK, self.decrypt(data)
+            elif operation == OP_ENCRYPT:
+                jenc_version = bytes(data[:4])
+                if jenc_version == _default_version:
+                    jenc_version = None
+                else:
+                    jenc_version = jenc_version.decode('us-ascii')
+                    jenc.jenc_version_check(jenc_version)
+                return STATUS_OK, self.encrypt(data[4:], jenc_version=jenc_version)
+            elif operation == OP_STATUS:
+                return STATUS_OK, json.dumps(self.status()).encode('utf-8')
+            elif operation == OP_STOP:
+                self.stop()
+                return STATUS_OK, b''
+            else:
+                return STATUS_ERROR, ('unknown operation %r' % operation).encode('utf-8')
+        except jenc.JencDecryptError as info:
+            return STATUS_DECRYPT_ERROR, str(info).encode('utf-8')
+        except jenc.UnsupportedMetaData as info:
+            return STATUS_UNSUPPORTED, str(info).encode('utf-8')
+        except Exception as info:
+            return STATUS_ERROR, repr(info).encode('utf-8')
+
+    def _handle_connection(self, connection):
+        try:
+            while not self._stopped.is_set():
+                request = _recv_frame(connection)
+                if request is None:
+                    break
+                status, data = self.handle_request(request)
+                _send_frame(connection, status, data)
+        except (AgentError, EnvironmentError):
+            pass  # client went away
+        finally:
+            connection.close()
+
+    def bind(self):
+        """Create listening socket, owner only access. Refuses to replace a live agent's socket"""
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.lexists(directory):
+            os.makedirs(directory, 0o700)
+        check_socket_directory(self.socket_path)  # existing directory is not trusted
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                probe.close()
+                raise AgentError('agent already running on %r' % self.socket_path)
+            except socket.error:
+                os.remove(self.socket_path)  # stale
+            finally:
+                probe.close()
+        listen_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        original_umask = os.umask(0o177)
+        try:
+            listen_socket.bind(self.socket_path)
+        finally:
+            os.umask(original_umask)
+        os.chmod(self.socket_path, 0o600)
+        listen_socket.listen(16)
+        self.listen_socket = listen_socket
+
+    def serve_forever(self):
+        """Accept connections until stop() (or OP_STOP), each client is served by its own thread"""
+        if self.listen_socket is None:
+            self.bind()
+        self.listen_socket.settimeout(0.5)  # check for stop
+        try:
+            while not self._stopped.is_set():
+                try:
+                    connection, address = self.listen_socket.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                thread = threading.Thread(target=self._handle_connection, args=(connection,), name='jenc-agent-client')
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stopped.set()
+
+    def close(self):
+        """Stop serving, remove socket and forget (zeroize) keys"""
+        self.stop()
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+            self.listen_socket = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        with self._lock:
+            for expiry, session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+        self.key_cache.zeroize()
+        self.password = None
+
+
+class AgentClient(object):
+    """Client for JencAgent, not thread safe (use one client per thread)"""
+
+    def __init__(self, socket_path=None, timeout=None):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise AgentError('Unix domain sockets not supported on this platform')
+        self.socket_path = socket_path or default_socket_path()
+        check_socket_directory(self.socket_path)  # before any password is sent
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.socket_path)
+        except socket.error as info:
+            self.sock.close()
+            raise AgentError('unable to connect to agent %r %r' % (self.socket_path, info))
+
+    def _send(self, operation, data=b''):
+        _send_frame(self.sock, operation, data)
+
+    def _receive(self):
+        response = _recv_frame(self.sock)
+        if response is None:
+            raise AgentError('agent closed connection')
+        status, data = bytes(response[:1]), response[1:]
+        if status == STATUS_OK:
+            return bytes(data)
+        message = bytes(data).decode('utf-8', 'replace')
+        if status == STATUS_DECRYPT_ERROR:
+            raise jenc.JencDecryptError(message)
+        if status == STATUS_UNSUPPORTED:
+            raise jenc.UnsupportedMetaData(message)
+        raise AgentError(message)
+
+    def _encrypt_prefix(self, jenc_version):
+        if jenc_version is None:
+            return OP_ENCRYPT + _default_version
+        return OP_ENCRYPT + jenc_version.encode('us-ascii')
+
+    def encrypt(self, plaintext_bytes, jenc_version=None):
+        """Same as jenc.encrypt(), returns encrypted bytes"""
+        self._send(self._encrypt_prefix(jenc_version), plaintext_bytes)
+        return self._receive()
+
+    def decrypt(self, encrypt_bytes):
+        """Same as jenc.decrypt(), returns plaintext bytes"""
+        self._send(OP_DECRYPT, encrypt_bytes)
+        return self._receive()
+
+    def _pipeline(self, requests, window):
+        """Send (prefix, data) requests keeping up to window in flight, returns list of results (or exceptions)"""
+        results = []
+        in_flight = 0
+        for prefix, data in requests:
+            if in_flight >= window:
+                results.append(self._receive_result())
+                in_flight -= 1
+            self._send(prefix, data)
+            in_flight += 1
+        while in_flight:
+            results.append(self._receive_result())
+            in_flight -= 1
+        return results
+
+    def _receive_result(self):
+        try:
+            return self._receive()
+        except (jenc.JencDecryptError, jenc.UnsupportedMetaData) as info:
+            return info
+
+    def encrypt_many(self, plaintexts, jenc_version=None, window=DEFAULT_WINDOW):
+        """Pipelined encrypt, returns list of encrypted bytes (or exception instance for failures) in order"""
+        prefix = self._encrypt_prefix(jenc_version)
+        return self._pipeline(((prefix, plaintext_bytes) for plaintext_bytes in plaintexts), window)
+
+    def decrypt_many(self, encrypted, window=DEFAULT_WINDOW):
+        """Pipelined decrypt, returns list of plaintext bytes (or JencDecryptError instance for failures) in order"""
+        return self._pipeline(((OP_DECRYPT, encrypt_bytes) for encrypt_bytes in encrypted), window)
+
+    def status(self):
+        self._send(OP_STATUS)
+        return json.loads(self._receive().decode('utf-8'))
+
+    def stop_agent(self):
+        """Ask agent to forget keys and exit"""
+        self._send(OP_STOP)
+        return self._receive()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv=None):
+    import getpass
+    import optparse
+
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog agent [options]"
+    parser = optparse.OptionParser(
+        usage=usage,
+        version="%prog " + jenc.__version__,
+        description="jenc agent, holds password and derived keys in memory and serves encrypt/decrypt on a Unix domain socket"
+    )
+    parser.add_option("-E", "--envvar", help="Name of environment variable to get password from (defaults to JENC_PASSWORD) - unsafe", default="JENC_PASSWORD")
+    parser.add_option("-p", "--password", help="password, if omitted but OS env JENC_PASSWORD is set use that, if missing prompt - unsafe")
+    parser.add_option("-P", "--password_file", help="file name where password is to be read from, trailing blanks are ignored")
+    parser.add_option("-j", "--jenc-version", "--jenc_version", help="jenc version to encrypt with, case sensitive")
+    parser.add_option("-a", "--socket", help="Unix domain socket path (defaults to OS env JENC_AGENT_SOCK or a per user temp directory)")
+    parser.add_option("--ttl", help="seconds derived keys (and the encryption session key) are kept before being derived again (defaults to %default)", type="int", default=DEFAULT_TTL)
+    parser.add_option("-k", "--kill", help="stop the running agent", action="store_true")
+    parser.add_option("--status", help="report status of the running agent", action="store_true")
+
+    (options, args) = parser.parse_args(argv[1:])
+    socket_path = options.socket or default_socket_path()
+
+    if options.kill or options.status:
+        client = AgentClient(socket_path)
+        try:
+            if options.kill:
+                client.stop_agent()
+            else:
+                print(json.dumps(client.status(), indent=4, sort_keys=True))
+        finally:
+            client.close()
+        return 0
+
+    password = jenc._resolve_password(options.password, options.password_file, options.envvar) or getpass.getpass("Password:")
+    agent = JencAgent(password, socket_path=socket_path, ttl=options.ttl, jenc_version=options.jenc_version)
+    agent.bind()
+    print('%s=%s; export %s;' % (AGENT_SOCKET_ENVVAR, agent.socket_path, AGENT_SOCKET_ENVVAR))
+    sys.stdout.flush()
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""asyncio API for jenc, for use in event loop based services (aiohttp, etc.)
+
+Key derivation (PBKDF2) and AES-GCM work, and file I/O, are run in an
+executor so the event loop is never blocked. The number of operations
+in flight is limited by a semaphore. Uses the same header parsing and
+version table (jenc.jenc_version_details) as the synchronous API.
+
+Sample code:
+
+    import asyncio
+    import jenc.aio
+
+    async def demo():
+        password = 'geheim'
+        encrypted_bytes = await jenc.aio.encrypt(password, b"Hello World")
+        plaintext_bytes = await jenc.aio.decrypt(password, encrypted_bytes)
+        print(plaintext_bytes)
+
+    asyncio.run(demo())
+
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import weakref
+
+import jenc
+
+
+DEFAULT_MAX_CONCURRENCY = os.cpu_count() or 4
+
+_config = {
+    'executor': None,  # set by configure(), None means use the private executor
+    'private_executor': None,  # ThreadPoolExecutor created on first use, owned (and shut down) by this module
+    'max_concurrency': DEFAULT_MAX_CONCURRENCY,
+}
+_semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+
+def configure(executor=None, max_concurrency=None):
+    """Set the executor jenc work is offloaded to, and the maximum number of
+    concurrent operations (per event loop).
+    Executor can be any concurrent.futures.Executor, a ThreadPoolExecutor is
+    a good fit as pycryptodome releases the GIL during KDF and cipher work.
+    A caller supplied executor is never shut down by jenc. The private
+    executor is shut down (work already submitted still completes) when it is
+    replaced by a caller supplied executor or max_concurrency changes.
+    """
+    max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+    private_executor = _config['private_executor']
+    if private_executor is not None and (executor is not None or max_concurrency != _config['max_concurrency']):
+        private_executor.shutdown(wait=False)  # do not block the (possibly running) event loop
+        _config['private_executor'] = None
+    _config['executor'] = executor
+    _config['max_concurrency'] = max_concurrency
+    _semaphores.clear()
+
+
+def _get_executor():
+    if _config['executor'] is not None:
+        return _config['executor']
+    if _config['private_executor'] is None:
+        _config['private_executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=_config['max_concurrency'], thread_name_prefix='jenc')
+    return _config['private_executor']
+
+
+def _get_semaphore(loop):
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(_config['max_concurrency'])
+    return semaphore
+
+
+async def _run(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    async with _get_semaphore(loop):
+        return await loop.run_in_executor(_get_executor(), functools.partial(function, *args, **kwargs))
+
+
+async def encrypt(password, plaintext_bytes, jenc_version=None):
+    """Async version of jenc.encrypt(), returns encrypted bytes"""
+    return await _run(jenc.encrypt, password, plaintext_bytes, jenc_version=jenc_version)
+
+
+async def decrypt(password, encrypt_bytes):
+    """Async version of jenc.decrypt(), returns plaintext bytes"""
+    return await _run(jenc.decrypt, password, encrypt_bytes)
+
+
+def _encrypt_file(password, in_filename, out_filename, jenc_version):
+    in_file = open(in_filename, 'rb')
+    try:
+        out_file = jenc.AtomicFileWriter(out_filename)
+        try:
+            result = jenc.encrypt_stream(password, in_file, out_file, jenc_version=jenc_version)
+        except:
+            out_file.abort()
+            raise
+        out_file.commit()
+        return result
+    finally:
+        in_file.close()
+
+
+def _decrypt_file(password, in_filename, out_filename):
+    in_file = open(in_filename, 'rb')
+    try:
+        if out_filename is None:
+            return jenc.decrypt_file_handle(in_file, password)
+        out_file = jenc.AtomicFileWriter(out_filename)  # only replaced once the auth tag is verified
+        try:
+            result = jenc.decrypt_stream(password, in_file, out_file)
+        except:
+            out_file.abort()
+            raise
+        out_file.commit()
+        return result
+    finally:
+        in_file.close()
+
+
+async def encrypt_file(password, in_filename, out_filename, jenc_version=None):
+    """Encrypt plaintext file in_filename into out_filename, constant memory.
+    out_filename is replaced atomically once complete.
+    Returns number of bytes written.
+    """
+    return await _run(_encrypt_file, password, in_filename, out_filename, jenc_version)
+
+
+async def decrypt_file(password, in_filename, out_filename=None):
+    """Decrypt .jenc file in_filename.
+    If out_filename is None returns plaintext bytes, otherwise plaintext is
+    streamed into out_filename (constant memory) and the number of bytes written returned.
+    out_filename is only created/replaced once the auth tag has been verified,
+    on JencDecryptError it is left untouched.
+    """
+    return await _run(_decrypt_file, password, in_filename, out_filename)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Pluggable crypto backends for jenc, KDF and cipher are selected separately.
+
+KDF (PBKDF2) backends:
+
+  * pycryptodome - Crypto.Protocol.KDF.PBKDF2
+  * hashlib - Python stdlib hashlib.pbkdf2_hmac (OpenSSL)
+  * parallel - pycryptodome HMAC state computed once per password, PBKDF2 blocks
+    (2 for U001) derived concurrently, single block keys (V001) via hashlib,
+    see jenc.kdf. Opt-in only, never auto-selected
+
+Cipher (AES-GCM) backends:
+
+  * pycryptodome - Crypto.Cipher.AES
+  * cryptography - https://cryptography.io/ AES-GCM (OpenSSL, AES-NI), if installed
+  * parallel - pycryptodome AES-GCM split across threads for large payloads, see jenc.gcm.
+    Opt-in only, never auto-selected
+
+On first use the fastest available backend is picked with a short
+calibration (which also checks the result matches the reference
+pycryptodome implementation). Override with environment variables
+JENC_KDF_BACKEND and JENC_CIPHER_BACKEND, or JENC_BACKEND for both,
+or from code:
+
+    import jenc.backends
+
+    jenc.backends.set_backend(kdf='hashlib', cipher='pycryptodome')
+    print(jenc.backends.active_backends())
+
+"""
+
+import os
+import threading
+import time
+
+
+KDF_SHA1 = 'sha1'
+KDF_SHA512 = 'sha512'
+
+REFERENCE_BACKEND = 'pycryptodome'
+CALIBRATION_KDF_ITERATIONS = 500
+CALIBRATION_CIPHER_SIZE = 256 * 1024  # in bytes
+AES_BLOCK_SIZE = 16  # in bytes
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time  # py2
+
+
+class BackendNotAvailable(Exception):
+    '''Requested backend is not registered or its library is not installed'''
+
+
+def password_to_bytes(password):
+    """Convert password to bytes the same way pycryptodome PBKDF2 does (latin-1 for str),
+    so all KDF backends derive identical keys"""
+    if isinstance(password, (bytearray, memoryview)):
+        return bytes(password)
+    if isinstance(password, bytes):
+        return password
+    return password.encode('latin-1')
+
+
+############################################################
+# KDF backends
+# derive(password_bytes, salt_bytes, key_length, iterations, hash_name) -> bytes
+
+def pycryptodome_pbkdf2(password_bytes, salt_bytes, key_length, iterations, hash_name):
+    from Crypto.Protocol.KDF import PBKDF2
+    if hash_name == KDF_SHA512:
+        from Crypto.Hash import SHA512 as hmac_hash_module
+    elif hash_name == KDF_SHA1:
+        from Crypto.Hash import SHA1 as hmac_hash_module
+    else:
+        raise BackendNotAvailable('hash %r' % hash_name)
+    return PBKDF2(password_bytes, salt_bytes, key_length, count=iterations, hmac_hash_module=hmac_hash_module)
+
+def hashlib_pbkdf2(password_bytes, salt_bytes, key_length, iterations, hash_name):
+    import hashlib
+    return hashlib.pbkdf2_hmac(hash_name, password_bytes, bytes(salt_bytes), iterations, key_length)
+
+
+############################################################
+# Cipher backends
+# new_cipher(key, nonce_bytes) -> object with pycryptodome GCM style methods;
+#   encrypt(data, output=None), decrypt(data, output=None), digest(), verify(tag),
+#   encrypt_and_digest(data), decrypt_and_verify(data, tag)
+# verify() raises ValueError on failure
+
+def pycryptodome_aes_gcm(key, nonce_bytes):
+    from Crypto.Cipher import AES
+    return AES.new(key, AES.MODE_GCM, nonce=nonce_bytes)
+
+
+class CryptographyAesGcm(object):
+    """pycryptodome GCM cipher API on top of cryptography's streaming (hazmat) AES-GCM"""
+
+    def __init__(self, key, nonce_bytes):
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        self._cipher = Cipher(algorithms.AES(bytes(key)), modes.GCM(bytes(nonce_bytes)))
+        self._context = None
+
+    def _update(self, data, output):
+        if output is None:
+            return self._context.update(data)
+        data_view = memoryview(data).cast('B')
+        out_view = memoryview(output).cast('B')
+        if out_view.nbytes != data_view.nbytes:
+            raise ValueError('output must be a bytearray or writeable memoryview of length %d' % data_view.nbytes)
+        # update_into() needs AES block size - 1 bytes of slack in the output, the tail goes via update()
+        split_offset = max(0, data_view.nbytes - (AES_BLOCK_SIZE - 1))
+        if split_offset:
+            self._context.update_into(data_view[:split_offset], out_view)
+        out_view[split_offset:] = self._context.update(data_view[split_offset:])
+        return None
+
+    def encrypt(self, plaintext, output=None):
+        if self._context is None:
+            self._context = self._cipher.encryptor()
+        return self._update(plaintext, output)
+
+    def decrypt(self, ciphertext, output=None):
+        if self._context is None:
+            self._context = self._cipher.decryptor()
+        return self._update(ciphertext, output)
+
+    def digest(self):
+        if self._context is None:
+            self._context = self._cipher.encryptor()
+        self._context.finalize()
+        return self._context.tag
+
+    def verify(self, received_mac_tag):
+        from cryptography.exceptions import InvalidTag
+        if self._context is None:
+            self._context = self._cipher.decryptor()
+        try:
+            self._context.finalize_with_tag(bytes(received_mac_tag))
+        except InvalidTag:
+            raise ValueError('MAC check failed')
+
+    def encrypt_and_digest(self, plaintext):
+        return self.encrypt(plaintext), self.digest()
+
+    def decrypt_and_verify(self, ciphertext, received_mac_tag):
+        plaintext = self.decrypt(ciphertext)
+        self.verify(received_mac_tag)
+        return plaintext
+
+
+def parallel_pbkdf2(password_bytes, salt_bytes, key_length, iterations, hash_name):
+    from . import kdf
+    return kdf.pbkdf2(password_bytes, salt_bytes, key_length, iterations, hash_name)
+
+def cryptography_aes_gcm(key, nonce_bytes):
+    return CryptographyAesGcm(key, nonce_bytes)
+
+def parallel_aes_gcm(key, nonce_bytes):
+    from . import gcm
+    return gcm.ParallelAesGcm(key, nonce_bytes)
+
+
+############################################################
+# Registry
+
+kdf_backends = {}  # name -> (derive function, availability check function)
+cipher_backends = {}  # name -> (new_cipher function, availability check function)
+OPT_IN_BACKENDS = ('parallel',)  # only used when selected by name (KDF and cipher), calibration is too small to show their benefit
+
+_active = {'kdf': None, 'cipher': None}
+_lock = threading.Lock()
+
+
+def _module_available(module_name):
+    def check():
+        try:
+            __import__(module_name)
+        except ImportError:
+            return False
+        return True
+    return check
+
+def _parallel_available():
+    from . import gcm
+    return gcm.available()
+
+def _parallel_kdf_available():
+    from . import kdf
+    return kdf.available()
+
+def _hashlib_available():
+    import hashlib
+    return hasattr(hashlib, 'pbkdf2_hmac')  # py2.7.8+ and py3.4+
+
+def register_kdf_backend(name, derive_function, available=None):
+    kdf_backends[name] = (derive_function, available or (lambda: True))
+
+def register_cipher_backend(name, new_cipher_function, available=None):
+    cipher_backends[name] = (new_cipher_function, available or (lambda: True))
+
+register_kdf_backend('pycryptodome', pycryptodome_pbkdf2, _module_available('Crypto.Protocol.KDF'))
+register_kdf_backend('hashlib', hashlib_pbkdf2, _hashlib_available)
+register_kdf_backend('parallel', parallel_pbkdf2, _parallel_kdf_available)
+register_cipher_backend('pycryptodome', pycryptodome_aes_gcm, _module_available('Crypto.Cipher.AES'))
+register_cipher_backend('cryptography', cryptography_aes_gcm, _module_available('cryptography.hazmat.primitives.ciphers'))
+register_cipher_backend('parallel', parallel_aes_gcm, _parallel_available)
+
+
+def available_backends():
+    """Returns dict of lists of available (installed) backend names"""
+    return {
+        'kdf': sorted(name for name, (function, available) in kdf_backends.items() if available()),
+        'cipher': sorted(name for name, (function, available) in cipher_backends.items() if available()),
+    }
+
+
+def _calibrate_kdf(names):
+    password_bytes, salt_bytes = b'calibrate', b'\x00' * 64
+    timings = []
+    for name in names:
+        derive_function = kdf_backends[name][0]
+        start_time = timer()
+        result = derive_function(password_bytes, salt_bytes, 32, CALIBRATION_KDF_ITERATIONS, KDF_SHA512)
+        timings.append((timer() - start_time, name, result))
+    reference = [result for duration, name, result in timings if name == REFERENCE_BACKEND]
+    timings = [(duration, name) for duration, name, result in timings if not reference or result == reference[0]]
+    return min(timings)[1]
+
+def _calibrate_cipher(names):
+    key, nonce_bytes, plaintext = b'\x01' * 32, b'\x02' * 32, b'\x03' * CALIBRATION_CIPHER_SIZE
+    timings = []
+    for name in names:
+        new_cipher_function = cipher_backends[name][0]
+        new_cipher_function(key, nonce_bytes).encrypt_and_digest(plaintext[:16])  # warm up, e.g. load library
+        start_time = timer()
+        result = new_cipher_function(key, nonce_bytes).encrypt_and_digest(plaintext)
+        timings.append((timer() - start_time, name, result))
+    reference = [result for duration, name, result in timings if name == REFERENCE_BACKEND]
+    timings = [(duration, name) for duration, name, result in timings if not reference or result == reference[0]]
+    return min(timings)[1]
+
+
+def _select(kind, registry, calibrate):
+    """Returns active backend function for kind, selecting on first use"""
+    with _lock:
+        name = _active[kind]
+        if name is None:
+            name = os.environ.get('JENC_%s_BACKEND' % kind.upper()) or os.environ.get('JENC_BACKEND')
+            if name:
+                if name not in registry or not registry[name][1]():
+                    raise BackendNotAvailable('%s backend %r' % (kind, name))
+            else:
+                names = [name for name in available_backends()[kind] if name not in OPT_IN_BACKENDS]
+                if not names:
+                    raise BackendNotAvailable('no %s backend available, install pycryptodome' % kind)
+                if len(names) == 1:
+                    name = names[0]
+                else:
+                    name = calibrate(names)
+            _active[kind] = name
+        return registry[name][0]
+
+
+def set_backend(kdf=None, cipher=None):
+    """Select backends by name, None leaves that backend unchanged"""
+    for kind, registry, name in (('kdf', kdf_backends, kdf), ('cipher', cipher_backends, cipher)):
+        if name is None:
+            continue
+        if name not in registry or not registry[name][1]():
+            raise BackendNotAvailable('%s backend %r' % (kind, name))
+        _active[kind] = name
+
+
+def reset_backends():
+    """Forget selected backends, next use will auto-select (calibrate) again"""
+    _active['kdf'] = _active['cipher'] = None
+
+
+def active_backends():
+    """Returns dict of active backend names (selecting them if needed)"""
+    _select('kdf', kdf_backends, _calibrate_kdf)
+    _select('cipher', cipher_backends, _calibrate_cipher)
+    return dict(_active)
+
+
+def pbkdf2(password, salt_bytes, key_length, iterations, hash_name):
+    """Derive key_length bytes using PBKDF2-HMAC-`hash_name` with the active KDF backend"""
+    name = _active['kdf']
+    if name is None:
+        derive_function = _select('kdf', kdf_backends, _calibrate_kdf)
+    else:
+        derive_function = kdf_backends[name][0]
+    return derive_function(password_to_bytes(password), salt_bytes, key_length, iterations, hash_name)
+
+
+def new_aes_gcm(key, nonce_bytes):
+    """Returns new AES-GCM cipher object from the active cipher backend"""
+    name = _active['cipher']
+    if name is None:
+        new_cipher_function = _select('cipher', cipher_backends, _calibrate_cipher)
+    else:
+        new_cipher_function = cipher_backends[name][0]
+    return new_cipher_function(key, nonce_bytes)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Benchmarks for jenc, emits machine readable JSON so results can be
+compared between releases and hosts.
+
+Measures:
+
+  * kdf - key derivation (PBKDF2) per jenc version, no cipher work
+  * kdf_engine - jenc.kdf PBKDF2 engine per jenc version; cold (new engine, HMAC keyed per call),
+    serial (cached engine, 1 thread), parallel (cached engine, blocks on threads, threads is the CPU count)
+    and batch_per_key (KDF_BATCH_SIZE salts in one batch, time per key), against hashlib.pbkdf2_hmac (hashlib).
+    U001 has 2 blocks, V001 1 (single block keys are derived with hashlib by the engine)
+  * cipher - AES-GCM encrypt/decrypt throughput with a fixed key, no KDF, active backend
+    and jenc.gcm parallel (parallel_encrypt/parallel_decrypt, threads is the CPU count)
+  * encrypt, decrypt, decrypt_file_handle - full operations, per payload size
+      * cold - derived key cache disabled, every call runs the KDF
+      * warm - KDF amortized; decrypt with a primed derived key cache, encrypt with a JencSession
+  * tracing - decrypt (warm) with jenc.tracing off and on, against raw AES-GCM decrypt of the same payload;
+    tracing_off_ratio close to 1.0 means tracing costs nothing when disabled
+
+Sample usage:
+
+    python -m jenc.bench
+    python -m jenc.bench --sizes 100,1K,1M,100M,1G --repeat 3 -o bench.json
+
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+from io import BytesIO
+from io import StringIO
+
+import jenc
+
+
+DEFAULT_SIZES = '100,1K,10K,100K,1M,10M'
+DEFAULT_REPEAT = 5
+LARGE_PAYLOAD_SIZE = 100 * 1024 * 1024  # in bytes, payloads this size or larger are repeated fewer times
+LARGE_PAYLOAD_REPEAT = 2
+KDF_BATCH_SIZE = 16  # salts per derive_many() call
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time  # py2
+
+
+def parse_size(size_str):
+    """Parse size string, e.g. 100, 1K, 10M, 1G (1024 based) into number of bytes"""
+    size_str = size_str.strip().upper()
+    multiplier = 1
+    for suffix, suffix_multiplier in (('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3)):
+        if size_str.endswith(suffix):
+            size_str = size_str[:-1]
+            multiplier = suffix_multiplier
+            break
+    return int(size_str) * multiplier
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(timings, byte_count=None):
+    """Returns dict of statistics for list of timings (in seconds)"""
+    timings = sorted(timings)
+    result = {
+        'count': len(timings),
+        'min': timings[0],
+        'max': timings[-1],
+        'mean': sum(timings) / len(timings),
+        'p50': percentile(timings, 50),
+        'p90': percentile(timings, 90),
+        'p99': percentile(timings, 99),
+    }
+    if byte_count is not None:
+        result['bytes'] = byte_count
+        result['mb_per_sec_p50'] = byte_count / (result['p50'] or 1e-9) / (1024 * 1024)
+    return result
+
+
+def time_calls(function, repeat):
+    """Returns list of durations (in seconds) of `repeat` calls to function"""
+    timings = []
+    for x in range(repeat):
+        start_time = timer()
+        function()
+        timings.append(timer() - start_time)
+    return timings
+
+
+def bench_kdf(jenc_version, repeat):
+    this_file_meta = jenc.jenc_version_details[jenc_version]
+    password = 'geheim'
+    salt_bytes = jenc.get_random_bytes(this_file_meta['keySaltLength'])
+    return summarize(time_calls(lambda: jenc._pbkdf2_derive_key(password, salt_bytes, this_file_meta), repeat))
+
+
+def bench_kdf_engine(jenc_version, repeat):
+    from jenc import gcm
+    from jenc import kdf
+    this_file_meta = jenc.jenc_version_details[jenc_version]
+    password_bytes = b'geheim'
+    hash_name = jenc._key_factory_hash_names[this_file_meta['keyFactory']]
+    key_length, iterations = this_file_meta['keyLength'] // 8, this_file_meta['keyIterationCount']
+    salt_bytes = jenc.get_random_bytes(this_file_meta['keySaltLength'])
+    salts = [jenc.get_random_bytes(this_file_meta['keySaltLength']) for x in range(KDF_BATCH_SIZE)]
+    serial_engine = kdf.Pbkdf2Engine(password_bytes, hash_name, jobs=1)
+    parallel_engine = kdf.Pbkdf2Engine(password_bytes, hash_name)
+    parallel_engine.derive_many(salts[:2], key_length, iterations)  # warm up, e.g. start pool threads
+    batch_timings = time_calls(lambda: parallel_engine.derive_many(salts, key_length, iterations), repeat)
+    return {
+        'hashlib': summarize(time_calls(lambda: hashlib.pbkdf2_hmac(hash_name, password_bytes, salt_bytes, iterations, key_length), repeat)),
+        'cold': summarize(time_calls(lambda: kdf.Pbkdf2Engine(password_bytes, hash_name).derive(salt_bytes, key_length, iterations), repeat)),
+        'serial': summarize(time_calls(lambda: serial_engine.derive(salt_bytes, key_length, iterations), repeat)),
+        'parallel': summarize(time_calls(lambda: parallel_engine.derive(salt_bytes, key_length, iterations), repeat)),
+        'batch_per_key': summarize([duration / KDF_BATCH_SIZE for duration in batch_timings]),
+        'blocks': (key_length + serial_engine.digest_size - 1) // serial_engine.digest_size,
+        'threads': gcm.default_jobs(),
+    }
+
+
+def bench_cipher(jenc_version, size, repeat):
+    from jenc import gcm
+    this_file_meta = jenc.jenc_version_details[jenc_version]
+    derived_key = jenc.get_random_bytes(this_file_meta['keyLength'] // 8)
+    nonce_bytes = jenc.get_random_bytes(this_file_meta['nonceLenth'])
+    plaintext_bytes = os.urandom(size)
+    crypted_bytes, auth_tag = jenc._new_cipher_from_key(derived_key, nonce_bytes, this_file_meta).encrypt_and_digest(plaintext_bytes)
+    crypted_bytes, auth_tag = crypted_bytes + auth_tag[:-jenc.AUTH_TAG_LENGTH], auth_tag[-jenc.AUTH_TAG_LENGTH:]  # digest() may return trailing ciphertext, e.g. C001
+    result = {
+        'encrypt': summarize(time_calls(lambda: jenc._new_cipher_from_key(derived_key, nonce_bytes, this_file_meta).encrypt_and_digest(plaintext_bytes), repeat), size),
+        'decrypt': summarize(time_calls(lambda: jenc._new_cipher_from_key(derived_key, nonce_bytes, this_file_meta).decrypt_and_verify(crypted_bytes, auth_tag), repeat), size),
+    }
+    if this_file_meta['cipher'] == jenc.JENC_AES_GCM_NoPadding:
+        result['parallel_encrypt'] = summarize(time_calls(lambda: gcm.ParallelAesGcm(derived_key, nonce_bytes).encrypt_and_digest(plaintext_bytes), repeat), size)
+        result['parallel_decrypt'] = summarize(time_calls(lambda: gcm.ParallelAesGcm(derived_key, nonce_bytes).decrypt_and_verify(crypted_bytes, auth_tag), repeat), size)
+        result['threads'] = gcm.default_jobs()
+    return result
+
+
+def bench_operations(jenc_version, size, repeat):
+    password = 'geheim'
+    plaintext_bytes = os.urandom(size)
+    encrypted_bytes = jenc.encrypt(password, plaintext_bytes, jenc_version=jenc_version)
+    operations = {
+        'encrypt': lambda: jenc.encrypt(password, plaintext_bytes, jenc_version=jenc_version),
+        'decrypt': lambda: jenc.decrypt(password, encrypted_bytes),
+        'decrypt_file_handle': lambda: jenc.decrypt_file_handle(BytesIO(encrypted_bytes), password),
+    }
+    result = {}
+    original_cache = jenc.derived_key_cache
+    try:
+        jenc.disable_key_cache()
+        for name, function in operations.items():
+            result[name] = {'cold': summarize(time_calls(function, repeat), size)}
+
+        session = jenc.JencSession(password, jenc_version=jenc_version, max_files=None)
+        operations['encrypt'] = lambda: session.encrypt(plaintext_bytes)
+        jenc.enable_key_cache()
+        for name, function in operations.items():
+            function()  # prime cache/session
+            result[name]['warm'] = summarize(time_calls(function, repeat), size)
+        session.close()
+    finally:
+        jenc.disable_key_cache()
+        jenc.derived_key_cache = original_cache
+    return result
+
+
+def bench_tracing(jenc_version, size, repeat):
+    import logging
+    from jenc import tracing
+    password = 'geheim'
+    plaintext_bytes = os.urandom(size)
+    encrypted_bytes = jenc.encrypt(password, plaintext_bytes, jenc_version=jenc_version)
+    split_jenc_version, this_file_meta, nonce_bytes, salt_bytes, content_view, auth_tag = jenc._split_buffer(encrypted_bytes)
+    derived_key = jenc._pbkdf2_derive_key(password, salt_bytes, this_file_meta)
+    key_cache = jenc.DerivedKeyCache()
+    key_cache.derive(password, salt_bytes, this_file_meta, jenc._pbkdf2_derive_key)  # prime
+    result = {
+        'raw_aes_gcm': summarize(time_calls(lambda: jenc._new_cipher_from_key(derived_key, nonce_bytes, this_file_meta).decrypt_and_verify(content_view, auth_tag), repeat), size),
+    }
+    decrypt = lambda: jenc.decrypt(password, encrypted_bytes, key_cache=key_cache)
+    was_enabled = tracing.enabled
+    tracing.disable_tracing()
+    result['tracing_off'] = summarize(time_calls(decrypt, repeat), size)
+    handler = logging.StreamHandler(StringIO())  # records are formatted, output discarded
+    tracing.log.addHandler(handler)
+    tracing.enable_tracing()
+    try:
+        result['tracing_on'] = summarize(time_calls(decrypt, repeat), size)
+    finally:
+        tracing.log.removeHandler(handler)
+        if not was_enabled:
+            tracing.disable_tracing()
+    key_cache.zeroize()
+    result['tracing_off_ratio'] = result['tracing_off']['p50'] / (result['raw_aes_gcm']['p50'] or 1e-9)
+    return result
+
+
+def pycryptodome_version():
+    try:
+        import Crypto
+    except ImportError:
+        return None
+    return getattr(Crypto, '__version__', None)
+
+
+def host_details():
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+        'python': sys.version.replace('\n', ' '),
+        'python_implementation': platform.python_implementation(),
+        'jenc': jenc.__version__,
+        'pycryptodome': pycryptodome_version(),
+        'backends': jenc.backends.active_backends(),
+    }
+
+
+def run_benchmarks(sizes=None, repeat=DEFAULT_REPEAT, versions=None, verbose=False):
+    """Run all benchmarks, returns (JSON serializable) dict of results"""
+    if sizes is None:
+        sizes = [parse_size(x) for x in DEFAULT_SIZES.split(',')]
+    versions = versions or sorted(jenc.jenc_version_details)
+    from jenc import kdf
+    kdf_engine_available = kdf.available()
+    result = {
+        'timestamp': time.time(),
+        'host': host_details(),
+        'repeat': repeat,
+        'kdf': {},
+        'kdf_engine': {},
+        'cipher': {},
+        'operations': {},
+        'tracing': {},
+    }
+    for jenc_version in versions:
+        if verbose:
+            sys.stderr.write('%s kdf\n' % jenc_version)
+        result['kdf'][jenc_version] = bench_kdf(jenc_version, repeat)
+        if kdf_engine_available:
+            result['kdf_engine'][jenc_version] = bench_kdf_engine(jenc_version, repeat)
+        result['cipher'][jenc_version] = {}
+        result['operations'][jenc_version] = {}
+        result['tracing'][jenc_version] = {}
+        for size in sizes:
+            if verbose:
+                sys.stderr.write('%s %d bytes\n' % (jenc_version, size))
+            size_repeat = repeat
+            if size >= LARGE_PAYLOAD_SIZE:
+                size_repeat = min(repeat, LARGE_PAYLOAD_REPEAT)
+            result['cipher'][jenc_version][str(size)] = bench_cipher(jenc_version, size, size_repeat)
+            result['operations'][jenc_version][str(size)] = bench_operations(jenc_version, size, size_repeat)
+            result['tracing'][jenc_version][str(size)] = bench_tracing(jenc_version, size, size_repeat)
+    return result
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(
+        usage=usage,
+        version="%prog " + jenc.__version__,
+        description="Benchmark jenc key derivation, cipher and encrypt/decrypt operations, JSON output"
+    )
+    parser.add_option("-o", "--output", dest="out_filename", default='-', help="write JSON output to FILE", metavar="FILE")
+    parser.add_option("--sizes", default=DEFAULT_SIZES, help="comma separated payload sizes, K/M/G suffix supported (defaults to %default)")
+    parser.add_option("--repeat", type="int", default=DEFAULT_REPEAT, help="number of timed runs per measurement (defaults to %default)")
+    parser.add_option("-j", "--jenc-version", "--jenc_version", action="append", help="jenc version to benchmark, can be repeated (defaults to all)")
+    parser.add_option("-v", "--verbose", action="store_true")
+
+    (options, args) = parser.parse_args(argv[1:])
+    sizes = [parse_size(x) for x in options.sizes.split(',')]
+    result = run_benchmarks(sizes=sizes, repeat=options.repeat, versions=options.jenc_version, verbose=options.verbose)
+    json_str = json.dumps(result, indent=4, sort_keys=True)
+    if options.out_filename == '-':
+        print(json_str)
+    else:
+        f = open(options.out_filename, 'w')
+        f.write(json_str)
+        f.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Compress-then-encrypt jenc versions (C001), smaller files for text.
+
+NOTE C001 is a jenc-py extension, Markor / jpencconverter can NOT read it.
+Convert with `python -m jenc -p PASSWORD --migrate-to V001 FILE`.
+
+Same header (version, nonce, salt), key derivation and AES-GCM as V001, the
+encrypted (and so authenticated) content is:
+
+    algorithm id (1 byte) + compressed stream
+
+Algorithms; zlib and lzma (standard library). The algorithm is read from the
+content so decrypt() needs no options. Compression streams in both
+directions, whole file APIs (jenc.encrypt(), jenc.decrypt(), streaming,
+JencSession, --pipeline, etc.) handle C001 via CompressedAesGcm. As the
+plaintext length is only known after decompressing, encrypt_into(),
+decrypt_into() and their length functions do not support C001.
+
+Nothing is decompressed before the auth tag has been checked when the whole
+ciphertext is available; jenc.decrypt() and streaming from seekable files
+run AES-GCM over the content first (authenticate_first()), then decrypt and
+decompress without limits. Only non-seekable streams (pipes, --pipeline)
+decompress unauthenticated data; there output is limited to
+MAX_EXPANSION_RATIO times the compressed size (decompression bomb guard),
+outputs up to MIN_LIMIT bytes are always allowed. Exceeding the limit raises
+DecompressionLimitExceeded, once the auth tag has been checked. Change the
+limits with set_limits(), OS env JENC_MAX_EXPANSION_RATIO or the
+--max-expansion-ratio command line option.
+
+Sample code:
+
+    import jenc
+    import jenc.compression
+
+    jenc.compression.set_algorithm('lzma')  # or OS env JENC_COMPRESSION=lzma, defaults to zlib
+    encrypted_bytes = jenc.encrypt('geheim', b'Hello World' * 1000, jenc_version='C001')
+    plaintext_bytes = jenc.decrypt('geheim', encrypted_bytes)
+
+Command line:
+
+    python -m jenc -e -p geheim --compression zlib -o notes.md.jenc notes.md
+
+"""
+
+import os
+import zlib
+
+import jenc
+from jenc import backends
+
+
+COMPRESSED_JENC_VERSION = 'C001'
+ALGORITHM_IDS = {  # stored in the first (encrypted) content byte, never renumber. 3 is reserved (zstd)
+    'zlib': 1,
+    'lzma': 2,
+}
+MAX_EXPANSION_RATIO = 100  # unauthenticated plaintext may be at most this many times the compressed size...
+MIN_LIMIT = 16 * 1024 * 1024  # ... unless it is at most this size, in bytes
+VERIFY_CHUNK_SIZE = 1024 * 1024  # in bytes, authenticate_first() works through buffers this much at a time
+
+_algorithm = None  # set by set_algorithm()
+_limits = {}  # set by set_limits()
+
+
+class DecompressionLimitExceeded(jenc.JencDecryptError):
+    """Decompressed output larger than MAX_EXPANSION_RATIO/MIN_LIMIT allow"""
+
+
+def is_compressed(this_file_meta):
+    return this_file_meta['cipher'] == jenc.JENC_AES_GCM_COMPRESSED
+
+
+def _algorithm_available(name):
+    if name == 'lzma':
+        try:
+            import lzma
+        except ImportError:  # Python built without liblzma
+            return False
+        return True
+    return name in ALGORITHM_IDS
+
+
+def available_algorithms():
+    """Returns list of algorithm names that can be used in this environment"""
+    return [name for name in sorted(ALGORITHM_IDS, key=ALGORITHM_IDS.get) if _algorithm_available(name)]
+
+
+def set_algorithm(name=None):
+    """Select algorithm used for new C001 files by name, None resets to the default"""
+    if name is not None and not _algorithm_available(name):
+        raise jenc.UnsupportedMetaData('compression %r not available, one of %r' % (name, available_algorithms()))
+    global _algorithm
+    _algorithm = name
+
+
+def current_algorithm(default_algorithm):
+    """Returns algorithm name for new files; set_algorithm(), OS env JENC_COMPRESSION or default_algorithm (from jenc_version_details)"""
+    name = _algorithm or os.environ.get('JENC_COMPRESSION') or default_algorithm
+    if not _algorithm_available(name):
+        raise jenc.UnsupportedMetaData('compression %r not available, one of %r' % (name, available_algorithms()))
+    return name
+
+
+def set_limits(max_ratio=None, min_limit=None):
+    """Set the decompression bomb guard for unauthenticated (non-seekable stream) decryption.
+    max_ratio 0 disables the guard, None resets to OS env JENC_MAX_EXPANSION_RATIO or MAX_EXPANSION_RATIO"""
+    _limits.clear()
+    if max_ratio is not None:
+        _limits['max_ratio'] = max_ratio
+    if min_limit is not None:
+        _limits['min_limit'] = min_limit
+
+
+def current_limits():
+    """Returns tuple of; max_ratio (0 for no limit), min_limit"""
+    max_ratio = _limits.get('max_ratio')
+    if max_ratio is None:
+        max_ratio = float(os.environ.get('JENC_MAX_EXPANSION_RATIO') or MAX_EXPANSION_RATIO)
+    return max_ratio, _limits.get('min_limit', MIN_LIMIT)
+
+
+def _new_compressor(name):
+    """Returns object with compress(data) and flush() methods"""
+    if name == 'zlib':
+        return zlib.compressobj()
+    if name == 'lzma':
+        import lzma
+        return lzma.LZMACompressor()
+    raise jenc.UnsupportedMetaData('compression %r' % name)
+
+
+def _new_decompressor(name):
+    """Returns object with decompress(data, max_length) method and eof, unused_data attributes"""
+    if name == 'zlib':
+        return zlib.decompressobj()
+    import lzma
+    return lzma.LZMADecompressor()
+
+
+class CompressedAesGcm(object):
+    """Cipher for compressed jenc versions with the same (pycryptodome GCM style)
+    API as the jenc.backends ciphers, so whole file APIs work unchanged.
+
+    encrypt() returns encrypted compressed bytes, this may be empty as the
+    compressor buffers. digest() returns the encrypted remainder of the
+    compressed stream followed by the auth tag. decrypt() returns
+    decompressed plaintext, output is not supported by either (lengths are
+    not known in advance). verify() also checks the compressed stream is complete.
+
+    Decompression errors (corrupt stream, unknown algorithm, limit exceeded)
+    are only raised by verify(), after the auth tag has been checked, so a
+    wrong password or tampered file is always reported as a failed tag check.
+    Once authenticate_first() succeeded decrypt() has no expansion limit.
+    """
+
+    def __init__(self, derived_key, nonce_bytes, default_algorithm, max_ratio=None, min_limit=None):
+        self._derived_key = derived_key
+        self._nonce_bytes = nonce_bytes
+        self._cipher = backends.new_aes_gcm(derived_key, nonce_bytes)
+        self.default_algorithm = default_algorithm
+        self.algorithm = None  # encrypt; see current_algorithm(), decrypt; read from content
+        current_max_ratio, current_min_limit = current_limits()
+        self.max_ratio = current_max_ratio if max_ratio is None else max_ratio
+        self.min_limit = current_min_limit if min_limit is None else min_limit
+        self.authenticated = False  # set by authenticate_first()
+        self._compressor = None
+        self._decompressor = None
+        self._error = None  # decrypt, deferred until verify()
+        self._compressed_length = 0  # decrypt, compressed bytes received
+        self._plaintext_length = 0  # decrypt, plaintext bytes returned
+
+    def _start_encrypt(self):
+        if self._compressor is None:
+            self.algorithm = current_algorithm(self.default_algorithm)
+            self._compressor = _new_compressor(self.algorithm)
+            return bytes(bytearray([ALGORITHM_IDS[self.algorithm]]))
+        return b''
+
+    def encrypt(self, plaintext, output=None):
+        if output is not None:
+            raise TypeError('output not supported, compressed length is not known in advance')
+        prefix = self._start_encrypt()
+        return self._cipher.encrypt(prefix + self._compressor.compress(plaintext))
+
+    def digest(self):
+        prefix = self._start_encrypt()
+        return self._cipher.encrypt(prefix + self._compressor.flush()) + self._cipher.digest()
+
+    def authenticate_first(self, content_chunks, auth_tag):
+        """Run AES-GCM over all of the content (iterable of buffers) and check
+        auth_tag before anything is decompressed, nothing is decrypted into
+        memory beyond VERIFY_CHUNK_SIZE. auth_tag may be a callable, called
+        once content_chunks is exhausted. Raises ValueError if the tag does not match.
+        """
+        verifier = backends.new_aes_gcm(self._derived_key, self._nonce_bytes)
+        scratch = bytearray(VERIFY_CHUNK_SIZE)
+        scratch_view = memoryview(scratch)
+        for content in content_chunks:
+            content_view = memoryview(content)
+            for offset in range(0, len(content_view), VERIFY_CHUNK_SIZE):
+                piece = content_view[offset:offset + VERIFY_CHUNK_SIZE]
+                verifier.decrypt(piece, output=scratch_view[:len(piece)])
+        if callable(auth_tag):
+            auth_tag = auth_tag()
+        verifier.verify(auth_tag)
+        self.authenticated = True
+
+    def _decompress(self, compressed_bytes):
+        if self._decompressor is None:
+            if not compressed_bytes:
+                return b''
+            algorithm_id = bytearray(compressed_bytes[:1])[0]
+            compressed_bytes = compressed_bytes[1:]
+            for name, value in ALGORITHM_IDS.items():
+                if value == algorithm_id:
+                    break
+            else:
+                raise jenc.JencDecryptError('unknown compression algorithm id %d' % algorithm_id)
+            if not _algorithm_available(name):
+                raise jenc.UnsupportedMetaData('compression %r not available, one of %r' % (name, available_algorithms()))
+            self.algorithm = name
+            self._decompressor = _new_decompressor(name)
+        if not compressed_bytes:
+            return b''
+        if self._decompressor.eof:
+            raise jenc.JencDecryptError('data after end of compressed stream')
+        self._compressed_length += len(compressed_bytes)
+        limit = None  # authenticated or guard disabled
+        if not self.authenticated and self.max_ratio:
+            limit = max(self.min_limit, int(self.max_ratio * self._compressed_length)) - self._plaintext_length
+        try:
+            if limit is None:
+                plaintext_bytes = self._decompressor.decompress(compressed_bytes)
+            else:
+                plaintext_bytes = self._decompressor.decompress(compressed_bytes, limit + 1)
+        except Exception as info:  # zlib.error, lzma.LZMAError; corrupt or tampered
+            raise jenc.JencDecryptError('%s decompress failed %s' % (self.algorithm, info))
+        if limit is not None and len(plaintext_bytes) > limit:
+            raise DecompressionLimitExceeded('decompressed size exceeds %g times compressed size (%d bytes), see jenc.compression.set_limits() or --max-expansion-ratio' % (self.max_ratio, self._compressed_length))
+        if self._decompressor.unused_data:
+            raise jenc.JencDecryptError('data after end of compressed stream')
+        self._plaintext_length += len(plaintext_bytes)
+        return plaintext_bytes
+
+    def decrypt(self, ciphertext, output=None):
+        if output is not None:
+            raise TypeError('output not supported, plaintext length is not known in advance')
+        compressed_bytes = self._cipher.decrypt(ciphertext)
+        if self._error is not None:
+            return b''  # keep the tag check going, error is raised by verify()
+        try:
+            return self._decompress(compressed_bytes)
+        except jenc.JencException as info:
+            if self.authenticated:
+                raise
+            self._error = info  # may be a wrong password or tampering, check the tag first
+            return b''
+
+    def verify(self, received_mac_tag):
+        self._cipher.verify(received_mac_tag)
+        if self._error is not None:
+            raise self._error
+        if self._decompressor is None or not self._decompressor.eof:
+            raise ValueError('truncated compressed stream')
+
+    def encrypt_and_digest(self, plaintext):
+        return self.encrypt(plaintext), self.digest()
+
+    def decrypt_and_verify(self, ciphertext, received_mac_tag):
+        plaintext = self.decrypt(ciphertext)
+        self.verify(received_mac_tag)
+        return plaintext
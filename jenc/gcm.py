@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Parallel AES-GCM, a single large payload is split into segments that are
+processed on a pool of threads.
+
+GCM is CTR mode encryption plus GHASH (a polynomial in the hash subkey H)
+over the ciphertext, both can be computed per segment independently:
+
+  * CTR - the segment starting at block b uses counter (J0 + 1 + b) mod 2**32
+  * GHASH - each segment of m blocks is hashed from a zero state, results are
+    combined in order with Y = Y * H**m ^ GHASH(segment)
+
+pycryptodome releases the GIL while encrypting/hashing so segments run
+concurrently. Ciphertext and 16 byte tag are identical to serial AES-GCM
+(checked by the test suite).
+
+NOTE GHASH uses pycryptodome's private Crypto.Cipher._mode_gcm, which may
+change between releases; available() runs a known-answer check so the
+backend is only offered if it still gives correct output.
+
+Sample code:
+
+    import jenc
+    import jenc.backends
+
+    jenc.backends.set_backend(cipher='parallel')  # or OS env JENC_CIPHER_BACKEND=parallel
+    encrypted_bytes = jenc.encrypt('geheim', b'x' * (1024 * 1024 * 1024))
+
+Or directly:
+
+    import jenc.gcm
+
+    cipher = jenc.gcm.ParallelAesGcm(key, nonce_bytes, jobs=4)
+    crypted_bytes, auth_tag = cipher.encrypt_and_digest(plaintext_bytes)
+
+"""
+
+import binascii
+import hmac
+import os
+import struct
+import threading
+
+
+BLOCK_SIZE = 16  # in bytes, AES block and GHASH size
+DEFAULT_SEGMENT_SIZE = 1024 * 1024  # in bytes, work per task, multiple of BLOCK_SIZE
+COUNTER_MASK = 0xFFFFFFFF  # GCM increments only the last 32 bits of the counter block
+
+_pools = {}  # (stage, jobs) -> ThreadPool, each stage has its own pool
+_pool_lock = threading.Lock()
+_worker = threading.local()  # active is True on pool threads
+_known_answer = {}  # 'result' -> available() check result, computed once
+
+
+KNOWN_ANSWER_KEY = bytes(bytearray(range(32)))
+KNOWN_ANSWER_NONCE = bytes(bytearray(range(100, 132)))  # 32 bytes, as jenc uses
+KNOWN_ANSWER_PLAINTEXT = bytes(bytearray(i % 251 for i in range(5 * BLOCK_SIZE + 3)))  # several segments and a partial block
+KNOWN_ANSWER_ENCRYPTED = binascii.unhexlify(  # ciphertext + tag, from pycryptodome and cryptography AES-GCM
+    b'ca40d1c44c1bf5724a724c7590dc509342d00afa2dd7dc30ee95967e25d8b1611c27b90d22b122d39b6c2b907eafffd4d2a27892b4aaa49f3d'
+    b'acf8799d97be03aeccf2fd31ba4e0e1fbff37c646ba2b83b8a203b98c1f0a7c918fa1c8579f993b3882b')
+
+
+def _check_known_answer():
+    """Returns True if ParallelAesGcm gives the known ciphertext and tag"""
+    try:
+        from Crypto.Cipher import AES
+        from Crypto.Cipher._mode_gcm import _GHASH, _ghash_clmul, _ghash_portable
+    except ImportError:
+        return False
+    try:
+        cipher = ParallelAesGcm(KNOWN_ANSWER_KEY, KNOWN_ANSWER_NONCE, jobs=1, segment_size=2 * BLOCK_SIZE)
+        encrypted_bytes = cipher.encrypt(KNOWN_ANSWER_PLAINTEXT[:7]) + cipher.encrypt(KNOWN_ANSWER_PLAINTEXT[7:]) + cipher.digest()
+        cipher = ParallelAesGcm(KNOWN_ANSWER_KEY, KNOWN_ANSWER_NONCE, jobs=1, segment_size=2 * BLOCK_SIZE)
+        plaintext_bytes = cipher.decrypt_and_verify(KNOWN_ANSWER_ENCRYPTED[:-BLOCK_SIZE], KNOWN_ANSWER_ENCRYPTED[-BLOCK_SIZE:])
+    except Exception:  # pycryptodome internals changed
+        return False
+    return encrypted_bytes == KNOWN_ANSWER_ENCRYPTED and plaintext_bytes == KNOWN_ANSWER_PLAINTEXT
+
+
+def available():
+    """pycryptodome internals needed for GHASH are present and still give the
+    known ciphertext and tag (known-answer check, run once)"""
+    result = _known_answer.get('result')
+    if result is None:
+        result = _known_answer['result'] = _check_known_answer()
+    return result
+
+
+def default_jobs():
+    if hasattr(os, 'cpu_count'):
+        return os.cpu_count() or 1
+    import multiprocessing  # py2
+    return multiprocessing.cpu_count()
+
+
+def _mark_worker():
+    _worker.active = True
+
+
+def thread_pool(jobs, stage='gcm'):
+    """Returns ThreadPool with `jobs` threads, shared by all users of `stage` (e.g. 'gcm', 'kdf', 'segmented')"""
+    from multiprocessing.pool import ThreadPool
+    with _pool_lock:
+        pool = _pools.get((stage, jobs))
+        if pool is None:
+            pool = _pools[(stage, jobs)] = ThreadPool(jobs, initializer=_mark_worker)
+        return pool
+
+
+def parallel_map(function, items, jobs, stage='gcm'):
+    """Returns list of function(item) for each of items, run on the `stage` pool of `jobs` threads.
+    Runs in the calling thread if there is nothing to gain or it is already a pool
+    thread (e.g. parallel cipher inside a segmented worker), a worker waiting on a
+    pool could otherwise deadlock it"""
+    if jobs > 1 and len(items) > 1 and not getattr(_worker, 'active', False):
+        return thread_pool(jobs, stage).map(function, items)
+    return [function(item) for item in items]
+
+
+def _xor(a, b):
+    """xor of two byte strings of the same length (at most a block)"""
+    return bytes(bytearray(x ^ y for x, y in zip(bytearray(a), bytearray(b))))
+
+
+class ParallelAesGcm(object):
+    """pycryptodome GCM cipher API (see jenc.backends), data passed to one
+    encrypt()/decrypt() call is split into segment_size pieces processed on
+    `jobs` threads. Any call sizes may be used, e.g. by the streaming API.
+    """
+
+    def __init__(self, key, nonce_bytes, jobs=None, segment_size=DEFAULT_SEGMENT_SIZE):
+        from Crypto.Cipher import AES
+        from Crypto.Cipher import _mode_gcm
+        if segment_size <= 0 or segment_size % BLOCK_SIZE:
+            raise ValueError('segment_size %r not a multiple of %d' % (segment_size, BLOCK_SIZE))
+        self.jobs = jobs or default_jobs()
+        self.segment_size = segment_size
+        self._AES = AES
+        self._GHASH = _mode_gcm._GHASH
+        self._ghash_c = _mode_gcm._ghash_clmul or _mode_gcm._ghash_portable
+        self._key = bytes(key)
+        ecb_cipher = AES.new(self._key, AES.MODE_ECB)
+        self._hash_subkey = ecb_cipher.encrypt(b'\x00' * BLOCK_SIZE)
+
+        nonce_bytes = bytes(nonce_bytes)
+        if len(nonce_bytes) == 12:
+            j0 = nonce_bytes + b'\x00\x00\x00\x01'
+        else:
+            fill = (BLOCK_SIZE - len(nonce_bytes) % BLOCK_SIZE) % BLOCK_SIZE + 8
+            j0 = self._ghash(nonce_bytes + b'\x00' * fill + struct.pack('>Q', 8 * len(nonce_bytes)))
+        self._tag_mask = ecb_cipher.encrypt(j0)
+        self._counter_nonce = j0[:12]
+        self._first_counter = (struct.unpack('>I', j0[12:])[0] + 1) & COUNTER_MASK
+
+        self._block_count = 0  # keystream blocks generated so far
+        self._keystream = b''  # unused bytes of the last (partial) keystream block
+        self._pending = b''  # ciphertext of a partial block, not yet hashed
+        self._y = b'\x00' * BLOCK_SIZE  # GHASH state
+        self._message_length = 0
+        self._mode = None
+        self._tag = None
+        self._subkey_powers = {1: self._hash_subkey}  # m -> H**m
+
+    def _ghash(self, data, subkey=None):
+        """GHASH of data (multiple of BLOCK_SIZE) from a zero state"""
+        return self._GHASH(subkey or self._hash_subkey, self._ghash_c).update(data).digest()
+
+    def _multiply(self, a, b):
+        """a * b in GF(2**128), GHASH of the single block a with subkey b"""
+        return self._ghash(a, subkey=b)
+
+    def _subkey_power(self, block_count):
+        result = self._subkey_powers.get(block_count)
+        if result is None:
+            # square and multiply
+            square = self._hash_subkey
+            exponent = block_count
+            while exponent:
+                if exponent & 1:
+                    result = square if result is None else self._multiply(result, square)
+                exponent >>= 1
+                if exponent:
+                    square = self._multiply(square, square)
+            self._subkey_powers[block_count] = result
+        return result
+
+    def _ctr_cipher(self, block_offset):
+        counter = (self._first_counter + block_offset) & COUNTER_MASK
+        return self._AES.new(self._key, self._AES.MODE_CTR, nonce=self._counter_nonce, initial_value=counter)
+
+    def _segment(self, job):
+        """Worker, CTR and GHASH of one block aligned segment. Returns GHASH of its ciphertext"""
+        in_view, out_view, block_offset, decrypting = job
+        if decrypting:
+            ghash_value = self._ghash(in_view)
+            self._ctr_cipher(block_offset).encrypt(in_view, output=out_view)
+        else:
+            self._ctr_cipher(block_offset).encrypt(in_view, output=out_view)
+            ghash_value = self._ghash(out_view)
+        return ghash_value
+
+    def _hash_block(self, block):
+        self._y = self._multiply(_xor(self._y, block), self._hash_subkey)
+
+    def _process(self, data, output, decrypting):
+        if self._tag is not None:
+            raise TypeError('encrypt()/decrypt() cannot be called after digest()/verify()')
+        in_view = memoryview(data).cast('B')
+        length = in_view.nbytes
+        if output is None:
+            result = bytearray(length)
+        else:
+            result = output
+        out_view = memoryview(result).cast('B')
+        if out_view.nbytes != length:
+            raise ValueError('output must be a bytearray or writeable memoryview of length %d' % length)
+        self._message_length += length
+
+        # finish a partial block left from the previous call
+        offset = min(len(self._keystream), length)
+        if offset:
+            out_view[:offset] = _xor(in_view[:offset], self._keystream[:offset])
+            self._keystream = self._keystream[offset:]
+            self._pending += bytes((in_view if decrypting else out_view)[:offset])
+            if len(self._pending) == BLOCK_SIZE:
+                self._hash_block(self._pending)
+                self._pending = b''
+
+        # whole blocks, in segments
+        aligned_end = offset + (length - offset) // BLOCK_SIZE * BLOCK_SIZE
+        jobs = []
+        for start in range(offset, aligned_end, self.segment_size):
+            end = min(start + self.segment_size, aligned_end)
+            jobs.append((in_view[start:end], out_view[start:end], self._block_count + (start - offset) // BLOCK_SIZE, decrypting))
+        ghash_values = parallel_map(self._segment, jobs, self.jobs)
+        for job, ghash_value in zip(jobs, ghash_values):
+            segment_blocks = job[0].nbytes // BLOCK_SIZE
+            self._y = _xor(self._multiply(self._y, self._subkey_power(segment_blocks)), ghash_value)
+        self._block_count += (aligned_end - offset) // BLOCK_SIZE
+
+        # start a partial block
+        if aligned_end < length:
+            tail_length = length - aligned_end
+            keystream = self._ctr_cipher(self._block_count).encrypt(b'\x00' * BLOCK_SIZE)
+            self._block_count += 1
+            out_view[aligned_end:] = _xor(in_view[aligned_end:], keystream[:tail_length])
+            self._keystream = keystream[tail_length:]
+            self._pending = bytes((in_view if decrypting else out_view)[aligned_end:])
+
+        if output is None:
+            return bytes(result)
+        return None
+
+    def _check_mode(self, mode):
+        if self._mode is None:
+            self._mode = mode
+        elif self._mode != mode:
+            raise TypeError('cannot mix encrypt and decrypt')
+
+    def encrypt(self, plaintext, output=None):
+        self._check_mode('encrypt')
+        return self._process(plaintext, output, decrypting=False)
+
+    def decrypt(self, ciphertext, output=None):
+        self._check_mode('decrypt')
+        return self._process(ciphertext, output, decrypting=True)
+
+    def _compute_tag(self):
+        if self._tag is None:
+            if self._pending:
+                self._hash_block(self._pending + b'\x00' * (BLOCK_SIZE - len(self._pending)))
+                self._pending = b''
+            self._hash_block(struct.pack('>QQ', 0, 8 * self._message_length))  # no associated data
+            self._tag = _xor(self._y, self._tag_mask)
+        return self._tag
+
+    def digest(self):
+        self._check_mode('encrypt')
+        return self._compute_tag()
+
+    def verify(self, received_mac_tag):
+        self._check_mode('decrypt')
+        if not hmac.compare_digest(self._compute_tag(), bytes(received_mac_tag)):
+            raise ValueError('MAC check failed')
+
+    def encrypt_and_digest(self, plaintext):
+        return self.encrypt(plaintext), self.digest()
+
+    def decrypt_and_verify(self, ciphertext, received_mac_tag):
+        plaintext = self.decrypt(ciphertext)
+        self.verify(received_mac_tag)
+        return plaintext
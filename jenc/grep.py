@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""grep for directories of .jenc files, plaintext is only ever held in memory.
+
+Files are decrypted across a pool of worker processes and matched line by
+line against a bytes regular expression (or fixed string). Large files are
+decrypted and matched in chunks (bounded memory), matches are only reported
+once the file's auth tag has been verified. Files that share a salt
+(e.g. written by the same jenc.JencSession) are sent to the same worker so
+PBKDF2 runs about once per salt per worker rather than once per file.
+
+Sample code:
+
+    import jenc
+
+    for match in jenc.search(b'TODO', ['my_notes_dir'], 'geheim'):
+        print('%s:%d:%r' % (match.filename, match.line_number, match.line))
+
+Command line:
+
+    python -m jenc grep -i todo my_notes_dir
+    python -m jenc grep -l -F 'milk' my_notes_dir
+
+"""
+
+import collections
+import itertools
+import os
+import re
+import sys
+
+import jenc
+
+
+DEFAULT_STREAM_THRESHOLD = 16 * 1024 * 1024  # in bytes, larger files are decrypted and matched in chunks
+MAX_LINE_LENGTH = 1024 * 1024  # in bytes, longer lines in streamed files are matched in pieces
+MAX_BATCH_SIZE = 64  # files per worker task
+
+SearchMatch = collections.namedtuple('SearchMatch', ('filename', 'line_number', 'line'))
+
+
+def compile_pattern(pattern, fixed_string=False, ignore_case=False):
+    """Returns compiled bytes regex for pattern (string or bytes)"""
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode('utf-8')
+    if fixed_string:
+        pattern = re.escape(pattern)
+    flags = re.MULTILINE
+    if ignore_case:
+        flags |= re.IGNORECASE
+    return re.compile(pattern, flags)
+
+
+def match_lines(regex, data, line_number=1, max_count=None):
+    """Returns list of (line_number, line bytes) for lines in data that match regex,
+    line_number is the number of the first line in data.
+    Each line is matched on its own (like grep, a match never spans a newline),
+    lines exclude the newline.
+    """
+    matches = []
+    data_length = len(data)
+    line_start = 0
+    while line_start < data_length and (max_count is None or len(matches) < max_count):
+        line_end = data.find(b'\n', line_start)
+        if line_end < 0:
+            line_end = data_length
+        if regex.search(data, line_start, line_end) is not None:
+            matches.append((line_number, bytes(data[line_start:line_end])))
+        line_number += 1
+        line_start = line_end + 1
+    return matches
+
+
+def _search_stream(regex, password, in_file, key_cache, max_count, chunk_size):
+    """Match lines while decrypting in chunks, returns list of (line_number, line bytes)
+    only once the auth tag has been verified (raises JencDecryptError otherwise)"""
+    matches = []
+    line_number = 1
+    carry = b''  # partial last line
+    for plaintext_bytes in jenc.decrypt_stream_generator(password, in_file, chunk_size=chunk_size, key_cache=key_cache):
+        if max_count is not None and len(matches) >= max_count:
+            continue  # no more matches needed, but keep decrypting to verify the auth tag
+        data = carry + plaintext_bytes
+        cut = data.rfind(b'\n') + 1
+        if not cut:
+            if len(data) <= MAX_LINE_LENGTH:
+                carry = data
+                continue
+            cut = len(data)
+        remaining = None if max_count is None else max_count - len(matches)
+        matches.extend(match_lines(regex, data[:cut], line_number, remaining))
+        line_number += data.count(b'\n', 0, cut)
+        carry = data[cut:]
+    if carry and (max_count is None or len(matches) < max_count):
+        matches.extend(match_lines(regex, carry, line_number, None if max_count is None else max_count - len(matches)))
+    return matches
+
+
+_worker_state = {}  # per process state for search()
+
+def _search_init(password, regex, max_count, stream_threshold, chunk_size):
+    _worker_state['password'] = password
+    _worker_state['regex'] = regex
+    _worker_state['max_count'] = max_count
+    _worker_state['stream_threshold'] = stream_threshold
+    _worker_state['chunk_size'] = chunk_size
+    _worker_state['key_cache'] = jenc.DerivedKeyCache()
+
+def _search_file(job):
+    """Search one file, returns tuple of;
+    (index, filename, list of (line_number, line bytes), error or None)
+    """
+    index, filename = job
+    state = _worker_state
+    try:
+        in_file = open(filename, 'rb')
+        try:
+            if os.fstat(in_file.fileno()).st_size > state['stream_threshold']:
+                matches = _search_stream(state['regex'], state['password'], in_file, state['key_cache'], state['max_count'], state['chunk_size'])
+            else:
+                plaintext_bytes = jenc.decrypt(state['password'], in_file.read(), key_cache=state['key_cache'])
+                matches = match_lines(state['regex'], plaintext_bytes, 1, state['max_count'])
+        finally:
+            in_file.close()
+    except Exception as info:
+        return index, filename, [], info
+    return index, filename, matches, None
+
+def _search_batch(batch):
+    return [_search_file(job) for job in batch]
+
+
+def _salt_batches(filenames, jobs):
+    """Returns list of batches of (index, filename), files sharing a salt are batched together.
+    Only headers are read, files that can not be read get a batch of their own
+    (the worker reports the error)."""
+    groups = collections.OrderedDict()  # salt (or index) -> list of (index, filename), in order of first appearance
+    for index, filename in enumerate(filenames):
+        group_key = index
+        try:
+            header = jenc.inspect(filename)
+            if header.valid:
+                group_key = (header.jenc_version, bytes(header.salt_bytes))
+        except EnvironmentError:
+            pass
+        groups.setdefault(group_key, []).append((index, filename))
+    batch_size = max(1, min(MAX_BATCH_SIZE, -(-len(filenames) // jobs)))  # keep all workers busy
+    batches = []
+    for group in groups.values():
+        for offset in range(0, len(group), batch_size):
+            batches.append(group[offset:offset + batch_size])
+    return batches
+
+
+def search(pattern, paths, password, fixed_string=False, ignore_case=False, files_with_matches=False, max_count=None,
+        ordered=True, jobs=None, recursive=True, stream_threshold=DEFAULT_STREAM_THRESHOLD, chunk_size=jenc.DEFAULT_CHUNK_SIZE, on_error=None):
+    """Takes in:
+        pattern, regular expression string or bytes (matched against plaintext bytes)
+        paths, list of .jenc filenames and directories (searched for .jenc files)
+        password string
+        fixed_string, match pattern literally rather than as a regex
+        files_with_matches, only the first match per file is reported
+        max_count, stop matching a file after this many matching lines
+        ordered, report files in the order found, False reports as soon as each file is done
+        jobs, number of worker processes (defaults to CPU count)
+        stream_threshold, files larger than this (in bytes) are decrypted and matched in chunks
+        on_error, callback(filename, exception) for files that fail, if None the exception is raised
+    Yields SearchMatch(filename, line_number, line) tuples, line is bytes without the newline.
+    Matches are only reported for files that decrypted and authenticated.
+    Streamed files are matched line by line, patterns spanning lines only match in files below stream_threshold.
+
+    Sample code:
+
+        import jenc
+
+        for match in jenc.search(r'milk|eggs', ['my_notes_dir'], 'geheim', ignore_case=True):
+            print('%s:%d:%r' % match)
+    """
+    import multiprocessing
+    if isinstance(paths, (str, bytes)):
+        paths = [paths]
+    regex = compile_pattern(pattern, fixed_string=fixed_string, ignore_case=ignore_case)
+    if files_with_matches:
+        max_count = 1
+    filenames = jenc.find_files(paths, True, recursive=recursive)
+    jobs = jobs or multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(filenames)))
+    initargs = (password, regex, max_count, stream_threshold, chunk_size)
+    pool = None
+    if jobs == 1:
+        _search_init(*initargs)
+        results = map(_search_file, enumerate(filenames))
+    else:
+        pool = multiprocessing.Pool(processes=jobs, initializer=_search_init, initargs=initargs)
+        results = itertools.chain.from_iterable(pool.imap_unordered(_search_batch, _salt_batches(filenames, jobs)))
+    completed = False
+    try:
+        pending = {}  # index -> result, waiting for earlier files (ordered output)
+        next_index = 0
+        for result in results:
+            if ordered:
+                pending[result[0]] = result
+                ready = []
+                while next_index in pending:
+                    ready.append(pending.pop(next_index))
+                    next_index += 1
+            else:
+                ready = [result]
+            for index, filename, matches, error in ready:
+                if error is not None:
+                    if on_error is None:
+                        raise error
+                    on_error(filename, error)
+                for line_number, line in matches:
+                    yield SearchMatch(filename, line_number, line)
+        completed = True
+    finally:
+        if pool is None:
+            _worker_state['key_cache'].zeroize()
+            _worker_state.clear()
+        elif completed:
+            pool.close()
+            pool.join()
+        else:
+            pool.terminate()  # consumer stopped early (or error), abandon outstanding work
+            pool.join()
+
+
+def main(argv=None):
+    import getpass
+    import optparse
+
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog grep [options] PATTERN [path ...]"
+    parser = optparse.OptionParser(
+        usage=usage,
+        version="%prog " + jenc.__version__,
+        description="Search .jenc files (directories are searched recursively, defaults to current directory) for lines matching PATTERN, a Python regular expression. Output is filename:line_number:line"
+    )
+    parser.add_option("-E", "--envvar", help="Name of environment variable to get password from (defaults to JENC_PASSWORD) - unsafe", default="JENC_PASSWORD")
+    parser.add_option("-p", "--password", help="password, if omitted but OS env JENC_PASSWORD is set use that, if missing prompt - unsafe")
+    parser.add_option("-P", "--password_file", help="file name where password is to be read from, trailing blanks are ignored")
+    parser.add_option("-i", "--ignore-case", "--ignore_case", help="case insensitive match", action="store_true")
+    parser.add_option("-F", "--fixed-strings", "--fixed_strings", help="PATTERN is a literal string, not a regular expression", action="store_true")
+    parser.add_option("-l", "--files-with-matches", "--files_with_matches", help="only print names of files with a match", action="store_true")
+    parser.add_option("-m", "--max-count", "--max_count", help="stop matching a file after NUM matching lines", type="int", metavar="NUM")
+    parser.add_option("--jobs", help="number of worker processes (defaults to CPU count)", type="int")
+    parser.add_option("--unordered", help="print results as each file completes rather than in file name order", action="store_true")
+    parser.add_option("--stream-threshold", "--stream_threshold", help="files larger than this many bytes are decrypted and matched in chunks (defaults to %default)", type="int", default=DEFAULT_STREAM_THRESHOLD)
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not args:
+        parser.print_usage()
+        return 2
+    pattern, paths = args[0], args[1:] or [os.curdir]
+    password = jenc._resolve_password(options.password, options.password_file, options.envvar) or getpass.getpass("Password:")
+
+    out_file = getattr(sys.stdout, 'buffer', sys.stdout)  # py3, matched lines are bytes
+    fsencode = getattr(os, 'fsencode', lambda filename: filename)  # py2 filenames are already bytes
+    errors = []
+
+    def on_error(filename, error):
+        errors.append(filename)
+        sys.stderr.write('%s: %r\n' % (filename, error))
+
+    match_count = 0
+    for match in search(pattern, paths, password, fixed_string=options.fixed_strings, ignore_case=options.ignore_case,
+            files_with_matches=options.files_with_matches, max_count=options.max_count, ordered=not options.unordered,
+            jobs=options.jobs, stream_threshold=options.stream_threshold, on_error=on_error):
+        match_count += 1
+        if options.files_with_matches:
+            out_file.write(fsencode(match.filename) + b'\n')
+        else:
+            out_file.write(b'%s:%d:%s\n' % (fsencode(match.filename), match.line_number, match.line))
+    out_file.flush()
+    if errors:
+        return 2
+    if match_count:
+        return 0
+    return 1
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Persistent full-text index for a directory of .jenc files.
+
+Inverted index of term -> postings (file, byte offset of the first
+occurrence in that file), itself stored encrypted with the same password
+in jenc format (in root/.jenc_index by default, no .jenc extension so
+that tools working on notes ignore it).
+
+The index keeps a manifest of (path, mtime, size, header salt, header nonce)
+for every indexed file, update() only decrypts and tokenizes files whose
+mtime, size or header salt/nonce changed (the header is re-read, not
+decrypted; it changes on every re-encryption, even with the same size and
+mtime), drops deleted files and adds new ones. Queries are answered
+from memory; postings are flat array('I') of (file id, offset) pairs.
+
+Terms are runs of ASCII letters, digits, underscore and non-ASCII bytes
+(i.e. UTF-8 encoded letters), ASCII case-insensitive.
+
+Sample code:
+
+    import jenc.index
+
+    index = jenc.index.JencIndex('my_notes_dir', 'geheim')
+    index.update()  # only changed files are decrypted
+    index.save()
+    print(index.search('milk eggs'))  # paths containing both terms
+    print(index.lookup('milk'))  # [(path, offset), ...]
+
+"""
+
+import array
+import json
+import os
+import re
+import sys
+
+import jenc
+
+
+INDEX_FILENAME = '.jenc_index'  # default index file, created in root
+INDEX_FORMAT = 1
+MAX_TERM_LENGTH = 64  # in bytes, longer terms are truncated
+MAX_OFFSET = 0xffffffff  # offsets are stored as unsigned 32-bit, larger offsets are clamped
+
+_term_regex = re.compile(br'(?:[0-9A-Za-z_]|[\x80-\xff])+')
+
+
+def tokenize(plaintext_bytes):
+    """Returns dict of term bytes (lower case) -> offset of first occurrence"""
+    terms = {}
+    for match in _term_regex.finditer(plaintext_bytes):
+        term = match.group().lower()[:MAX_TERM_LENGTH]
+        if term not in terms:
+            terms[term] = match.start()
+    return terms
+
+
+def _query_terms(query):
+    if not isinstance(query, bytes):
+        query = query.encode('utf-8')
+    return list(tokenize(query))
+
+
+def _array_to_bytes(postings):
+    if sys.byteorder != 'little':
+        postings = array.array('I', postings)
+        postings.byteswap()
+    return postings.tobytes()
+
+
+def _array_from_bytes(data):
+    postings = array.array('I')
+    postings.frombytes(data)
+    if sys.byteorder != 'little':
+        postings.byteswap()
+    return postings
+
+
+_worker_state = {}  # per process state for JencIndex.update()
+
+def _index_init(password):
+    _worker_state['password'] = password
+    _worker_state['key_cache'] = jenc.DerivedKeyCache()
+
+def _header_signature(header):
+    """Returns manifest [salt hex, nonce hex] for a JencHeader"""
+    return [bytes(header.salt_bytes).hex(), bytes(header.nonce_bytes).hex()]
+
+def _index_file(job):
+    """Decrypt and tokenize one file, returns tuple of;
+    (path, manifest entry, dict of terms or None on error, error or None)
+    """
+    path, filename = job
+    try:
+        f = open(filename, 'rb')
+        try:
+            stat_result = os.fstat(f.fileno())  # of the bytes actually read
+            encrypt_bytes = f.read()
+        finally:
+            f.close()
+        header = jenc.inspect(encrypt_bytes)
+        plaintext_bytes = jenc.decrypt(_worker_state['password'], encrypt_bytes, key_cache=_worker_state['key_cache'])
+    except Exception as info:
+        return path, None, None, info
+    entry = [path, getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime), stat_result.st_size] + _header_signature(header)
+    return path, entry, tokenize(plaintext_bytes), None
+
+
+class JencIndex(object):
+    """Inverted index for the .jenc files under root.
+    Paths are relative to root without the .jenc extension, using / as separator.
+    An existing index file is loaded (raises JencDecryptError if password does not match),
+    rebuild=True ignores it.
+    """
+
+    def __init__(self, root, password, index_filename=None, rebuild=False):
+        self.root = os.path.abspath(root)
+        self.password = password
+        self.index_filename = index_filename or os.path.join(self.root, INDEX_FILENAME)
+        self._files = []  # file id -> manifest entry [path, mtime, size, salt hex, nonce hex], None once removed
+        self._file_ids = {}  # path -> file id
+        self._postings = {}  # term bytes -> array('I') of file id, offset pairs
+        self._removed_count = 0
+        self.modified = False  # unsaved changes
+        self.errors = []  # (path, exception) for files that could not be indexed by the last update()
+        if not rebuild and os.path.exists(self.index_filename):
+            self.load()
+
+    def _path(self, filename):
+        relative_path = os.path.relpath(filename, self.root)[:-len(jenc.JENC_FILENAME_EXTENSION)]
+        return relative_path.replace(os.sep, '/')
+
+    def load(self):
+        f = open(self.index_filename, 'rb')
+        try:
+            index_bytes = jenc.decrypt(self.password, f.read())
+        finally:
+            f.close()
+        self._loads(index_bytes)
+
+    def _loads(self, index_bytes):
+        header_end = index_bytes.index(b'\n')
+        header = json.loads(index_bytes[:header_end].decode('utf-8'))
+        if header.get('format') != INDEX_FORMAT:
+            raise jenc.UnsupportedMetaData('index format %r' % header.get('format'))
+        offset = header_end + 1
+        terms = index_bytes[offset:offset + header['terms_length']].split(b'\n')
+        offset += header['terms_length']
+        counts = _array_from_bytes(index_bytes[offset:offset + 4 * header['term_count']])
+        offset += 4 * header['term_count']
+        postings = {}
+        if header['term_count']:
+            for term, count in zip(terms, counts):
+                postings[term] = _array_from_bytes(index_bytes[offset:offset + 8 * count])
+                offset += 8 * count
+        self._files = header['files']
+        self._file_ids = dict((entry[0], file_id) for file_id, entry in enumerate(self._files))
+        self._postings = postings
+        self._removed_count = 0
+        self.modified = False
+
+    def _dumps(self):
+        self.compact()
+        terms = sorted(self._postings)
+        terms_bytes = b'\n'.join(terms)
+        header = {
+            'format': INDEX_FORMAT,
+            'files': self._files,
+            'term_count': len(terms),
+            'terms_length': len(terms_bytes),
+        }
+        counts = array.array('I', [len(self._postings[term]) // 2 for term in terms])
+        chunks = [json.dumps(header, sort_keys=True).encode('utf-8'), b'\n', terms_bytes, _array_to_bytes(counts)]
+        chunks.extend(_array_to_bytes(self._postings[term]) for term in terms)
+        return b''.join(chunks)
+
+    def save(self, jenc_version=None):
+        """Write index (encrypted) atomically"""
+        out_file = jenc.AtomicFileWriter(self.index_filename)
+        try:
+            jenc.encrypt_file_handle(out_file, self.password, self._dumps(), jenc_version=jenc_version)
+        except:
+            out_file.abort()
+            raise
+        out_file.commit()
+        self.modified = False
+
+    def _add(self, entry, terms):
+        file_id = len(self._files)
+        self._files.append(entry)
+        self._file_ids[entry[0]] = file_id
+        for term, offset in terms.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array.array('I')
+            postings.append(file_id)
+            postings.append(min(offset, MAX_OFFSET))
+        self.modified = True
+
+    def _remove(self, path):
+        file_id = self._file_ids.pop(path)
+        self._files[file_id] = None  # postings are dropped by compact()
+        self._removed_count += 1
+        self.modified = True
+
+    def compact(self):
+        """Drop postings of removed files and renumber file ids"""
+        if not self._removed_count:
+            return
+        new_ids = {}
+        files = []
+        for file_id, entry in enumerate(self._files):
+            if entry is not None:
+                new_ids[file_id] = len(files)
+                files.append(entry)
+        postings_by_term = {}
+        for term, postings in self._postings.items():
+            new_postings = array.array('I')
+            for position in range(0, len(postings), 2):
+                new_id = new_ids.get(postings[position])
+                if new_id is not None:
+                    new_postings.append(new_id)
+                    new_postings.append(postings[position + 1])
+            if new_postings:
+                postings_by_term[term] = new_postings
+        self._files = files
+        self._file_ids = dict((entry[0], file_id) for file_id, entry in enumerate(files))
+        self._postings = postings_by_term
+        self._removed_count = 0
+
+    def update(self, jobs=1):
+        """Bring index up to date with the .jenc files under root, only new and changed files
+        (mtime, size or header salt/nonce differ from the manifest) are decrypted, across `jobs` worker processes.
+        Files that fail to decrypt are left out of the index and listed in self.errors.
+        Returns number of files (re)indexed or removed.
+        """
+        import multiprocessing
+        current = {}  # path -> filename
+        work = []
+        for filename in jenc.find_files([self.root], True, recursive=True):
+            path = self._path(filename)
+            current[path] = filename
+            file_id = self._file_ids.get(path)
+            if file_id is not None:
+                entry = self._files[file_id]
+                try:
+                    stat_result = os.stat(filename)
+                except EnvironmentError:
+                    continue  # deleted since listed, removed below next time
+                if [getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime), stat_result.st_size] == entry[1:3]:
+                    try:
+                        header = jenc.inspect(filename)  # rewritten within mtime granularity, or mtime restored by sync
+                    except EnvironmentError:
+                        continue
+                    if header.valid and _header_signature(header)[:len(entry) - 3] == entry[3:]:  # older manifests have no nonce
+                        continue
+            work.append((path, filename))
+        change_count = 0
+        for path in [path for path in self._file_ids if path not in current]:
+            self._remove(path)
+            change_count += 1
+
+        def salt_order(job):
+            file_id = self._file_ids.get(job[0])
+            return file_id is not None and self._files[file_id][3] or ''
+        work.sort(key=salt_order)  # files that shared a salt are likely to still share it, keep them on one worker
+
+        self.errors = []
+        jobs = max(1, min(jobs or multiprocessing.cpu_count(), len(work)))
+        pool = None
+        if jobs == 1:
+            _index_init(self.password)
+            results = map(_index_file, work)
+        else:
+            pool = multiprocessing.Pool(processes=jobs, initializer=_index_init, initargs=(self.password,))
+            results = pool.imap_unordered(_index_file, work, chunksize=max(1, min(64, len(work) // (4 * jobs))))
+        try:
+            for path, entry, terms, error in results:
+                if path in self._file_ids:
+                    self._remove(path)
+                change_count += 1
+                if error is not None:
+                    self.errors.append((path, error))
+                    continue
+                self._add(entry, terms)
+        finally:
+            if pool is None:
+                _worker_state['key_cache'].zeroize()
+                _worker_state.clear()
+            else:
+                pool.close()
+                pool.join()
+        if self._removed_count > len(self._file_ids):
+            self.compact()
+        return change_count
+
+    def lookup(self, term):
+        """Returns list of (path, offset of first occurrence) for files containing term"""
+        terms = _query_terms(term)
+        if len(terms) != 1:
+            return []
+        postings = self._postings.get(terms[0], ())
+        result = []
+        for position in range(0, len(postings), 2):
+            entry = self._files[postings[position]]
+            if entry is not None:
+                result.append((entry[0], postings[position + 1]))
+        return result
+
+    def _file_id_set(self, term):
+        postings = self._postings.get(term)
+        if postings is None:
+            return set()
+        return set(file_id for file_id in postings[::2] if self._files[file_id] is not None)
+
+    def search(self, query, match_all=True):
+        """Returns sorted list of paths containing all (match_all=False for any) of the terms in query"""
+        result = None
+        for term in _query_terms(query):
+            file_ids = self._file_id_set(term)
+            if result is None:
+                result = file_ids
+            elif match_all:
+                result &= file_ids
+            else:
+                result |= file_ids
+        return sorted(self._files[file_id][0] for file_id in result or ())
+
+    def paths(self):
+        return sorted(self._file_ids)
+
+    def __len__(self):
+        return len(self._file_ids)
+
+    def __contains__(self, path):
+        return path in self._file_ids
+
+    def stats(self):
+        return {
+            'files': len(self._file_ids),
+            'terms': len(self._postings),
+            'postings': sum(len(postings) for postings in self._postings.values()) // 2,
+            'removed': self._removed_count,
+        }
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Per-phase timing and metrics for jenc operations.
+
+Every encrypt/decrypt/*_file_handle/*_stream call records time spent in each
+phase (read, parse, kdf, cipher, verify, write), byte counts and jenc
+version. Nothing is recorded (and overhead is a couple of attribute
+lookups) unless a hook is registered or cumulative metrics are enabled.
+
+Sample code:
+
+    import jenc
+    import jenc.metrics
+
+    def show(stats):
+        print(stats.as_dict())
+
+    jenc.metrics.add_hook(show)  # called after each operation
+    collector = jenc.metrics.enable_metrics()  # cumulative counters
+    jenc.decrypt('geheim', jenc.encrypt('geheim', b'Hello World'))
+    print(collector.to_json())
+    print(collector.to_prometheus())
+
+"""
+
+import threading
+import time
+
+
+PHASES = ('read', 'parse', 'kdf', 'cipher', 'verify', 'write')
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time  # py2
+
+_hooks = []  # callables, called with OperationStats
+collector = None  # MetricsCollector when enabled
+_enabled = False  # fast check, True if hooks or collector
+_local = threading.local()
+
+
+class OperationStats(object):
+    """Timings and counts for one jenc operation, passed to hooks"""
+    __slots__ = ('operation', 'jenc_version', 'phases', 'bytes_in', 'bytes_out', 'duration', 'error', '_start_time', '_lap_time')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.jenc_version = None
+        self.phases = {}  # phase name -> seconds
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.duration = None
+        self.error = None
+        self._start_time = self._lap_time = timer()
+
+    def lap(self, phase):
+        """Attribute time since previous lap (or start) to phase"""
+        now = timer()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._lap_time)
+        self._lap_time = now
+
+    def skip(self):
+        """Do not attribute time since previous lap to any phase"""
+        self._lap_time = timer()
+
+    def set_version(self, jenc_version):
+        self.jenc_version = jenc_version
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+
+    def set_error(self, error):
+        """Mark operation as failed, for errors that are handled rather than raised"""
+        self.error = repr(error)
+
+    def finish(self, error=None):
+        self.duration = timer() - self._start_time
+        if error is not None:
+            self.set_error(error)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__ if not name.startswith('_'))
+
+
+class _NullOperation(object):
+    """Used when metrics are disabled, all methods are no-ops"""
+    def lap(self, phase):
+        pass
+
+    def skip(self):
+        pass
+
+    def set_version(self, jenc_version):
+        pass
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        pass
+
+    def set_error(self, error):
+        pass
+
+_null_operation = _NullOperation()
+
+
+def current():
+    """Returns OperationStats for the operation in progress in this thread (no-op object if metrics disabled)"""
+    if not _enabled:
+        return _null_operation
+    return getattr(_local, 'operation', None) or _null_operation
+
+
+def _start(operation_name):
+    """Returns (OperationStats, True) for a new top level operation, or (existing OperationStats, False) if nested"""
+    existing = getattr(_local, 'operation', None)
+    if existing is not None:
+        return existing, False
+    operation = _local.operation = OperationStats(operation_name)
+    return operation, True
+
+
+def _finish(operation, error=None):
+    _local.operation = None
+    operation.finish(error)
+    if collector is not None:
+        collector.record(operation)
+    for hook in list(_hooks):
+        hook(operation)
+
+
+class operation(object):
+    """Context manager to record an operation, nested jenc calls add to it.
+
+        with jenc.metrics.operation('my_import') as stats:
+            data = f.read()
+            stats.lap('read')
+            jenc.encrypt(password, data)
+    """
+    def __init__(self, operation_name):
+        self.operation_name = operation_name
+        self.stats = _null_operation
+        self.top_level = False
+
+    def __enter__(self):
+        if _enabled:
+            self.stats, self.top_level = _start(self.operation_name)
+        return self.stats
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.top_level:
+            _finish(self.stats, exc_value)
+
+
+def instrumented(operation_name):
+    """Decorator, record calls to function as operation_name"""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            stats, top_level = _start(operation_name)
+            if not top_level:
+                return function(*args, **kwargs)
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as info:
+                _finish(stats, info)
+                raise
+            _finish(stats)
+            return result
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+    return decorator
+
+
+def instrumented_generator(operation_name):
+    """Decorator for generator functions, operation covers the whole iteration"""
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not _enabled or getattr(_local, 'operation', None) is not None:
+                # disabled, or nested in an instrumented call that will be consuming this generator
+                for item in function(*args, **kwargs):
+                    yield item
+                return
+            stats = OperationStats(operation_name)
+            generator = function(*args, **kwargs)
+            try:
+                while True:
+                    previous = getattr(_local, 'operation', None)
+                    _local.operation = stats  # generator may be resumed from other code, set per step
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        break
+                    finally:
+                        _local.operation = previous
+                    stats.skip()  # time spent by consumer is not ours
+                    yield item
+            except BaseException as info:
+                stats.finish(info)
+                _record(stats)
+                raise
+            stats.finish()
+            _record(stats)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+    return decorator
+
+
+def _record(stats):
+    if collector is not None:
+        collector.record(stats)
+    for hook in list(_hooks):
+        hook(stats)
+
+
+def _update_enabled():
+    global _enabled
+    _enabled = bool(_hooks) or collector is not None
+
+
+def add_hook(callback):
+    """Register callback(OperationStats), called after every jenc operation (in the calling thread)"""
+    _hooks.append(callback)
+    _update_enabled()
+
+
+def remove_hook(callback):
+    _hooks.remove(callback)
+    _update_enabled()
+
+
+class MetricsCollector(object):
+    """Cumulative counters, per (operation, jenc_version)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # (operation, jenc_version) -> dict
+
+    def record(self, stats):
+        key = (stats.operation, stats.jenc_version or '')
+        with self._lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = {'count': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0, 'phase_seconds': {}}
+            counter['count'] += 1
+            if stats.error is not None:
+                counter['errors'] += 1
+            counter['bytes_in'] += stats.bytes_in
+            counter['bytes_out'] += stats.bytes_out
+            counter['seconds'] += stats.duration or 0.0
+            for phase, seconds in stats.phases.items():
+                counter['phase_seconds'][phase] = counter['phase_seconds'].get(phase, 0.0) + seconds
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+
+    def as_dict(self):
+        """Returns JSON serializable copy of counters"""
+        with self._lock:
+            result = []
+            for (operation_name, jenc_version), counter in sorted(self.counters.items()):
+                entry = {'operation': operation_name, 'jenc_version': jenc_version}
+                entry.update(counter)
+                entry['phase_seconds'] = dict(counter['phase_seconds'])
+                result.append(entry)
+        return {'operations': result}
+
+    def to_json(self, indent=None):
+        import json
+        return json.dumps(self.as_dict(), indent=indent, sort_keys=True)
+
+    def to_prometheus(self):
+        """Returns counters in Prometheus text exposition format"""
+        lines = []
+        metrics = (
+            ('jenc_operations_total', 'Number of jenc operations', 'count'),
+            ('jenc_operation_errors_total', 'Number of failed jenc operations', 'errors'),
+            ('jenc_bytes_in_total', 'Bytes consumed by jenc operations', 'bytes_in'),
+            ('jenc_bytes_out_total', 'Bytes produced by jenc operations', 'bytes_out'),
+            ('jenc_operation_seconds_total', 'Time spent in jenc operations', 'seconds'),
+        )
+        operations = self.as_dict()['operations']
+        for metric_name, help_text, field in metrics:
+            lines.append('# HELP %s %s' % (metric_name, help_text))
+            lines.append('# TYPE %s counter' % metric_name)
+            for entry in operations:
+                lines.append('%s{operation="%s",jenc_version="%s"} %s' % (metric_name, entry['operation'], entry['jenc_version'], entry[field]))
+        metric_name = 'jenc_phase_seconds_total'
+        lines.append('# HELP %s Time spent in each phase (read, parse, kdf, cipher, verify, write) of jenc operations' % metric_name)
+        lines.append('# TYPE %s counter' % metric_name)
+        for entry in operations:
+            for phase, seconds in sorted(entry['phase_seconds'].items()):
+                lines.append('%s{operation="%s",jenc_version="%s",phase="%s"} %s' % (metric_name, entry['operation'], entry['jenc_version'], phase, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def phase_report(self):
+        """Returns human readable per-phase breakdown"""
+        lines = []
+        for entry in self.as_dict()['operations']:
+            lines.append('%s %s: %d ops, %d errors, %d bytes in, %d bytes out, %f secs' % (entry['operation'], entry['jenc_version'], entry['count'], entry['errors'], entry['bytes_in'], entry['bytes_out'], entry['seconds']))
+            for phase in PHASES:
+                if phase in entry['phase_seconds']:
+                    seconds = entry['phase_seconds'][phase]
+                    lines.append('    %-7s %f secs %5.1f%%' % (phase, seconds, 100.0 * seconds / (entry['seconds'] or 1e-9)))
+        return '\n'.join(lines) + '\n'
+
+
+def enable_metrics():
+    """Enable cumulative metrics, returns MetricsCollector"""
+    global collector
+    if collector is None:
+        collector = MetricsCollector()
+    _update_enabled()
+    return collector
+
+
+def disable_metrics():
+    global collector
+    collector = None
+    _update_enabled()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Pipelined encrypt/decrypt between file objects (e.g. stdin/stdout).
+
+A reader thread, the cipher stage (calling thread) and a writer thread are
+connected by bounded queues (queue_depth chunks each, i.e. double buffered
+by default) so reading, AES-GCM and writing overlap. Memory use is bounded by
+about 2 * queue_depth * chunk_size, except for decrypt with RELEASE_VERIFY.
+
+  * encrypt - the header is written immediately, then each chunk as soon as it has been read
+  * decrypt, release policy:
+      * RELEASE_VERIFY - plaintext is held in memory and only written once the auth tag has been verified,
+        nothing is written for corrupt/tampered input (default)
+      * RELEASE_STREAM - plaintext is written as it is decrypted, it is NOT authenticated until
+        the call returns without raising JencDecryptError; consumers must discard output on error
+
+Sample code:
+
+    import sys
+    import jenc.pipeline
+
+    jenc.pipeline.encrypt('geheim', sys.stdin.buffer, sys.stdout.buffer, chunk_size=1024 * 1024)
+
+Command line:
+
+    cat big.md | python -m jenc -e -p geheim --pipeline --chunk-size 1M - | ssh host 'cat > big.md.jenc'
+
+"""
+
+import collections
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # py2
+
+import jenc
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # in bytes
+DEFAULT_QUEUE_DEPTH = 2  # chunks buffered between stages
+
+RELEASE_VERIFY = 'verify'
+RELEASE_STREAM = 'stream'
+RELEASE_POLICIES = (RELEASE_VERIFY, RELEASE_STREAM)
+
+_EOF = None
+
+
+class _ReaderThread(threading.Thread):
+    """Reads chunks from in_file into a bounded queue, _EOF (or the exception raised) last"""
+
+    def __init__(self, in_file, chunk_size, queue_depth):
+        threading.Thread.__init__(self, name='jenc-pipeline-reader')
+        self.daemon = True  # do not hang on a blocked stdin read after an error
+        self.in_file = in_file
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.stopped = False
+
+    def run(self):
+        read = getattr(self.in_file, 'read1', self.in_file.read)  # read1 returns what is available, e.g. from a pipe
+        try:
+            while not self.stopped:
+                data = read(self.chunk_size)
+                if not data:
+                    break
+                self._put(data)
+            self._put(_EOF)
+        except Exception as info:
+            self._put(info)
+
+    def _put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass  # check stopped, consumer may have gone away
+
+
+class _ChunkReader(object):
+    """File-like read() over the reader thread queue.
+    exact=False returns each chunk as read (short reads), exact=True returns size bytes unless at EOF.
+    Chunks are kept as queued (deque plus offset into the first), read() only copies the bytes it returns"""
+
+    def __init__(self, reader_thread, exact=False):
+        self.reader_thread = reader_thread
+        self.exact = exact
+        self.chunks = collections.deque()
+        self.offset = 0  # into self.chunks[0]
+        self.length = 0  # buffered bytes not yet returned
+        self.eof = False
+
+    def _next(self):
+        item = self.reader_thread.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if item is _EOF:
+            self.eof = True
+            return False
+        if item:
+            self.chunks.append(item)
+            self.length += len(item)
+        return True
+
+    def read(self, size=-1):
+        while not self.eof and (not self.length or (self.exact and (size < 0 or self.length < size))):
+            self._next()
+        if size < 0 or size > self.length:
+            size = self.length
+        if size == 0:
+            return b''
+        first_chunk = self.chunks[0]
+        if self.offset == 0 and len(first_chunk) == size:
+            self.chunks.popleft()  # common case, whole chunk as read, no copy
+            self.length -= size
+            return first_chunk
+        pieces = []
+        remaining = size
+        while remaining:
+            chunk = self.chunks[0]
+            end = self.offset + remaining
+            if end >= len(chunk):
+                pieces.append(chunk[self.offset:])
+                remaining -= len(chunk) - self.offset
+                self.chunks.popleft()
+                self.offset = 0
+            else:
+                pieces.append(chunk[self.offset:end])
+                self.offset = end
+                remaining = 0
+        self.length -= size
+        return b''.join(pieces)
+
+
+class _WriterThread(threading.Thread):
+    """Writes chunks from a bounded queue to out_file, flushing each so output is visible immediately"""
+
+    def __init__(self, out_file, queue_depth):
+        threading.Thread.__init__(self, name='jenc-pipeline-writer')
+        self.daemon = True
+        self.out_file = out_file
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.error = None
+        self.aborted = False
+        self.byte_count = 0
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is _EOF:
+                break
+            if self.error is not None or self.aborted:
+                continue  # drain, so the cipher stage does not block
+            try:
+                self.out_file.write(data)
+                self.out_file.flush()
+                self.byte_count += len(data)
+            except Exception as info:
+                self.error = info
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def abort(self):
+        """Discard anything still queued"""
+        self.aborted = True
+        self.queue.put(_EOF)
+
+    def close(self):
+        """Wait for queued data to be written, raises write errors"""
+        self.queue.put(_EOF)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _run(function, in_file, out_file, chunk_size, queue_depth, exact):
+    reader_thread = _ReaderThread(in_file, chunk_size, queue_depth)
+    writer_thread = _WriterThread(out_file, queue_depth)
+    reader_thread.start()
+    writer_thread.start()
+    try:
+        function(_ChunkReader(reader_thread, exact=exact), writer_thread)
+    except:
+        reader_thread.stopped = True
+        writer_thread.abort()
+        raise
+    writer_thread.close()
+    return writer_thread.byte_count
+
+
+def encrypt(password, in_file, out_file, jenc_version=None, chunk_size=DEFAULT_CHUNK_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """Takes in:
+        password string
+        in_file, file-like object to read plaintext bytes from, until EOF
+        out_file, file-like object to write encrypted bytes to
+        version (string)
+        chunk_size, number of bytes to read at a time
+    Returns number of bytes written. Output is the same format as jenc.encrypt()
+    """
+    def cipher_stage(chunk_reader, writer):
+        for encrypted_bytes in jenc.encrypt_stream_generator(password, chunk_reader, jenc_version=jenc_version, chunk_size=chunk_size):
+            writer.write(encrypted_bytes)
+    return _run(cipher_stage, in_file, out_file, chunk_size, queue_depth, exact=False)
+
+
+def decrypt(password, in_file, out_file, release=RELEASE_VERIFY, chunk_size=DEFAULT_CHUNK_SIZE, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """Takes in:
+        password string
+        in_file, file-like object to read encrypted bytes from, until EOF
+        out_file, file-like object to write plaintext bytes to
+        release, RELEASE_VERIFY or RELEASE_STREAM, see module docs
+        chunk_size, number of bytes to read at a time
+    Returns number of bytes written.
+    Raises JencDecryptError if the auth tag does not verify.
+    """
+    if release not in RELEASE_POLICIES:
+        raise ValueError('release %r not one of %r' % (release, RELEASE_POLICIES))
+
+    def cipher_stage(chunk_reader, writer):
+        held_chunks = []
+        for plaintext_bytes in jenc.decrypt_stream_generator(password, chunk_reader, chunk_size=chunk_size):
+            if release == RELEASE_STREAM:
+                writer.write(plaintext_bytes)
+            else:
+                held_chunks.append(plaintext_bytes)
+        for plaintext_bytes in held_chunks:  # auth tag verified
+            writer.write(plaintext_bytes)
+    return _run(cipher_stage, in_file, out_file, chunk_size, queue_depth, exact=True)
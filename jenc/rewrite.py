@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Bulk re-key (password rotation) and version migration of .jenc files.
+
+Each file is streamed through decrypt and re-encrypt (constant memory) into
+a temporary file that replaces the original only after the old auth tag
+has been verified, see jenc.AtomicFileWriter.
+New keys come from a jenc.JencSession so the KDF runs once per session
+rather than once per file, old keys are looked up in a derived key cache
+(files written by a JencSession share salts).
+
+  * migrate only - files already at the target version are skipped by reading the header, no password work
+  * rekey - progress is recorded in a checkpoint journal so an interrupted run can be resumed,
+    files that already decrypt with the new password are skipped
+
+Sample code:
+
+    import jenc.rewrite
+
+    with jenc.rewrite.Rewriter('old password', new_password='new password', jenc_version='V001') as rewriter:
+        rewriter.rewrite_file('notes.md.jenc')
+
+Command line:
+
+    python -m jenc --migrate-to V001 -r DIR
+    python -m jenc --rekey -r DIR
+
+"""
+
+import json
+import os
+import sys
+import time
+
+import jenc
+from jenc import metrics
+
+
+JOURNAL_FILENAME = '.jenc_rewrite_journal'  # default journal, created in the directory being rewritten
+
+REWRITTEN = 'rewritten'
+SKIPPED = 'skipped'
+
+
+class Rewriter(object):
+    """Re-encrypt .jenc files in place with a new password and/or jenc version.
+    new_password None keeps the current password, jenc_version None keeps each file's version.
+    """
+
+    def __init__(self, password, new_password=None, jenc_version=None, chunk_size=jenc.DEFAULT_CHUNK_SIZE):
+        if jenc_version is not None:
+            jenc.jenc_version_check(jenc_version)
+        self.password = password
+        self.new_password = new_password
+        self.jenc_version = jenc_version
+        self.chunk_size = chunk_size
+        self.key_cache = jenc.DerivedKeyCache()
+        self.sessions = {}  # jenc_version -> JencSession
+
+    def needs_rewrite(self, header):
+        """Returns False if file with (valid) jenc.JencHeader is already in the target state, header only check"""
+        if self.new_password is not None:
+            return True  # password can not be checked from the header, see rewrite_file() and Journal
+        return self.jenc_version is not None and header.jenc_version != self.jenc_version
+
+    def _session(self, jenc_version):
+        session = self.sessions.get(jenc_version)
+        if session is None:
+            session = self.sessions[jenc_version] = jenc.JencSession(self.new_password or self.password, jenc_version=jenc_version)
+        return session
+
+    def _decrypt_chunks(self, password, in_file):
+        return jenc.decrypt_stream_generator(password, in_file, chunk_size=self.chunk_size, key_cache=self.key_cache)
+
+    def _decrypts_with(self, password, filename):
+        in_file = open(filename, 'rb')
+        try:
+            for plaintext_bytes in self._decrypt_chunks(password, in_file):
+                pass
+        except jenc.JencDecryptError:
+            return False
+        finally:
+            in_file.close()
+        return True
+
+    @metrics.instrumented('rewrite')
+    def rewrite_file(self, filename):
+        """Re-encrypt filename in place, returns REWRITTEN or SKIPPED (already in target state).
+        Raises JencDecryptError if filename does not decrypt with the old password (nor the new one)"""
+        header = jenc.inspect(filename)
+        if not header.valid:
+            raise jenc.JencDecryptError('%s %r' % (header.error, filename))
+        if not self.needs_rewrite(header):
+            return SKIPPED
+        session = self._session(self.jenc_version or header.jenc_version)
+
+        in_file = open(filename, 'rb')
+        out_file = jenc.AtomicFileWriter(filename)
+        try:
+            try:
+                session.encrypt_chunks(self._decrypt_chunks(self.password, in_file), out_file)
+            finally:
+                in_file.close()  # before rename, Windows can not replace an open file
+            out_file.commit()
+        except jenc.JencDecryptError:
+            out_file.abort()
+            # an interrupted rekey run may have replaced the file without recording it in the journal
+            if self.new_password is not None and self.jenc_version in (None, header.jenc_version) and self._decrypts_with(self.new_password, filename):
+                return SKIPPED
+            raise
+        except:
+            out_file.abort()
+            raise
+        return REWRITTEN
+
+    def close(self):
+        """Zeroize derived keys"""
+        for session in self.sessions.values():
+            session.close()
+        self.key_cache.zeroize()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Journal(object):
+    """Checkpoint journal, records files that have been completed by a rewrite run.
+    One JSON encoded absolute filename per line, the first line describes the run;
+    an existing journal for a different kind of run (e.g. other target version) is ignored.
+    """
+
+    def __init__(self, filename, description):
+        self.filename = filename
+        self.completed = set()
+        header = json.dumps({'jenc_rewrite_journal': description}, sort_keys=True)
+        lines = []
+        if os.path.exists(filename):
+            f = open(filename, 'r')
+            lines = f.read().split('\n')
+            f.close()
+        if lines and lines[0] == header:
+            for line in lines[1:]:
+                try:
+                    self.completed.add(json.loads(line))
+                except ValueError:
+                    pass  # empty or partial last line from an interrupted run
+            self.file = open(filename, 'a')
+            if lines[-1]:
+                self.file.write('\n')  # terminate partial line
+        else:
+            self.file = open(filename, 'w')
+            self.file.write(header + '\n')
+        self._flush()
+
+    def _flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def is_completed(self, filename):
+        return os.path.abspath(filename) in self.completed
+
+    def record(self, filename):
+        filename = os.path.abspath(filename)
+        self.completed.add(filename)
+        self.file.write(json.dumps(filename) + '\n')
+        self._flush()
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        """Close and delete journal, run is complete"""
+        self.close()
+        os.remove(self.filename)
+
+
+_worker_state = {}  # per process state for rewrite_files()
+
+def _rewrite_files_init(password, new_password, jenc_version, collect_metrics=False):
+    _worker_state['rewriter'] = Rewriter(password, new_password=new_password, jenc_version=jenc_version)
+    if collect_metrics:
+        metrics.enable_metrics()
+
+def _rewrite_file(filename):
+    """Rewrite one file for rewrite_files(), returns tuple of;
+    (filename, REWRITTEN/SKIPPED or None on error, error or None, number of bytes, metrics.OperationStats or None)
+    """
+    with metrics.operation('rewrite') as stats:
+        try:
+            status = _worker_state['rewriter'].rewrite_file(filename)
+            error = None
+        except Exception as info:
+            status, error = None, info
+            stats.set_error(info)
+    if not isinstance(stats, metrics.OperationStats):
+        stats = None
+    byte_count = 0
+    if status == REWRITTEN:
+        byte_count = os.path.getsize(filename)
+    return filename, status, error, byte_count, stats
+
+
+def rewrite_files(password, filenames, new_password=None, jenc_version=None, jobs=None, journal_filename=None, verbose=False):
+    """Re-key and/or migrate multiple .jenc files in place, see Rewriter.
+    Work is spread across `jobs` worker processes (defaults to CPU count).
+    If journal_filename is set, completed files are recorded there and
+    skipped by a later run; the journal is removed once every file succeeded.
+    Reports per file result and throughput on stderr.
+    Returns 0 on success, 1 if any file failed (process exit code).
+    """
+    import multiprocessing
+    journal = None
+    if journal_filename:
+        journal = Journal(journal_filename, {'rekey': new_password is not None, 'jenc_version': jenc_version})
+    work = [filename for filename in filenames if journal is None or not journal.is_completed(filename)]
+    resumed_count = len(filenames) - len(work)
+    jobs = jobs or multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(work) or 1))
+    collector = metrics.collector
+    start_time = time.time()
+    if jobs == 1:
+        _rewrite_files_init(password, new_password, jenc_version)
+        results = map(_rewrite_file, work)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes=jobs, initializer=_rewrite_files_init, initargs=(password, new_password, jenc_version, collector is not None))
+        results = pool.imap_unordered(_rewrite_file, work)
+    counts = {REWRITTEN: 0, SKIPPED: resumed_count, None: 0}
+    byte_count = 0
+    try:
+        for filename, status, error, file_byte_count, file_stats in results:
+            if pool is not None and collector is not None and file_stats is not None:
+                collector.record(file_stats)  # from worker process
+            counts[status] += 1
+            if status is None:
+                sys.stderr.write('FAILED    %s %r\n' % (filename, error))
+                continue
+            byte_count += file_byte_count
+            if journal is not None:
+                journal.record(filename)
+            if verbose:
+                sys.stderr.write('%-9s %s\n' % (status, filename))
+    finally:
+        if pool is None:
+            _worker_state['rewriter'].close()
+        _worker_state.clear()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if journal is not None:
+            if counts[None] or counts[REWRITTEN] + counts[SKIPPED] != len(filenames):
+                journal.close()  # keep for resume
+            else:
+                journal.remove()
+    elapsed = time.time() - start_time
+    sys.stderr.write('%d files, %d rewritten, %d skipped, %d failed, %d bytes in %f secs (%.2f MB/sec) using %d jobs\n' % (
+        len(filenames), counts[REWRITTEN], counts[SKIPPED], counts[None], byte_count, elapsed, byte_count / (elapsed or 1e-9) / (1024 * 1024), jobs))
+    sys.stderr.flush()
+    if counts[None]:
+        return 1
+    return 0
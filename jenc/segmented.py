@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Segmented, seekable jenc versions (S001), random access without
+decrypting the whole file.
+
+NOTE S001 is a jenc-py extension, Markor / jpencconverter can NOT read it.
+Convert with `python -m jenc -p PASSWORD --migrate-to V001 FILE` (and back with `--migrate-to S001`).
+
+Same header as V001 (version, nonce, salt) and the same PBKDF2 derived key,
+from which a per-file key is derived with HMAC-SHA256 over the header nonce
+(so JencSession files sharing a salt still get distinct keys). The plaintext
+is split into fixed size segments (jenc_version_details 'segmentSize'), each
+encrypted with AES-GCM and stored as a frame:
+
+    segment nonce (8 random bytes) + ciphertext + auth tag (16 bytes)
+
+The GCM nonce is the segment nonce followed by the 32-bit segment index, so
+frames can not be reordered. All segments are full except the final one which is always
+shorter (possibly empty), so truncation at a frame boundary is detected.
+Frame offsets follow from the segment index, i.e. the layout is its own
+segment index; reading segment i means reading and authenticating one frame.
+
+Whole file APIs (jenc.encrypt(), jenc.decrypt(), streaming, JencSession, etc.)
+handle S001 via SegmentedAesGcm. For random access use SegmentedFile:
+
+    import jenc.segmented
+
+    with jenc.segmented.SegmentedFile('big.md.jenc', 'geheim', mode='wb') as f:
+        f.write(b'Hello World')
+    with jenc.segmented.SegmentedFile('big.md.jenc', 'geheim') as f:
+        f.seek(6)
+        print(f.read(5))  # only the segment holding offset 6 is decrypted
+    with jenc.segmented.SegmentedFile('big.md.jenc', 'geheim', mode='r+b') as f:
+        f.seek(6)
+        f.write(b'Jenc!')  # only that segment is re-encrypted and rewritten
+
+"""
+
+import collections
+import hashlib
+import hmac
+import io
+import struct
+
+import jenc
+from jenc import backends
+
+
+SEGMENTED_JENC_VERSION = 'S001'
+SEGMENT_NONCE_LENGTH = 8  # in bytes, random per frame, GCM nonce is this plus 4 byte segment index
+FRAME_OVERHEAD = SEGMENT_NONCE_LENGTH + jenc.AUTH_TAG_LENGTH  # in bytes, per segment
+MAX_SEGMENT_COUNT = 2 ** 32  # segment index is 32-bit
+FILE_KEY_LABEL = b'jenc S001 file key'
+MAX_DIRTY_SEGMENTS = 16  # SegmentedFile writes are flushed to disk after this many modified segments
+MAX_CACHED_SEGMENTS = 8  # SegmentedFile decrypted (clean) segments kept in memory
+
+
+def is_segmented(this_file_meta):
+    return this_file_meta['cipher'] == jenc.JENC_AES_GCM_SEGMENTED
+
+
+def file_key(derived_key, nonce_bytes):
+    """Per-file key, derived (PBKDF2) key and header nonce_bytes"""
+    return hmac.new(bytes(derived_key), FILE_KEY_LABEL + bytes(nonce_bytes), hashlib.sha256).digest()
+
+
+def _segment_cipher(file_key_bytes, segment_nonce, index):
+    if index >= MAX_SEGMENT_COUNT:
+        raise jenc.JencException('too many segments, limit %d' % MAX_SEGMENT_COUNT)
+    return backends.new_aes_gcm(file_key_bytes, segment_nonce + struct.pack('>I', index))
+
+
+def encrypted_content_length(plaintext_length, segment_size):
+    """Returns size in bytes after the header (all frames) for plaintext_length bytes"""
+    return plaintext_length + (plaintext_length // segment_size + 1) * FRAME_OVERHEAD
+
+
+def plaintext_length(content_length, segment_size):
+    """Returns plaintext size for content_length bytes between header and final auth tag,
+    None if that is not a valid (i.e. truncated) layout"""
+    content_length -= SEGMENT_NONCE_LENGTH
+    if content_length < 0:
+        return None
+    full_segments, final_length = divmod(content_length, segment_size + FRAME_OVERHEAD)
+    if final_length >= segment_size:
+        return None
+    return full_segments * segment_size + final_length
+
+
+def _output(result, output):
+    if output is None:
+        return result
+    out_view = memoryview(output).cast('B')
+    if out_view.nbytes != len(result):
+        raise ValueError('output must be a bytearray or writeable memoryview of length %d' % len(result))
+    out_view[:] = result
+    return None
+
+
+class SegmentedAesGcm(object):
+    """Cipher for segmented jenc versions with the same (pycryptodome GCM style)
+    API as the jenc.backends ciphers, so whole file APIs work unchanged.
+
+    encrypt() output is framed, i.e. includes segment nonces and tags of
+    completed segments, starting with the nonce of the first segment.
+    digest() returns the tag of the final segment (preceded by the first
+    segment nonce if encrypt() was never called). decrypt() takes the framed
+    bytes (all but the final tag), raising JencDecryptError as soon as a
+    segment tag does not verify; verify() checks the final tag.
+    """
+
+    def __init__(self, derived_key, nonce_bytes, segment_size):
+        self.segment_size = segment_size
+        self._file_key = file_key(derived_key, nonce_bytes)
+        self._index = 0
+        self._cipher = None  # of current segment
+        self._segment_length = 0  # bytes of current segment processed
+        self._started = False
+        self._buffer = b''  # decrypt, partially received segment nonce or tag
+
+    def _start_segment(self, segment_nonce):
+        self._cipher = _segment_cipher(self._file_key, segment_nonce, self._index)
+        self._segment_length = 0
+
+    def encrypt(self, plaintext, output=None):
+        plaintext_view = memoryview(plaintext).cast('B')
+        length = plaintext_view.nbytes
+        result = []
+        if not self._started:
+            self._started = True
+            segment_nonce = jenc.get_random_bytes(SEGMENT_NONCE_LENGTH)
+            self._start_segment(segment_nonce)
+            result.append(segment_nonce)
+        offset = 0
+        while offset < length:
+            chunk_length = min(self.segment_size - self._segment_length, length - offset)
+            result.append(self._cipher.encrypt(plaintext_view[offset:offset + chunk_length]))
+            offset += chunk_length
+            self._segment_length += chunk_length
+            if self._segment_length == self.segment_size:
+                # full, the final segment is always shorter (possibly empty)
+                result.append(self._cipher.digest())
+                self._index += 1
+                segment_nonce = jenc.get_random_bytes(SEGMENT_NONCE_LENGTH)
+                self._start_segment(segment_nonce)
+                result.append(segment_nonce)
+        return _output(b''.join(result), output)
+
+    def digest(self):
+        prefix = b''
+        if not self._started:
+            prefix = self.encrypt(b'')
+        return prefix + self._cipher.digest()
+
+    def _fill_buffer(self, view, offset, wanted_length):
+        chunk = bytes(view[offset:offset + wanted_length - len(self._buffer)])
+        self._buffer += chunk
+        return offset + len(chunk)
+
+    def decrypt(self, ciphertext, output=None):
+        view = memoryview(ciphertext).cast('B')
+        length = view.nbytes
+        result = []
+        offset = 0
+        while offset < length:
+            if self._cipher is None:
+                offset = self._fill_buffer(view, offset, SEGMENT_NONCE_LENGTH)
+                if len(self._buffer) == SEGMENT_NONCE_LENGTH:
+                    self._start_segment(self._buffer)
+                    self._buffer = b''
+            elif self._segment_length < self.segment_size:
+                chunk_length = min(self.segment_size - self._segment_length, length - offset)
+                result.append(self._cipher.decrypt(view[offset:offset + chunk_length]))
+                offset += chunk_length
+                self._segment_length += chunk_length
+            else:
+                offset = self._fill_buffer(view, offset, jenc.AUTH_TAG_LENGTH)
+                if len(self._buffer) == jenc.AUTH_TAG_LENGTH:
+                    try:
+                        self._cipher.verify(self._buffer)
+                    except ValueError as info:
+                        raise jenc.JencDecryptError('segment %d %s' % (self._index, info))
+                    self._cipher = None
+                    self._buffer = b''
+                    self._index += 1
+        return _output(b''.join(result), output)
+
+    def verify(self, received_mac_tag):
+        if self._cipher is None or self._buffer or self._segment_length >= self.segment_size:
+            raise ValueError('truncated, missing final segment')
+        self._cipher.verify(received_mac_tag)
+
+    def encrypt_and_digest(self, plaintext):
+        return self.encrypt(plaintext), self.digest()
+
+    def decrypt_and_verify(self, ciphertext, received_mac_tag):
+        plaintext = self.decrypt(ciphertext)
+        self.verify(received_mac_tag)
+        return plaintext
+
+
+class SegmentedFile(io.RawIOBase):
+    """Seekable file object for segmented (S001) .jenc files.
+
+    Only the segments covering a read are decrypted and authenticated,
+    writes re-encrypt (with a fresh segment nonce) only the segments they
+    touch. Writes are buffered for up to MAX_DIRTY_SEGMENTS segments, see flush().
+    With jobs > 1 segments of large reads/flushes are processed on a thread pool.
+
+    Takes in:
+        file, filename or (seekable, readable) binary file object
+        password string
+        mode; 'rb' read only, 'r+b' modify existing file, 'wb' create new (truncates)
+        jenc_version for mode 'wb'
+        key_cache, optional DerivedKeyCache (see jenc.enable_key_cache())
+
+    NOTE writes to an existing file are in place, not atomic; an interrupted
+    write can leave a segment that fails to verify. Segments are authenticated
+    individually, so a segment from an older version of the same file is not
+    detected if substituted.
+    """
+
+    def __init__(self, file, password, mode='rb', jenc_version=SEGMENTED_JENC_VERSION, key_cache=None, jobs=1):
+        io.RawIOBase.__init__(self)
+        if mode not in ('rb', 'r+b', 'wb'):
+            raise ValueError('mode %r not one of rb, r+b, wb' % mode)
+        self.mode = mode
+        self.jobs = jobs
+        self._owns_file = not hasattr(file, 'read')
+        if self._owns_file:
+            file = open(file, {'wb': 'w+b'}.get(mode, mode))
+        self._file = file
+        try:
+            if mode == 'wb':
+                jenc.jenc_version_check(jenc_version)
+                self.jenc_version = jenc_version
+                self.this_file_meta = jenc.jenc_version_details[jenc_version]
+                self._check_segmented()
+                nonce_bytes = jenc.get_random_bytes(self.this_file_meta['nonceLenth'])
+                salt_bytes = jenc.get_random_bytes(self.this_file_meta['keySaltLength'])
+            else:
+                file.seek(0)
+                self.jenc_version, self.this_file_meta, nonce_bytes, salt_bytes = jenc._read_header(file)
+                self._check_segmented()
+            self.segment_size = self.this_file_meta['segmentSize']
+            self._header_length = jenc._header_length(self.this_file_meta)
+            self._file_key = file_key(jenc._derive_key(password, salt_bytes, self.this_file_meta, key_cache=key_cache), nonce_bytes)
+            self._segments = collections.OrderedDict()  # index -> bytearray plaintext, least recently used first
+            self._dirty = set()  # indexes of modified segments
+            self._position = 0
+            if mode == 'wb':
+                file.seek(0)
+                file.truncate()
+                file.write(self.jenc_version.encode('us-ascii') + nonce_bytes + salt_bytes)
+                self._length = self._stored_length = 0
+                self._segments[0] = bytearray()
+                self._dirty.add(0)
+                self.flush()  # valid (empty) file from the start
+            else:
+                total_length = file.seek(0, io.SEEK_END)
+                self._length = plaintext_length(total_length - self._header_length - jenc.AUTH_TAG_LENGTH, self.segment_size)
+                if self._length is None:
+                    raise jenc.JencDecryptError('truncated')
+                self._stored_length = self._length  # length of what is on disk
+        except:
+            if self._owns_file:
+                file.close()
+            raise
+
+    def _check_segmented(self):
+        if not is_segmented(self.this_file_meta):
+            raise jenc.UnsupportedMetaData('jenc version %r is not segmented (seekable), see --migrate-to %s' % (self.jenc_version, SEGMENTED_JENC_VERSION))
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self.mode != 'rb'
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._length + offset
+        else:
+            raise ValueError('invalid whence %r' % whence)
+        if position < 0:
+            raise ValueError('negative seek position %d' % position)
+        self._position = position
+        return position
+
+    def __len__(self):
+        """Plaintext size in bytes"""
+        return self._length
+
+    def _map(self, function, items):
+        from . import gcm
+        return gcm.parallel_map(function, items, self.jobs, stage='segmented')
+
+    def _frame_offset(self, index):
+        return self._header_length + index * (self.segment_size + FRAME_OVERHEAD)
+
+    def _decrypt_frame(self, job):
+        index, frame = job
+        cipher = _segment_cipher(self._file_key, frame[:SEGMENT_NONCE_LENGTH], index)
+        try:
+            return bytearray(cipher.decrypt_and_verify(frame[SEGMENT_NONCE_LENGTH:-jenc.AUTH_TAG_LENGTH], frame[-jenc.AUTH_TAG_LENGTH:]))
+        except ValueError as info:
+            raise jenc.JencDecryptError('segment %d %s' % (index, info))
+
+    def _encrypt_frame(self, job):
+        index, segment = job
+        segment_nonce = jenc.get_random_bytes(SEGMENT_NONCE_LENGTH)
+        crypted_bytes, auth_tag = _segment_cipher(self._file_key, segment_nonce, index).encrypt_and_digest(bytes(segment))
+        return segment_nonce + crypted_bytes + auth_tag
+
+    def _load_segments(self, indexes):
+        """Make sure segments are in memory, reading and decrypting those that are not"""
+        stored_final_index = self._stored_length // self.segment_size
+        jobs = []
+        for index in indexes:
+            if index in self._segments:
+                self._segments.move_to_end(index)
+            elif index > stored_final_index:
+                self._segments[index] = bytearray()  # beyond what is on disk, i.e. new
+            else:
+                frame_length = self.segment_size + FRAME_OVERHEAD
+                if index == stored_final_index:
+                    frame_length = self._stored_length % self.segment_size + FRAME_OVERHEAD
+                self._file.seek(self._frame_offset(index))
+                frame = self._file.read(frame_length)
+                if len(frame) != frame_length:
+                    raise jenc.JencDecryptError('truncated segment %d' % index)
+                jobs.append((index, frame))
+        for (index, frame), segment in zip(jobs, self._map(self._decrypt_frame, jobs)):
+            self._segments[index] = segment
+
+    def _trim_cache(self):
+        for index in list(self._segments):
+            if len(self._segments) <= MAX_CACHED_SEGMENTS:
+                break
+            if index not in self._dirty:
+                del self._segments[index]
+
+    def readinto(self, buffer):
+        out_view = memoryview(buffer).cast('B')
+        length = min(out_view.nbytes, self._length - self._position)
+        if length <= 0:
+            return 0
+        start, end = self._position, self._position + length
+        indexes = range(start // self.segment_size, (end - 1) // self.segment_size + 1)
+        self._load_segments(indexes)
+        for index in indexes:
+            segment_start = index * self.segment_size
+            low, high = max(start, segment_start), min(end, segment_start + self.segment_size)
+            out_view[low - start:high - start] = self._segments[index][low - segment_start:high - segment_start]
+        self._position = end
+        self._trim_cache()
+        return length
+
+    def _modify(self, start, data_view, new_length):
+        """Write data_view at start, zero filling any gap, file is at least new_length bytes afterwards"""
+        end = start + data_view.nbytes
+        if new_length > self._length:
+            # growing, all segments from the current final one change
+            indexes = range(min(start, self._length) // self.segment_size, new_length // self.segment_size + 1)
+        else:
+            indexes = range(start // self.segment_size, (end - 1) // self.segment_size + 1)
+        self._load_segments(indexes)
+        for index in indexes:
+            segment = self._segments[index]
+            segment_start = index * self.segment_size
+            segment_length = min(self.segment_size, max(new_length, self._length) - segment_start)
+            if len(segment) < segment_length:
+                segment.extend(bytes(segment_length - len(segment)))
+            low, high = max(start, segment_start), min(end, segment_start + self.segment_size)
+            if low < high:
+                segment[low - segment_start:high - segment_start] = data_view[low - start:high - start]
+            self._dirty.add(index)
+        self._length = max(self._length, new_length)
+        if len(self._dirty) > MAX_DIRTY_SEGMENTS:
+            self.flush()
+
+    def write(self, data):
+        if not self.writable():
+            raise io.UnsupportedOperation('not writable')
+        data_view = memoryview(data).cast('B')
+        length = data_view.nbytes
+        if length:
+            self._modify(self._position, data_view, self._position + length)
+            self._position += length
+        return length
+
+    def truncate(self, size=None):
+        if not self.writable():
+            raise io.UnsupportedOperation('not writable')
+        if size is None:
+            size = self._position
+        if size > self._length:
+            self._modify(size, memoryview(b''), size)  # zero fill
+        elif size < self._length:
+            final_index = size // self.segment_size
+            self._load_segments([final_index])
+            for index in list(self._segments):
+                if index > final_index:
+                    del self._segments[index]
+                    self._dirty.discard(index)
+            del self._segments[final_index][size - final_index * self.segment_size:]
+            self._dirty.add(final_index)
+            self._length = size
+            self.flush()  # so growing again does not load stale segments from disk
+        return size
+
+    def flush(self):
+        """Encrypt and write modified segments"""
+        if self.closed or not self._dirty:
+            return
+        indexes = sorted(self._dirty)
+        frames = self._map(self._encrypt_frame, [(index, self._segments[index]) for index in indexes])
+        for index, frame in zip(indexes, frames):
+            self._file.seek(self._frame_offset(index))
+            self._file.write(frame)
+        if self._length < self._stored_length:
+            self._file.truncate(self._header_length + encrypted_content_length(self._length, self.segment_size))
+        self._file.flush()
+        self._stored_length = self._length
+        self._dirty.clear()
+        self._trim_cache()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            io.RawIOBase.close(self)  # flushes
+        finally:
+            self._segments.clear()
+            if self._owns_file:
+                self._file.close()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Mirror a plaintext directory tree to a tree of .jenc files, encrypting only what changed.
+
+SRC/notes/todo.md is encrypted to DST/notes/todo.md.jenc. A manifest of
+(mtime, size, SHA-256 of plaintext) per source file is kept, encrypted with
+the same password, in DST/.jenc_sync_manifest.
+
+  * unchanged mtime and size - skipped without reading the file (a no-op sync is a metadata walk)
+  * same size but new mtime - content hash is checked first, only encrypted if it differs
+  * source file deleted - its .jenc file is removed (only files recorded in the manifest are ever removed)
+  * modified less than `debounce` seconds ago (or modified while being read) - left for the next pass
+
+Files are encrypted across a pool of worker processes, each with one
+jenc.JencSession, so the KDF runs once per worker rather than once per file.
+Output is written atomically, see jenc.AtomicFileWriter.
+
+Sample code:
+
+    import jenc.sync
+
+    with jenc.sync.Syncer('my_notes_dir', 'encrypted_notes_dir', 'geheim') as syncer:
+        print(syncer.sync_once())
+
+Command line:
+
+    python -m jenc sync -p geheim my_notes_dir encrypted_notes_dir
+    python -m jenc sync -p geheim --watch --interval 2 my_notes_dir encrypted_notes_dir
+
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+import jenc
+
+
+MANIFEST_FILENAME = '.jenc_sync_manifest'  # created in DST
+MANIFEST_FORMAT = 1
+DEFAULT_INTERVAL = 2.0  # in seconds, between polls in watch mode
+DEFAULT_WATCH_DEBOUNCE = 1.0  # in seconds, files modified more recently are synced on a later poll
+
+ENCRYPTED = 'encrypted'
+UNCHANGED = 'unchanged'
+DELETED = 'deleted'
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+class SourceChanged(jenc.JencException):
+    '''Source file was modified while being encrypted'''
+
+
+def _signature(stat_result):
+    return [getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime), stat_result.st_size]
+
+
+def _read_chunks(in_file, hasher, chunk_size=jenc.DEFAULT_CHUNK_SIZE):
+    while True:
+        plaintext_bytes = in_file.read(chunk_size)
+        if not plaintext_bytes:
+            break
+        hasher.update(plaintext_bytes)
+        yield plaintext_bytes
+
+
+_worker_state = {}  # per process state for Syncer
+
+def _sync_init(password, jenc_version):
+    _worker_state['session'] = jenc.JencSession(password, jenc_version=jenc_version)
+
+def _sync_file(job, session=None):
+    """Encrypt one source file if its content changed (with session, defaults to the worker's), returns tuple of;
+    (path, new manifest entry or None, ENCRYPTED/UNCHANGED/PENDING/FAILED, error or None, number of bytes read)
+    """
+    path, src_filename, dst_filename, old_entry = job
+    try:
+        in_file = open(src_filename, 'rb')
+        try:
+            signature = _signature(os.fstat(in_file.fileno()))
+            hasher = hashlib.sha256()
+            if old_entry is not None and old_entry[1] == signature[1] and os.path.exists(dst_filename):
+                # same size, probably only touched; hash before paying for encryption
+                for plaintext_bytes in _read_chunks(in_file, hasher):
+                    pass
+                if hasher.hexdigest() == old_entry[2]:
+                    return path, signature + [old_entry[2]], UNCHANGED, None, signature[1]
+                in_file.seek(0)
+                hasher = hashlib.sha256()
+            directory = os.path.dirname(dst_filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            out_file = jenc.AtomicFileWriter(dst_filename)
+            try:
+                (session or _worker_state['session']).encrypt_chunks(_read_chunks(in_file, hasher), out_file)
+                if _signature(os.stat(src_filename)) != signature:
+                    raise SourceChanged(src_filename)
+            except:
+                out_file.abort()
+                raise
+            out_file.commit()
+        finally:
+            in_file.close()
+    except SourceChanged as info:
+        return path, None, PENDING, info, 0
+    except Exception as info:
+        return path, None, FAILED, info, 0
+    return path, signature + [hasher.hexdigest()], ENCRYPTED, None, signature[1]
+
+
+class Syncer(object):
+    """Keeps dst (.jenc files) in sync with the plaintext files under src, see module docs.
+    Work is spread across `jobs` worker processes (defaults to CPU count), the pool is
+    kept between passes (watch mode) until close().
+    """
+
+    def __init__(self, src, dst, password, jenc_version=None, jobs=None, manifest_filename=None, debounce=0.0):
+        if jenc_version is not None:
+            jenc.jenc_version_check(jenc_version)
+        self.src = os.path.abspath(src)
+        self.dst = os.path.abspath(dst)
+        self.password = password
+        self.jenc_version = jenc_version
+        self.jobs = jobs
+        self.debounce = debounce
+        self.manifest_filename = manifest_filename or os.path.join(self.dst, MANIFEST_FILENAME)
+        self.manifest = {}  # path -> [mtime, size, sha256 hex digest]
+        self._pool = None
+        self._pool_size = None
+        self._session = None  # in process, when jobs == 1
+        if os.path.exists(self.manifest_filename):
+            self.load_manifest()
+
+    def load_manifest(self):
+        f = open(self.manifest_filename, 'rb')
+        try:
+            manifest = json.loads(jenc.decrypt(self.password, f.read()).decode('utf-8'))
+        finally:
+            f.close()
+        if manifest.get('format') != MANIFEST_FORMAT:
+            raise jenc.UnsupportedMetaData('sync manifest format %r' % manifest.get('format'))
+        self.manifest = manifest['files']
+
+    def save_manifest(self):
+        if not os.path.isdir(self.dst):
+            os.makedirs(self.dst)
+        manifest_bytes = json.dumps({'format': MANIFEST_FORMAT, 'files': self.manifest}, sort_keys=True).encode('utf-8')
+        out_file = jenc.AtomicFileWriter(self.manifest_filename)
+        try:
+            jenc.encrypt_file_handle(out_file, self.password, manifest_bytes, jenc_version=self.jenc_version)
+        except:
+            out_file.abort()
+            raise
+        out_file.commit()
+
+    def _dst_filename(self, path):
+        return os.path.join(self.dst, path.replace('/', os.sep) + jenc.JENC_FILENAME_EXTENSION)
+
+    def scan(self):
+        """Returns dict of path -> source filename, for (non .jenc) files under src"""
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(self.src):
+            dirnames[:] = sorted(dirname for dirname in dirnames if os.path.join(dirpath, dirname) != self.dst)  # dst may be inside src
+            for filename in sorted(filenames):
+                if filename.endswith(jenc.JENC_FILENAME_EXTENSION):
+                    continue
+                src_filename = os.path.join(dirpath, filename)
+                result[os.path.relpath(src_filename, self.src).replace(os.sep, '/')] = src_filename
+        return result
+
+    def _results(self, work):
+        import multiprocessing
+        jobs = max(1, min(self.jobs or multiprocessing.cpu_count(), len(work)))
+        if jobs == 1:
+            if self._session is None:
+                self._session = jenc.JencSession(self.password, jenc_version=self.jenc_version)
+            return (_sync_file(job, self._session) for job in work)
+        if self._pool is None or self._pool_size < jobs:
+            self._close_pool()
+            self._pool = multiprocessing.Pool(processes=jobs, initializer=_sync_init, initargs=(self.password, self.jenc_version))
+            self._pool_size = jobs
+        return self._pool.imap_unordered(_sync_file, work)
+
+    def sync_once(self, report=None):
+        """One pass, encrypt new/changed files and remove .jenc files for deleted ones.
+        report is an optional callback(path, action, error).
+        Returns dict of counts per action (ENCRYPTED, UNCHANGED, DELETED, PENDING, FAILED) and 'bytes'.
+        """
+        counts = {ENCRYPTED: 0, UNCHANGED: 0, DELETED: 0, PENDING: 0, FAILED: 0, 'bytes': 0}
+        now = time.time()
+        current = self.scan()
+        work = []
+        manifest_changed = False
+        for path, src_filename in current.items():
+            old_entry = self.manifest.get(path)
+            dst_filename = self._dst_filename(path)
+            try:
+                stat_result = os.stat(src_filename)
+            except EnvironmentError:
+                continue  # deleted since scan, handled next pass
+            if old_entry is not None and _signature(stat_result) == old_entry[:2] and os.path.exists(dst_filename):
+                counts[UNCHANGED] += 1
+                continue
+            if self.debounce and now - stat_result.st_mtime < self.debounce:
+                counts[PENDING] += 1  # still being saved
+                continue
+            work.append((path, src_filename, dst_filename, old_entry))
+
+        for path in sorted(path for path in self.manifest if path not in current):
+            dst_filename = self._dst_filename(path)
+            try:
+                if os.path.exists(dst_filename):
+                    os.remove(dst_filename)
+            except EnvironmentError as info:
+                counts[FAILED] += 1
+                if report is not None:
+                    report(path, FAILED, info)
+                continue
+            del self.manifest[path]
+            manifest_changed = True
+            counts[DELETED] += 1
+            if report is not None:
+                report(path, DELETED, None)
+
+        if work:
+            for path, entry, action, error, byte_count in self._results(work):
+                counts[action] += 1
+                if entry is not None:
+                    self.manifest[path] = entry
+                    manifest_changed = True
+                if action == ENCRYPTED:
+                    counts['bytes'] += byte_count
+                if report is not None and action != UNCHANGED:
+                    report(path, action, error)
+        if manifest_changed or not os.path.exists(self.manifest_filename):
+            self.save_manifest()
+        return counts
+
+    def watch(self, interval=DEFAULT_INTERVAL, report=None, on_pass=None, passes=None):
+        """Poll src every interval seconds and sync, forever (or for `passes` passes).
+        on_pass is an optional callback(counts, elapsed seconds) called after each pass.
+        Returns counts of the last pass."""
+        pass_count = 0
+        while True:
+            start_time = time.time()
+            counts = self.sync_once(report=report)
+            if on_pass is not None:
+                on_pass(counts, time.time() - start_time)
+            pass_count += 1
+            if passes is not None and pass_count >= passes:
+                return counts
+            time.sleep(interval)
+
+    def _close_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def close(self):
+        """Stop worker processes and zeroize the in process session key"""
+        self._close_pool()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def sync(src, dst, password, jenc_version=None, jobs=None):
+    """Sync once, see Syncer. Returns dict of counts"""
+    syncer = Syncer(src, dst, password, jenc_version=jenc_version, jobs=jobs)
+    try:
+        return syncer.sync_once()
+    finally:
+        syncer.close()
+
+
+def main(argv=None):
+    import getpass
+    import optparse
+
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog sync [options] SRC DST"
+    parser = optparse.OptionParser(
+        usage=usage,
+        version="%prog " + jenc.__version__,
+        description="Encrypt new and changed files under SRC into .jenc files under DST, remove .jenc files of deleted files"
+    )
+    parser.add_option("-E", "--envvar", help="Name of environment variable to get password from (defaults to JENC_PASSWORD) - unsafe", default="JENC_PASSWORD")
+    parser.add_option("-p", "--password", help="password, if omitted but OS env JENC_PASSWORD is set use that, if missing prompt - unsafe")
+    parser.add_option("-P", "--password_file", help="file name where password is to be read from, trailing blanks are ignored")
+    parser.add_option("-j", "--jenc-version", "--jenc_version", help="jenc version to encrypt with, case sensitive")
+    parser.add_option("--jobs", help="number of worker processes (defaults to CPU count)", type="int")
+    parser.add_option("-w", "--watch", help="keep polling SRC for changes", action="store_true")
+    parser.add_option("--interval", help="seconds between polls in watch mode (defaults to %default)", type="float", default=DEFAULT_INTERVAL)
+    parser.add_option("--debounce", help="skip files modified less than this many seconds ago until a later pass (defaults to %s in watch mode, 0 otherwise)" % DEFAULT_WATCH_DEBOUNCE, type="float")
+    parser.add_option("-v", "--verbose", help="report each file", action="store_true")
+
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.print_usage()
+        return 2
+    src, dst = args
+    if not os.path.isdir(src):
+        parser.error('SRC %r is not a directory' % src)
+    debounce = options.debounce
+    if debounce is None:
+        debounce = options.watch and DEFAULT_WATCH_DEBOUNCE or 0.0
+    password = jenc._resolve_password(options.password, options.password_file, options.envvar) or getpass.getpass("Password:")
+
+    def report(path, action, error):
+        if error is not None:
+            sys.stderr.write('%-9s %s %r\n' % (action, path, error))
+        elif options.verbose:
+            sys.stderr.write('%-9s %s\n' % (action, path))
+
+    def summary(counts, elapsed):
+        if options.watch and not (counts[ENCRYPTED] or counts[DELETED] or counts[FAILED] or options.verbose):
+            return  # quiet when idle
+        sys.stderr.write('%d encrypted, %d unchanged, %d deleted, %d pending, %d failed, %d bytes in %f secs\n' % (
+            counts[ENCRYPTED], counts[UNCHANGED], counts[DELETED], counts[PENDING], counts[FAILED], counts['bytes'], elapsed))
+        sys.stderr.flush()
+
+    syncer = Syncer(src, dst, password, jenc_version=options.jenc_version, jobs=options.jobs, debounce=debounce)
+    counts = {FAILED: 0}
+    try:
+        counts = syncer.watch(interval=options.interval, report=report, on_pass=summary, passes=None if options.watch else 1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        syncer.close()
+    if counts[FAILED]:
+        return 1
+    return 0
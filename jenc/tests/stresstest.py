@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Stress tests for jenc; concurrency, large payloads, peak memory and
+throughput regressions. Slow (minutes, GBs of AES-GCM) so skipped unless
+OS env JENC_STRESS=1 is set.
+
+OS env settings:
+
+  * JENC_STRESS=1 - run the stress tests
+  * JENC_STRESS_MAX_SIZE - largest payload of the size sweep, K/M/G suffix supported (default 1G), e.g. 4G
+  * JENC_STRESS_THREADS - number of threads/processes for concurrency tests (default 8)
+  * JENC_STRESS_BASELINE - throughput baseline JSON file (default stress_baseline.json next to this file,
+    jenc/tests/), recorded on first run (that test is then skipped), compared on later runs on the same host.
+    To keep it for a benchmark host or CI runner either commit jenc/tests/stress_baseline.json on that
+    host's branch or point JENC_STRESS_BASELINE at a path that outlives the checkout (e.g. a CI cache)
+  * JENC_STRESS_UPDATE_BASELINE=1 - record a new baseline
+  * JENC_STRESS_TOLERANCE - allowed throughput drop before failing, fraction of baseline (default 0.25)
+
+Sample usage:
+
+    JENC_STRESS=1 python -m jenc.tests.stresstest -v
+    JENC_STRESS=1 JENC_STRESS_MAX_SIZE=4G python -m jenc.tests.stresstest -v TestStressLargePayloads
+    JENC_STRESS=1 python -m pytest -q jenc/tests/stresstest.py
+
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+from io import BytesIO as FakeFile  # py3
+
+import jenc
+from jenc import bench
+from jenc.tests.testsuite import TestUtil, hello_password, main
+
+
+STRESS_ENABLED = os.environ.get('JENC_STRESS') == '1'
+MAX_SIZE = bench.parse_size(os.environ.get('JENC_STRESS_MAX_SIZE', '1G'))
+SWEEP_SIZES = [bench.parse_size(x) for x in ('1M', '16M', '256M', '1G', '2G', '4G', '8G')]
+IN_MEMORY_MAX_SIZE = 256 * 1024 * 1024  # in bytes, larger payloads are only streamed (generated input, hashed output)
+THREAD_COUNT = int(os.environ.get('JENC_STRESS_THREADS', '8'))
+ITERATIONS = 20  # per thread/process
+BASELINE_FILENAME = os.environ.get('JENC_STRESS_BASELINE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stress_baseline.json')
+UPDATE_BASELINE = os.environ.get('JENC_STRESS_UPDATE_BASELINE') == '1'
+REGRESSION_TOLERANCE = float(os.environ.get('JENC_STRESS_TOLERANCE', '0.25'))
+MEMORY_SLACK = 1024 * 1024  # in bytes, allowed on top of the expected peak for interpreter/bookkeeping allocations
+PATTERN_SIZE = 1024 * 1024  # in bytes, generated payloads repeat a random block this size
+
+
+def payload(seed, size):
+    """Deterministic bytes, the same in every process"""
+    block = hashlib.sha512(b'%d' % seed).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+class PatternFile(object):
+    """Read-only file-like object, `size` bytes of a repeated random block, without holding them in memory"""
+
+    def __init__(self, size, block=None):
+        self.block = block or os.urandom(PATTERN_SIZE)
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        """Short reads, at most up to the end of the current block"""
+        remaining = self.size - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        offset = self.position % len(self.block)
+        data = self.block[offset:offset + size]
+        self.position += len(data)
+        return data
+
+    def sha256(self):
+        digest = hashlib.sha256()
+        copy = PatternFile(self.size, self.block)
+        while True:
+            data = copy.read(PATTERN_SIZE)
+            if not data:
+                break
+            digest.update(data)
+        return digest.hexdigest()
+
+
+class GeneratorFile(object):
+    """File-like read() over an iterable of bytes, e.g. encrypt_stream_generator() output"""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class HashingFile(object):
+    """Write-only file-like object, keeps a sha256 and byte count instead of the data"""
+
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.byte_count = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.byte_count += len(data)
+
+    def flush(self):
+        pass
+
+    def sha256(self):
+        return self.digest.hexdigest()
+
+
+def streaming_round_trip(password, plaintext_file, jenc_version=None, chunk_size=jenc.DEFAULT_CHUNK_SIZE):
+    """Encrypt and decrypt plaintext_file chained in constant memory, returns HashingFile of the plaintext"""
+    encrypted_chunks = jenc.encrypt_stream_generator(password, plaintext_file, jenc_version=jenc_version, chunk_size=chunk_size)
+    out_file = HashingFile()
+    for plaintext_bytes in jenc.decrypt_stream_generator(password, GeneratorFile(encrypted_chunks), chunk_size=chunk_size):
+        out_file.write(plaintext_bytes)
+    return out_file
+
+
+def traced_peak(function):
+    """Returns tuple of; result of function(), peak bytes allocated (tracemalloc) while it ran"""
+    tracemalloc.start()
+    try:
+        result = function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def _process_encrypt(job):
+    """Pool worker, returns encrypted payload"""
+    seed, size, jenc_version = job
+    return jenc.encrypt(hello_password, payload(seed, size), jenc_version=jenc_version)
+
+
+def _process_decrypt(encrypted_bytes):
+    """Pool worker, returns sha256 hex of the plaintext"""
+    return hashlib.sha256(jenc.decrypt(hello_password, encrypted_bytes)).hexdigest()
+
+
+class StressUtil(TestUtil):
+    def setUp(self):
+        if not STRESS_ENABLED:
+            self.skip('stress test, set OS env JENC_STRESS=1 to run')
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_threads(self, function, count=THREAD_COUNT):
+        """Run function(thread_number) on count threads, fail with the first exception raised by any"""
+        errors = []
+
+        def run(thread_number):
+            try:
+                function(thread_number)
+            except Exception as info:
+                errors.append(info)
+        threads = [threading.Thread(target=run, args=(thread_number,)) for thread_number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class TestStressConcurrency(StressUtil):
+    def test_threads_shared_password(self):
+        versions = sorted(jenc.jenc_version_details)
+        shared_encrypted_bytes = jenc.encrypt(hello_password, payload(0, 100000))
+        nonces = []
+        original_cache = jenc.derived_key_cache
+        jenc.enable_key_cache()  # also exercise the shared cache
+
+        def work(thread_number):
+            for iteration in range(ITERATIONS):
+                plaintext = payload(thread_number * ITERATIONS + iteration, (thread_number * 7919 + iteration * 104729) % 65536)
+                encrypted_bytes = jenc.encrypt(hello_password, plaintext, jenc_version=versions[iteration % len(versions)])
+                nonces.append(jenc.inspect(encrypted_bytes).nonce_bytes)
+                self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+                self.assertEqual(payload(0, 100000), jenc.decrypt(hello_password, shared_encrypted_bytes))
+        try:
+            self.run_threads(work)
+        finally:
+            jenc.disable_key_cache()
+            jenc.derived_key_cache = original_cache
+        self.assertEqual(THREAD_COUNT * ITERATIONS, len(set(nonces)))
+
+    def test_threads_shared_session(self):
+        max_files = 7
+        results = []
+        session = jenc.JencSession(hello_password, max_files=max_files)
+
+        def work(thread_number):
+            for iteration in range(ITERATIONS):
+                plaintext = payload(thread_number, 1000 + iteration)
+                results.append((plaintext, session.encrypt(plaintext)))
+        self.run_threads(work)
+        session.close()
+        file_count = THREAD_COUNT * ITERATIONS
+        self.assertEqual(file_count, len(results))
+        self.assertEqual((file_count + max_files - 1) // max_files, session.key_derivation_count)
+        for plaintext, encrypted_bytes in results:
+            self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+
+    def test_processes(self):
+        versions = sorted(jenc.jenc_version_details)
+        jobs = [(seed, seed * 997 % 200000, versions[seed % len(versions)]) for seed in range(THREAD_COUNT * ITERATIONS)]
+        pool = multiprocessing.Pool(THREAD_COUNT)
+        try:
+            encrypted = pool.map(_process_encrypt, jobs)
+            for (seed, size, jenc_version), encrypted_bytes in zip(jobs, encrypted):
+                self.assertEqual(jenc_version.encode('us-ascii'), encrypted_bytes[:4])
+                self.assertEqual(payload(seed, size), jenc.decrypt(hello_password, encrypted_bytes))
+            digests = pool.map(_process_decrypt, [jenc.encrypt(hello_password, payload(seed, size)) for seed, size, jenc_version in jobs])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([hashlib.sha256(payload(seed, size)).hexdigest() for seed, size, jenc_version in jobs], digests)
+
+    def test_process_files(self):
+        filenames = []
+        for file_number in range(THREAD_COUNT * ITERATIONS):
+            filename = os.path.join(self.temp_dir, 'note%03d.md' % file_number)
+            f = open(filename, 'wb')
+            f.write(payload(file_number, file_number * 101))
+            f.close()
+            filenames.append(filename)
+        self.assertEqual(0, jenc.process_files(hello_password, filenames, False, jobs=THREAD_COUNT))
+        for filename in filenames:
+            os.remove(filename)
+        self.assertEqual(0, jenc.process_files(hello_password, [filename + jenc.JENC_FILENAME_EXTENSION for filename in filenames], True, jobs=THREAD_COUNT))
+        for file_number, filename in enumerate(filenames):
+            f = open(filename, 'rb')
+            self.assertEqual(payload(file_number, file_number * 101), f.read())
+            f.close()
+
+
+class TestStressLargePayloads(StressUtil):
+    sizes = [size for size in SWEEP_SIZES if size <= MAX_SIZE]
+
+    def test_in_memory_sweep(self):
+        for size in self.sizes:
+            if size > IN_MEMORY_MAX_SIZE:
+                continue
+            plaintext = os.urandom(size)
+            encrypted_bytes = jenc.encrypt(hello_password, plaintext)
+            self.assertEqual(jenc.encrypted_length(size), len(encrypted_bytes))
+            self.assertTrue(plaintext == jenc.decrypt(hello_password, encrypted_bytes), 'decrypt %d bytes' % size)
+            out_buffer = bytearray(size)
+            jenc.decrypt_into(hello_password, encrypted_bytes, out_buffer)
+            self.assertTrue(plaintext == out_buffer, 'decrypt_into %d bytes' % size)
+            del plaintext, encrypted_bytes, out_buffer
+
+    def test_streaming_sweep(self):
+        for size in self.sizes:
+            plaintext_file = PatternFile(size)
+            out_file = streaming_round_trip(hello_password, plaintext_file, chunk_size=1024 * 1024)
+            self.assertEqual(size, out_file.byte_count)
+            self.assertEqual(plaintext_file.sha256(), out_file.sha256(), 'streaming %d bytes' % size)
+
+    def test_streaming_all_versions(self):
+        size = min(MAX_SIZE, 64 * 1024 * 1024)
+        for jenc_version in sorted(jenc.jenc_version_details):
+            plaintext_file = PatternFile(size)
+            out_file = streaming_round_trip(hello_password, plaintext_file, jenc_version=jenc_version, chunk_size=256 * 1024)
+            self.assertEqual(plaintext_file.sha256(), out_file.sha256(), 'streaming %s %d bytes' % (jenc_version, size))
+
+    def test_parallel_gcm(self):
+        from jenc import gcm
+        size = min(MAX_SIZE, IN_MEMORY_MAX_SIZE)
+        plaintext = os.urandom(size)
+        key, nonce_bytes = os.urandom(32), os.urandom(32)
+        serial_result = jenc.backends.pycryptodome_aes_gcm(key, nonce_bytes).encrypt_and_digest(plaintext)
+        self.assertTrue(serial_result == gcm.ParallelAesGcm(key, nonce_bytes, jobs=THREAD_COUNT).encrypt_and_digest(plaintext))
+
+
+class TestStressMemory(StressUtil):
+    size = 64 * 1024 * 1024  # in bytes
+    chunk_size = 64 * 1024  # in bytes
+
+    def setUp(self):
+        StressUtil.setUp(self)
+        self.plaintext = os.urandom(self.size)
+        self.encrypted_bytes = jenc.encrypt(hello_password, self.plaintext)
+        self.original_cache = jenc.derived_key_cache
+        jenc.enable_key_cache()  # KDF allocations are not of interest
+        jenc.decrypt(hello_password, self.encrypted_bytes)
+
+    def tearDown(self):
+        jenc.disable_key_cache()
+        jenc.derived_key_cache = self.original_cache
+        StressUtil.tearDown(self)
+
+    def assertPeak(self, name, expected_peak, function):
+        result, peak = traced_peak(function)
+        self.assertTrue(peak <= expected_peak + MEMORY_SLACK, '%s peak %d bytes, expected at most %d' % (name, peak, expected_peak + MEMORY_SLACK))
+        return result
+
+    def test_whole_buffer(self):
+        self.assertPeak('encrypt', 2 * self.size, lambda: jenc.encrypt(hello_password, self.plaintext))  # ciphertext, then joined with header
+        self.assertPeak('decrypt', self.size, lambda: jenc.decrypt(hello_password, self.encrypted_bytes))
+        out_buffer = bytearray(self.size)
+        self.assertPeak('decrypt_into', 0, lambda: jenc.decrypt_into(hello_password, self.encrypted_bytes, out_buffer))
+        out_buffer = bytearray(len(self.encrypted_bytes))
+        self.assertPeak('encrypt_into', 0, lambda: jenc.encrypt_into(hello_password, self.plaintext, out_buffer))
+
+    def test_streaming(self):
+        for jenc_version in sorted(jenc.jenc_version_details):
+            plaintext_file = PatternFile(self.size)
+            out_file = self.assertPeak('streaming %s' % jenc_version, 8 * self.chunk_size,
+                lambda: streaming_round_trip(hello_password, plaintext_file, jenc_version=jenc_version, chunk_size=self.chunk_size))
+            self.assertEqual(self.size, out_file.byte_count)
+
+    def test_pipeline(self):
+        from jenc import pipeline
+        chunk_size = 1024 * 1024
+        queue_bytes = 3 * 2 * pipeline.DEFAULT_QUEUE_DEPTH * chunk_size  # both queues full, plus copies in flight in the 3 stages; independent of payload size
+        self.assertPeak('pipeline encrypt', queue_bytes, lambda: pipeline.encrypt(hello_password, PatternFile(self.size), HashingFile(), chunk_size=chunk_size))
+        self.assertPeak('pipeline decrypt stream', queue_bytes, lambda: pipeline.decrypt(hello_password, FakeFile(self.encrypted_bytes), HashingFile(), release=pipeline.RELEASE_STREAM, chunk_size=chunk_size))
+
+    def test_segmented_random_access(self):
+        from jenc import segmented
+        filename = os.path.join(self.temp_dir, 'big.md.jenc')
+        segmented_file = segmented.SegmentedFile(filename, hello_password, mode='wb')
+        segmented_file.write(self.plaintext)
+        segmented_file.close()
+        segment_size = jenc.jenc_version_details[segmented.SEGMENTED_JENC_VERSION]['segmentSize']
+        segmented_file = segmented.SegmentedFile(filename, hello_password)
+        try:
+            segmented_file.seek(self.size // 2)
+            data = self.assertPeak('segmented read', 4 * segment_size, lambda: segmented_file.read(4096))
+        finally:
+            segmented_file.close()
+        self.assertEqual(self.plaintext[self.size // 2:self.size // 2 + 4096], data)
+
+    def test_command_line_rss(self):
+        try:
+            import resource
+        except ImportError:
+            self.skip('resource module not available on this platform')
+        if not sys.platform.startswith('linux'):
+            self.skip('ru_maxrss units are platform specific, Linux only')
+        size = min(MAX_SIZE, IN_MEMORY_MAX_SIZE)
+        encrypted_filename = os.path.join(self.temp_dir, 'big.md.jenc')
+        out_filename = os.path.join(self.temp_dir, 'big.md')
+        f = open(encrypted_filename, 'wb')
+        jenc.encrypt_stream(hello_password, PatternFile(size), f, chunk_size=1024 * 1024)
+        f.close()
+
+        def max_rss(arguments):
+            """Runs jenc.main(arguments) in a fresh interpreter, returns its peak RSS in bytes"""
+            code = 'import resource, sys, jenc; rc = jenc.main(sys.argv); sys.stderr.write("\\nmaxrss %d\\n" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss); sys.exit(rc)'
+            environment = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(jenc.__file__))] + sys.path))
+            process = subprocess.Popen([sys.executable, '-c', code] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+            stdout_bytes, stderr_bytes = process.communicate()
+            self.assertEqual(0, process.returncode, stdout_bytes + stderr_bytes)
+            return int(stderr_bytes.split(b'maxrss ')[-1]) * 1024  # Linux reports KB
+
+        baseline_rss = max_rss(['--scan', encrypted_filename])  # interpreter and imports, no payload
+        decrypt_rss = max_rss(['-d', '-p', hello_password, '-o', out_filename, encrypted_filename])
+        self.assertTrue(decrypt_rss - baseline_rss < 64 * 1024 * 1024, 'decrypt -o %d bytes grew RSS by %d bytes' % (size, decrypt_rss - baseline_rss))
+        encrypt_rss = max_rss(['-e', '-p', hello_password, '--pipeline', '-o', encrypted_filename, out_filename])
+        self.assertTrue(encrypt_rss - baseline_rss < 64 * 1024 * 1024, 'encrypt --pipeline %d bytes grew RSS by %d bytes' % (size, encrypt_rss - baseline_rss))
+
+
+class TestStressBaseline(StressUtil):
+    """Throughput (higher is better) compared with JENC_STRESS_BASELINE, recorded on the same host"""
+
+    def measure(self):
+        repeat = 5
+        size = 16 * 1024 * 1024
+        result = {}
+        cipher = bench.bench_cipher('V001', size, repeat)
+        result['cipher_encrypt_mb_per_sec'] = cipher['encrypt']['mb_per_sec_p50']
+        result['cipher_decrypt_mb_per_sec'] = cipher['decrypt']['mb_per_sec_p50']
+        operations = bench.bench_operations('V001', size, repeat)
+        result['encrypt_warm_mb_per_sec'] = operations['encrypt']['warm']['mb_per_sec_p50']
+        result['decrypt_warm_mb_per_sec'] = operations['decrypt']['warm']['mb_per_sec_p50']
+        for jenc_version in ('U001', 'V001'):
+            result['kdf_%s_per_sec' % jenc_version] = 1.0 / bench.bench_kdf(jenc_version, repeat)['p50']
+        streaming = bench.summarize(bench.time_calls(lambda: streaming_round_trip(hello_password, PatternFile(size)), repeat), size)
+        result['streaming_round_trip_mb_per_sec'] = streaming['mb_per_sec_p50']
+        return result
+
+    def host_key(self):
+        """Throughput is only comparable between runs on the same host and software"""
+        host = bench.host_details()
+        return dict((name, host[name]) for name in ('platform', 'machine', 'processor', 'cpu_count', 'python_implementation', 'jenc', 'backends'))
+
+    def test_throughput_baseline(self):
+        result = self.measure()
+        if UPDATE_BASELINE or not os.path.exists(BASELINE_FILENAME):
+            f = open(BASELINE_FILENAME, 'w')
+            f.write(json.dumps({'host': self.host_key(), 'throughput': result}, indent=4, sort_keys=True))
+            f.close()
+            self.skip('baseline recorded in %s' % BASELINE_FILENAME)
+        f = open(BASELINE_FILENAME)
+        baseline = json.loads(f.read())
+        f.close()
+        if baseline['host'] != self.host_key():
+            self.skip('baseline %s is from a different host/software, JENC_STRESS_UPDATE_BASELINE=1 to replace it' % BASELINE_FILENAME)
+        regressions = []
+        for name, baseline_value in sorted(baseline['throughput'].items()):
+            value = result.get(name)
+            if value is not None and value < baseline_value * (1.0 - REGRESSION_TOLERANCE):
+                regressions.append('%s %.1f, baseline %.1f (%.0f%%)' % (name, value, baseline_value, 100.0 * value / baseline_value))
+        self.assertEqual([], regressions, 'throughput regressions beyond %.0f%%: %s' % (100 * REGRESSION_TOLERANCE, '; '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ Sample usage:
 """
 
 import glob
+import io
 import os
 import pdb
 import sys
@@ -19,6 +20,7 @@ import tempfile
 import traceback
 
 from io import BytesIO as FakeFile  # py3
+from io import StringIO as FakeFileText  # py3
 
 try:
     if sys.version_info < (2, 3):
@@ -233,6 +235,1829 @@ class TestJencWhiteBox(TestJencUtil):
             self.check_same_input_different_crypted_text(original_plaintext, password, version=version)
 
 
+class TestJencStream(TestJencUtil):
+    password = 'geheim'  # same password used in demos for Java version https://github.com/opensource21/jpencconverter/tree/master/src/test/encrypted
+
+    def check_stream_get_what_you_put_in(self, original_plaintext, version=None, chunk_size=jenc.DEFAULT_CHUNK_SIZE):
+        encrypted_file = FakeFile()
+        jenc.encrypt_stream(self.password, FakeFile(original_plaintext), encrypted_file, jenc_version=version, chunk_size=chunk_size)
+        encrypted_bytes = encrypted_file.getvalue()
+        self.assertEqual(original_plaintext, jenc.decrypt(self.password, encrypted_bytes))
+
+        plaintext_file = FakeFile()
+        jenc.decrypt_stream(self.password, FakeFile(encrypted_bytes), plaintext_file, chunk_size=chunk_size)
+        self.assertEqual(original_plaintext, plaintext_file.getvalue())
+
+    def test_hello_world_stream_all_versions(self):
+        for version in jenc.jenc_version_details:
+            self.check_stream_get_what_you_put_in(hello_world_plaintext, version=version)
+
+    def test_small_chunks_stream(self):
+        original_plaintext = b'0123456789abcdef' * 10 + b'tail'
+        for chunk_size in (1, 7, jenc.AUTH_TAG_LENGTH, jenc.AUTH_TAG_LENGTH + 1, 1024):
+            self.check_stream_get_what_you_put_in(original_plaintext, chunk_size=chunk_size)
+
+    def test_empty_stream(self):
+        self.check_stream_get_what_you_put_in(b'')
+
+    def test_hello_world_decrypt_stream_generator(self):
+        result = b''.join(jenc.decrypt_stream_generator(hello_password, FakeFile(hello_world_v001), chunk_size=5))
+        self.assertEqual(hello_world_plaintext, result)
+
+    def test_stream_same_bytes_as_encrypt(self):
+        original_random_bytes = jenc.get_random_bytes
+        try:
+            jenc.get_random_bytes = lambda length: b'\x01' * length
+            encrypted_bytes = jenc.encrypt(self.password, hello_world_plaintext)
+            encrypted_file = FakeFile()
+            jenc.encrypt_stream(self.password, FakeFile(hello_world_plaintext), encrypted_file, chunk_size=3)
+        finally:
+            jenc.get_random_bytes = original_random_bytes
+        self.assertEqual(encrypted_bytes, encrypted_file.getvalue())
+
+    def test_hello_world_decrypt_stream_bad_bytes(self):
+        spurious_byte_offset = 126
+        bad_hello_world_v001 = hello_world_v001[:spurious_byte_offset-1] + b'\x00' + hello_world_v001[spurious_byte_offset:]
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_stream, hello_password, FakeFile(bad_hello_world_v001), FakeFile())
+
+    def test_decrypt_file_handle_errors(self):
+        bad_hello_world_v001 = hello_world_v001[:125] + b'\x00' + hello_world_v001[126:]
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_file_handle, FakeFile(bad_hello_world_v001), hello_password)
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_file_handle, FakeFile(hello_world_v001), 'bad password')
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_file_handle, FakeFile(hello_world_v001[:110]), hello_password)
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_file_handle, FakeFile(hello_world_v001[:50]), hello_password)
+        for chunk_size in (1, 17, 1024):
+            original_chunk_size = jenc.DEFAULT_CHUNK_SIZE
+            jenc.DEFAULT_CHUNK_SIZE = chunk_size
+            try:
+                self.assertEqual(hello_world_plaintext, jenc.decrypt_file_handle(FakeFile(hello_world_v001), hello_password))
+            finally:
+                jenc.DEFAULT_CHUNK_SIZE = original_chunk_size
+
+    def test_hello_world_decrypt_stream_truncated(self):
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_stream, hello_password, FakeFile(hello_world_v001[:110]), FakeFile())
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_stream, hello_password, FakeFile(hello_world_v001[:50]), FakeFile())
+
+
+class TestJencKeyCache(TestJencUtil):
+    def tearDown(self):
+        jenc.disable_key_cache()
+
+    def test_hit_miss_decrypt(self):
+        cache = jenc.enable_key_cache()
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, hello_world_v001))
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, hello_world_v001))
+        self.assertEqual(hello_world_plaintext, jenc.decrypt_file_handle(FakeFile(hello_world_v001), hello_password))
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+    def test_wrong_password_not_a_hit(self):
+        cache = jenc.enable_key_cache()
+        jenc.decrypt(hello_password, hello_world_v001)
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt, 'bad password', hello_world_v001)
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        # bytes and str passwords are cached separately
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password.encode('us-ascii'), hello_world_v001))
+        self.assertEqual((0, 3), (cache.hits, cache.misses))
+
+    def test_lru_eviction_and_clear(self):
+        cache = jenc.enable_key_cache(max_entries=2)
+        for version in ('V001', 'U001', 'V001'):
+            self.check_get_what_you_put_in(hello_world_plaintext, hello_password, version=version)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+    def test_ttl_expiry(self):
+        cache = jenc.enable_key_cache(ttl=-1)  # already expired
+        jenc.decrypt(hello_password, hello_world_v001)
+        jenc.decrypt(hello_password, hello_world_v001)
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+    def test_zeroize(self):
+        cache = jenc.DerivedKeyCache()
+        cache_key = cache.make_key(hello_password, b'salt', jenc.jenc_version_details['V001'])
+        cache.put(cache_key, b'key')
+        stored_key = cache._entries[cache_key][1]
+        self.assertEqual(b'key', cache.get(cache_key))
+        cache.zeroize()
+        self.assertEqual(bytearray(3), stored_key)
+        self.assertEqual(None, cache.get(cache_key))
+
+
+    def test_contains_does_not_count(self):
+        cache = jenc.DerivedKeyCache()
+        cache_key = cache.make_key(hello_password, b'salt', jenc.jenc_version_details['V001'])
+        self.assertFalse(cache.contains(cache_key))
+        cache.put(cache_key, b'key')
+        self.assertTrue(cache.contains(cache_key))
+        self.assertEqual((0, 0), (cache.hits, cache.misses))
+        cache = jenc.DerivedKeyCache(ttl=-1)  # already expired
+        cache.put(cache_key, b'key')
+        self.assertFalse(cache.contains(cache_key))
+
+class TestJencSession(TestJencUtil):
+    def test_session_decrypts_with_stock_decrypt_all_versions(self):
+        for version in jenc.jenc_version_details:
+            session = jenc.JencSession(hello_password, jenc_version=version)
+            encrypted_bytes1 = session.encrypt(hello_world_plaintext)
+            encrypted_bytes2 = session.encrypt(hello_world_plaintext)
+            self.assertEqual(version.encode('us-ascii'), encrypted_bytes1[:4])
+            self.assertNotEqual(encrypted_bytes1, encrypted_bytes2)
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, encrypted_bytes1))
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, encrypted_bytes2))
+            self.assertEqual(1, session.key_derivation_count)
+
+    def test_session_salt_rotation_max_files(self):
+        session = jenc.JencSession(hello_password, max_files=2)
+        salts = set()
+        for x in range(5):
+            encrypted_bytes = session.encrypt(hello_world_plaintext)
+            salts.add(encrypted_bytes[4 + 32:4 + 32 + 64])
+        self.assertEqual(3, session.key_derivation_count)
+        self.assertEqual(3, len(salts))
+
+    def test_session_salt_rotation_max_bytes(self):
+        session = jenc.JencSession(hello_password, max_files=None, max_bytes=len(hello_world_plaintext) * 2)
+        for x in range(3):
+            session.encrypt(hello_world_plaintext)
+        self.assertEqual(2, session.key_derivation_count)
+
+    def test_session_encrypt_stream(self):
+        with jenc.JencSession(hello_password) as session:
+            encrypted_file = FakeFile()
+            session.encrypt_stream(FakeFile(hello_world_plaintext), encrypted_file, chunk_size=3)
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, encrypted_file.getvalue()))
+        self.assertEqual(None, session._derived_key)
+
+
+class TestJencCommandLineMultiFile(TestJencUtil):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.expected = {}
+        for filename in ('one.md', 'two.txt', os.path.join('sub', 'three.md')):
+            full_path = os.path.join(self.temp_dir, filename)
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            f = open(full_path, 'wb')
+            f.write(filename.encode('us-ascii') * 100)
+            f.close()
+            self.expected[full_path] = filename.encode('us-ascii') * 100
+        self.stderr = sys.stderr
+        sys.stderr = FakeFileText()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.temp_dir)
+
+    def check_round_trip(self, extra_args):
+        self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password] + extra_args + [self.temp_dir]))
+        for filename in self.expected:
+            self.assertTrue(os.path.exists(filename + '.jenc'))
+            os.remove(filename)
+        self.assertEqual(0, jenc.main(['jenc', '-d', '-p', hello_password] + extra_args + [self.temp_dir]))
+        for filename, plaintext in self.expected.items():
+            f = open(filename, 'rb')
+            self.assertEqual(plaintext, f.read())
+            f.close()
+
+    def test_directory_recursive_one_job(self):
+        self.check_round_trip(['-r', '--jobs', '1'])
+
+    def test_directory_recursive_process_pool(self):
+        self.check_round_trip(['-r', '--jobs', '2'])
+
+    def test_stats_process_pool(self):
+        self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password, '-r', '--jobs', '2', '--stats', self.temp_dir]))
+        self.assertTrue('encrypt_file V001: 3 ops, 0 errors' in sys.stderr.getvalue(), sys.stderr.getvalue())
+        self.assertEqual(None, jenc.metrics.collector)
+
+    def test_not_recursive(self):
+        self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password, '--jobs', '1', self.temp_dir]))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'sub', 'three.md.jenc')))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'one.md.jenc')))
+
+    def test_failures_reported_existing_output_not_overwritten(self):
+        filenames = sorted(self.expected)
+        self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password, '--jobs', '1'] + filenames))
+        self.assertEqual(1, jenc.main(['jenc', '-e', '-p', hello_password, '--jobs', '1'] + filenames))
+        self.assertTrue('3 failed' in sys.stderr.getvalue())
+        # wrong password, no partial output left behind
+        for filename in filenames:
+            os.remove(filename)
+        self.assertEqual(1, jenc.main(['jenc', '-d', '-p', 'bad password', '--jobs', '1', self.temp_dir]))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'one.md')))
+        self.assertEqual(['one.md.jenc', 'sub', 'two.txt.jenc'], sorted(os.listdir(self.temp_dir)))  # no temporary files either
+
+    def test_output_created_while_writing_not_overwritten(self):
+        out_filename = os.path.join(self.temp_dir, 'new.md')
+        out_file = jenc.AtomicFileWriter(out_filename, overwrite=False)
+        out_file.write(b'ours')
+        f = open(out_filename, 'wb')  # e.g. another worker with an overlapping input
+        f.write(b'theirs')
+        f.close()
+        self.assertRaises(jenc.JencException, out_file.commit)
+        f = open(out_filename, 'rb')
+        self.assertEqual(b'theirs', f.read())
+        f.close()
+        self.assertFalse(os.path.exists(out_file.temp_filename))
+        os.remove(out_filename)
+        out_file = jenc.AtomicFileWriter(out_filename, overwrite=False)
+        out_file.write(b'ours')
+        out_file.commit()
+        f = open(out_filename, 'rb')
+        self.assertEqual(b'ours', f.read())
+        f.close()
+        self.assertFalse(os.path.exists(out_file.temp_filename))
+
+
+class TestJencAio(TestJencUtil):
+    def setUp(self):
+        try:
+            import asyncio
+            import jenc.aio
+        except (ImportError, SyntaxError):
+            self.skip('asyncio not available')
+        self.asyncio = asyncio
+
+    def test_hello_world_round_trip(self):
+        async def round_trip():
+            encrypted_bytes = await jenc.aio.encrypt(hello_password, hello_world_plaintext)
+            return await jenc.aio.decrypt(hello_password, encrypted_bytes)
+        self.assertEqual(hello_world_plaintext, self.asyncio.run(round_trip()))
+
+    def test_concurrent_decrypts_limited(self):
+        jenc.aio.configure(max_concurrency=2)
+        async def many():
+            return await self.asyncio.gather(*[jenc.aio.decrypt(hello_password, hello_world_v001) for x in range(5)])
+        try:
+            self.assertEqual([hello_world_plaintext] * 5, self.asyncio.run(many()))
+        finally:
+            jenc.aio.configure()
+
+    def test_configure_executor_lifecycle(self):
+        import concurrent.futures
+        try:
+            jenc.aio.configure(max_concurrency=2)
+            self.assertEqual(hello_world_plaintext, self.asyncio.run(jenc.aio.decrypt(hello_password, hello_world_v001)))
+            old_executor = jenc.aio._get_executor()
+            self.assertEqual(2, old_executor._max_workers)
+            jenc.aio.configure(max_concurrency=2)
+            self.assertTrue(old_executor is jenc.aio._get_executor())  # unchanged, kept
+            jenc.aio.configure(max_concurrency=3)
+            self.assertTrue(old_executor._shutdown)  # threads released
+            new_executor = jenc.aio._get_executor()
+            self.assertEqual(3, new_executor._max_workers)
+            custom_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            jenc.aio.configure(executor=custom_executor)
+            self.assertTrue(new_executor._shutdown)
+            self.assertTrue(custom_executor is jenc.aio._get_executor())
+            self.assertEqual(hello_world_plaintext, self.asyncio.run(jenc.aio.decrypt(hello_password, hello_world_v001)))
+            jenc.aio.configure()
+            self.assertFalse(custom_executor._shutdown)  # caller owned
+            custom_executor.shutdown()
+        finally:
+            jenc.aio.configure()
+
+    def test_decrypt_wrong_password(self):
+        self.assertRaises(jenc.JencDecryptError, self.asyncio.run, jenc.aio.decrypt('bad password', hello_world_v001))
+
+    def test_files(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            plaintext_filename = os.path.join(temp_dir, 'hello.md')
+            encrypted_filename = plaintext_filename + '.jenc'
+            f = open(plaintext_filename, 'wb')
+            f.write(hello_world_plaintext)
+            f.close()
+            async def round_trip():
+                await jenc.aio.encrypt_file(hello_password, plaintext_filename, encrypted_filename)
+                await jenc.aio.decrypt_file(hello_password, encrypted_filename, plaintext_filename + '.copy')
+                return await jenc.aio.decrypt_file(hello_password, encrypted_filename)
+            self.assertEqual(hello_world_plaintext, self.asyncio.run(round_trip()))
+            f = open(plaintext_filename + '.copy', 'rb')
+            self.assertEqual(hello_world_plaintext, f.read())
+            f.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_decrypt_file_tampered(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            encrypted_filename = os.path.join(temp_dir, 'hello.md.jenc')
+            out_filename = os.path.join(temp_dir, 'hello.md')
+            f = open(encrypted_filename, 'wb')
+            f.write(hello_world_v001[:-1] + bytes(bytearray([hello_world_v001[-1] ^ 0xff])))
+            f.close()
+            self.assertRaises(jenc.JencDecryptError, self.asyncio.run, jenc.aio.decrypt_file(hello_password, encrypted_filename))
+            self.assertRaises(jenc.JencDecryptError, self.asyncio.run, jenc.aio.decrypt_file(hello_password, encrypted_filename, out_filename))
+            self.assertEqual(['hello.md.jenc'], os.listdir(temp_dir))  # no unauthenticated plaintext left behind
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestJencBuffers(TestJencUtil):
+    def test_decrypt_buffer_types(self):
+        for buffer_type in (bytearray, memoryview):
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, buffer_type(hello_world_v001)))
+
+    def test_encrypt_buffer_types(self):
+        for buffer_type in (bytearray, memoryview):
+            encrypted_bytes = jenc.encrypt(hello_password, buffer_type(hello_world_plaintext))
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+
+    def test_decrypt_mmap(self):
+        import mmap
+        temp_file = tempfile.TemporaryFile()
+        try:
+            temp_file.write(hello_world_v001)
+            temp_file.flush()
+            mapped_file = mmap.mmap(temp_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, mapped_file))
+            mapped_file.close()
+        finally:
+            temp_file.close()
+
+    def test_decrypt_into(self):
+        self.assertEqual(len(hello_world_plaintext), jenc.decrypted_length(hello_world_v001))
+        out_buffer = bytearray(100)
+        self.assertEqual(len(hello_world_plaintext), jenc.decrypt_into(hello_password, memoryview(hello_world_v001), out_buffer))
+        self.assertEqual(hello_world_plaintext, out_buffer[:len(hello_world_plaintext)])
+        self.assertEqual(bytearray(100 - len(hello_world_plaintext)), out_buffer[len(hello_world_plaintext):])
+
+    def test_decrypt_into_wrong_password_zeroed(self):
+        out_buffer = bytearray(len(hello_world_plaintext))
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt_into, 'bad password', hello_world_v001, out_buffer)
+        self.assertEqual(bytearray(len(hello_world_plaintext)), out_buffer)
+
+    def test_buffer_too_small(self):
+        self.assertRaises(jenc.JencException, jenc.decrypt_into, hello_password, hello_world_v001, bytearray(2))
+        self.assertRaises(jenc.JencException, jenc.encrypt_into, hello_password, hello_world_plaintext, bytearray(2))
+
+    def test_encrypt_into_all_versions(self):
+        for version in jenc.jenc_version_details:
+            if jenc.jenc_version_details[version]['cipher'] == jenc.JENC_AES_GCM_COMPRESSED:
+                self.assertRaises(jenc.UnsupportedMetaData, jenc.encrypted_length, len(hello_world_plaintext), jenc_version=version)  # length not known in advance
+                continue
+            out_buffer = bytearray(jenc.encrypted_length(len(hello_world_plaintext), jenc_version=version) + 10)
+            length = jenc.encrypt_into(hello_password, hello_world_plaintext, out_buffer, jenc_version=version)
+            self.assertEqual(len(out_buffer) - 10, length)
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, memoryview(out_buffer)[:length]))
+
+    def test_encrypt_into_same_bytes_as_encrypt(self):
+        original_random_bytes = jenc.get_random_bytes
+        try:
+            jenc.get_random_bytes = lambda length: b'\x01' * length
+            encrypted_bytes = jenc.encrypt(hello_password, hello_world_plaintext)
+            out_buffer = bytearray(len(encrypted_bytes))
+            jenc.encrypt_into(hello_password, hello_world_plaintext, out_buffer)
+        finally:
+            jenc.get_random_bytes = original_random_bytes
+        self.assertEqual(encrypted_bytes, out_buffer)
+
+    def test_truncated(self):
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt, hello_password, hello_world_v001[:110])
+
+
+class TestJencInspect(TestJencUtil):
+    def test_inspect_bytes(self):
+        header = jenc.inspect(hello_world_v001)
+        self.assertTrue(header.valid)
+        self.assertEqual('V001', header.jenc_version)
+        self.assertEqual(hello_world_v001[4:36], header.nonce_bytes)
+        self.assertEqual(hello_world_v001[36:100], header.salt_bytes)
+        self.assertEqual(len(hello_world_plaintext), header.content_length)
+        self.assertFalse(hasattr(header, '__dict__'))
+
+    def test_inspect_invalid(self):
+        header = jenc.inspect(b'AAAA' + hello_world_v001[4:])
+        self.assertFalse(header.valid)
+        self.assertEqual(None, header.jenc_version)
+        header = jenc.inspect(hello_world_v001[:50])
+        self.assertFalse(header.valid)
+        self.assertEqual('truncated header', header.error)
+        header = jenc.inspect(hello_world_v001[:110])
+        self.assertFalse(header.valid)
+        self.assertEqual('V001', header.jenc_version)
+
+
+class TestJencBench(TestJencUtil):
+    def test_run_benchmarks_json(self):
+        import json
+        import jenc.bench
+        result = jenc.bench.run_benchmarks(sizes=[100], repeat=1, versions=['V001'])
+        result = json.loads(json.dumps(result))
+        self.assertTrue(result['kdf']['V001']['p50'] > 0)
+        self.assertEqual(100, result['cipher']['V001']['100']['encrypt']['bytes'])
+        for name in ('encrypt', 'decrypt', 'decrypt_file_handle'):
+            self.assertEqual(set(['cold', 'warm']), set(result['operations']['V001']['100'][name]))
+        self.assertEqual(None, jenc.derived_key_cache)
+        self.assertTrue(result['tracing']['V001']['100']['tracing_off_ratio'] > 0)
+        self.assertFalse(jenc.tracing.enabled)
+
+    def test_parse_size(self):
+        import jenc.bench
+        self.assertEqual([100, 1024, 10 * 1024 * 1024, 1024 ** 3], [jenc.bench.parse_size(x) for x in ('100', '1K', '10m', '1G')])
+
+
+class TestJencTracing(TestJencUtil):
+    def setUp(self):
+        import logging
+
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.messages = []
+
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+
+        self.handler = ListHandler()
+        jenc.tracing.log.addHandler(self.handler)
+
+    def tearDown(self):
+        jenc.tracing.log.removeHandler(self.handler)
+        jenc.tracing.disable_tracing()
+
+    def test_tracing_off(self):
+        self.assertFalse(jenc.tracing.enabled)
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, hello_world_v001))
+        self.assertEqual([], self.handler.messages)
+
+    def test_tracing_redact_truncate(self):
+        jenc.tracing.enable_tracing(max_bytes=4)
+        plaintext_bytes = b'secret plaintext ' * 10
+        encrypted_bytes = jenc.encrypt(hello_password, plaintext_bytes)
+        self.assertEqual(plaintext_bytes, jenc.decrypt_file_handle(FakeFile(encrypted_bytes), hello_password))
+        self.assertEqual(plaintext_bytes, jenc.decrypt(hello_password, encrypted_bytes))
+        messages = '\n'.join(self.handler.messages)
+        self.assertTrue('nonce=<32 bytes %s...>' % encrypted_bytes[4:8].hex() in messages, messages)
+        self.assertTrue('plaintext=<redacted 170 bytes>' in messages)
+        self.assertTrue('password=<redacted 6 bytes>' in messages)
+        self.assertTrue('derived_key=<redacted 32 bytes>' in messages)
+        self.assertFalse(hello_password in messages)
+        self.assertFalse('secret' in messages)
+        self.assertEqual(8, len(self.handler.messages))  # header and cipher for encrypt, plus done for each decrypt
+
+
+class TestJencBackends(TestJencUtil):
+    def setUp(self):
+        import jenc.backends
+        self.original_active = dict(jenc.backends._active)
+
+    def tearDown(self):
+        jenc.backends._active.update(self.original_active)
+
+    def test_kdf_backends_same_key(self):
+        available = jenc.backends.available_backends()['kdf']
+        self.assertTrue('pycryptodome' in available)
+        for hash_name in (jenc.backends.KDF_SHA1, jenc.backends.KDF_SHA512):
+            results = set()
+            for name in available:
+                derive_function = jenc.backends.kdf_backends[name][0]
+                results.add(derive_function(b'geheim', b'salt' * 16, 32, 100, hash_name))
+            self.assertEqual(1, len(results))
+
+    def test_all_backend_combinations(self):
+        available = jenc.backends.available_backends()
+        for kdf_name in available['kdf']:
+            for cipher_name in available['cipher']:
+                jenc.backends.set_backend(kdf=kdf_name, cipher=cipher_name)
+                self.assertEqual({'kdf': kdf_name, 'cipher': cipher_name}, jenc.backends.active_backends())
+                self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, hello_world_v001))
+                for version in jenc.jenc_version_details:
+                    self.check_get_what_you_put_in(hello_world_plaintext, hello_password, version=version)
+                    self.assertRaises(jenc.JencDecryptError, self.check_get_what_you_put_in, hello_world_plaintext, hello_password, version=version, decrypt_password='bad password')
+
+    def test_auto_select_and_env_override(self):
+        jenc.backends.reset_backends()
+        active = jenc.backends.active_backends()
+        self.assertTrue(active['kdf'] in jenc.backends.available_backends()['kdf'])
+        jenc.backends.reset_backends()
+        os.environ['JENC_KDF_BACKEND'] = 'pycryptodome'
+        try:
+            self.assertEqual('pycryptodome', jenc.backends.active_backends()['kdf'])
+        finally:
+            del os.environ['JENC_KDF_BACKEND']
+
+    def test_unknown_backend(self):
+        self.assertRaises(jenc.backends.BackendNotAvailable, jenc.backends.set_backend, kdf='does not exist')
+
+    def test_cryptography_into_zero_copy(self):
+        import tracemalloc
+        if 'cryptography' not in jenc.backends.available_backends()['cipher']:
+            self.skip('cryptography not installed')
+        jenc.backends.set_backend(cipher='cryptography')
+        for plaintext_length in (0, 1, 15, 16, 17, 31, 1000):
+            plaintext_bytes = os.urandom(plaintext_length)
+            out_buffer = bytearray(jenc.encrypted_length(plaintext_length) + 3)  # larger than needed
+            total_length = jenc.encrypt_into(hello_password, plaintext_bytes, out_buffer)
+            self.assertEqual(plaintext_bytes, jenc.decrypt(hello_password, out_buffer[:total_length]))
+            plaintext_buffer = bytearray(plaintext_length + 3)
+            self.assertEqual(plaintext_length, jenc.decrypt_into(hello_password, memoryview(out_buffer)[:total_length], plaintext_buffer))
+            self.assertEqual(plaintext_bytes, bytes(plaintext_buffer[:plaintext_length]))
+        cipher = jenc.backends.new_aes_gcm(b'k' * 32, b'n' * 12)
+        self.assertRaises(ValueError, cipher.encrypt, b'x' * 20, output=bytearray(19))
+        # output= must not make a full size copy (update() did, then copied into output)
+        payload_size = 4 * 1024 * 1024
+        plaintext_bytes = bytes(payload_size)
+        encrypted_bytes = bytearray(jenc.encrypted_length(payload_size))
+        plaintext_buffer = bytearray(payload_size)
+        tracemalloc.start()
+        try:
+            jenc.encrypt_into(hello_password, plaintext_bytes, encrypted_bytes)
+            jenc.decrypt_into(hello_password, encrypted_bytes, plaintext_buffer)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(peak < payload_size // 4, peak)
+        self.assertEqual(plaintext_bytes, bytes(plaintext_buffer))
+
+
+class TestJencImport(TestJencUtil):
+    import_time_budget = 0.150  # in seconds, cumulative time for `import jenc` (including compile if no .pyc) - generous to avoid flaky failures on slow machines
+
+    def run_python(self, code, *python_options):
+        import subprocess
+        package_dir = os.path.dirname(os.path.dirname(jenc.__file__))
+        process = subprocess.Popen([sys.executable] + list(python_options) + ['-c', code], cwd=package_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout_bytes, stderr_bytes = process.communicate()
+        self.assertEqual(0, process.returncode, stderr_bytes)
+        return stdout_bytes.decode('utf-8'), stderr_bytes.decode('utf-8')
+
+    def test_lazy_imports(self):
+        stdout_str, stderr_str = self.run_python('import sys, logging, jenc; print(sorted(m for m in ("Crypto", "cryptography", "optparse", "getpass", "multiprocessing", "mmap", "hashlib") if m in sys.modules)); print(logging.getLogger("jenc").handlers)')
+        loaded_modules, handlers = stdout_str.splitlines()
+        self.assertEqual('[]', loaded_modules)
+        self.assertTrue('StreamHandler' not in handlers, handlers)
+
+    def test_setup_logging_once(self):  # main() calls setup_logging() on every call
+        stdout_str, stderr_str = self.run_python('import logging, jenc; jenc.setup_logging(); jenc.setup_logging(); jenc.setup_logging(); print(len([h for h in logging.getLogger("jenc").handlers if type(h) is logging.StreamHandler]))')
+        self.assertEqual('1', stdout_str.splitlines()[-1])
+
+    def test_import_time_budget(self):
+        if sys.version_info < (3, 7):
+            self.skip('-X importtime requires Python 3.7+')
+        stdout_str, stderr_str = self.run_python('import jenc', '-X', 'importtime')
+        # format: "import time: self [us] | cumulative | imported package"
+        jenc_lines = [line for line in stderr_str.splitlines() if line.split('|')[-1].strip() == 'jenc']
+        self.assertEqual(1, len(jenc_lines), stderr_str)
+        cumulative_us = int(jenc_lines[0].split('|')[1])
+        self.assertTrue(cumulative_us / 1000000.0 < self.import_time_budget, 'import jenc took %d us' % cumulative_us)
+
+
+class TestJencMetrics(TestJencUtil):
+    def setUp(self):
+        import jenc.metrics
+        self.results = []
+        jenc.metrics.add_hook(self.results.append)
+
+    def tearDown(self):
+        jenc.metrics.remove_hook(self.results.append)
+        jenc.metrics.disable_metrics()
+
+    def test_decrypt_phases(self):
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, hello_world_v001))
+        self.assertEqual(1, len(self.results))
+        stats = self.results[0]
+        self.assertEqual('decrypt', stats.operation)
+        self.assertEqual('V001', stats.jenc_version)
+        self.assertEqual(set(['parse', 'kdf', 'cipher', 'verify']), set(stats.phases))
+        self.assertEqual((len(hello_world_v001), len(hello_world_plaintext)), (stats.bytes_in, stats.bytes_out))
+        self.assertTrue(stats.duration >= sum(stats.phases.values()))
+        self.assertEqual(None, stats.error)
+
+    def test_nested_calls_single_operation(self):
+        file_object = FakeFile()
+        jenc.encrypt_file_handle(file_object, hello_password, hello_world_plaintext, jenc_version='U001')
+        file_object.seek(0)
+        self.assertEqual(hello_world_plaintext, jenc.decrypt_file_handle(file_object, hello_password))
+        self.assertEqual(['encrypt_file_handle', 'decrypt_file_handle'], [stats.operation for stats in self.results])
+        self.assertEqual(['U001', 'U001'], [stats.jenc_version for stats in self.results])
+        self.assertTrue('write' in self.results[0].phases)
+        self.assertTrue('read' in self.results[1].phases)
+
+    def test_stream_generator(self):
+        encrypted_bytes = b''.join(jenc.encrypt_stream_generator(hello_password, FakeFile(hello_world_plaintext), chunk_size=3))
+        self.assertEqual(['encrypt_stream'], [stats.operation for stats in self.results])
+        self.assertEqual((len(hello_world_plaintext), len(encrypted_bytes)), (self.results[0].bytes_in, self.results[0].bytes_out))
+        out_file = FakeFile()
+        jenc.decrypt_stream(hello_password, FakeFile(encrypted_bytes), out_file, chunk_size=3)
+        self.assertEqual(2, len(self.results))
+        self.assertEqual(set(['parse', 'kdf', 'read', 'cipher', 'verify', 'write']), set(self.results[1].phases))
+
+    def test_errors_and_collector(self):
+        collector = jenc.metrics.enable_metrics()
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt, 'bad password', hello_world_v001)
+        self.assertTrue('JencDecryptError' in self.results[0].error)
+        jenc.decrypt(hello_password, hello_world_v001)
+        result = collector.as_dict()['operations']
+        self.assertEqual(1, len(result))
+        self.assertEqual((2, 1), (result[0]['count'], result[0]['errors']))
+        self.assertTrue('"operation": "decrypt"' in collector.to_json())
+        prometheus_text = collector.to_prometheus()
+        self.assertTrue('jenc_operations_total{operation="decrypt",jenc_version="V001"} 2' in prometheus_text, prometheus_text)
+        self.assertTrue('jenc_phase_seconds_total{operation="decrypt",jenc_version="V001",phase="kdf"}' in prometheus_text)
+
+    def test_disabled(self):
+        jenc.metrics.remove_hook(self.results.append)
+        try:
+            self.assertTrue(jenc.metrics.current() is jenc.metrics._null_operation)
+            jenc.decrypt(hello_password, hello_world_v001)
+            self.assertEqual([], self.results)
+        finally:
+            jenc.metrics.add_hook(self.results.append)
+
+
+class TestJencRewrite(TestJencUtil):
+    def setUp(self):
+        import jenc.rewrite
+        self.temp_dir = tempfile.mkdtemp()
+        self.expected = {}
+        for filename in ('one.md', os.path.join('sub', 'two.md')):
+            full_path = os.path.join(self.temp_dir, filename + '.jenc')
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            f = open(full_path, 'wb')
+            jenc.encrypt_file_handle(f, hello_password, filename.encode('us-ascii') * 100, jenc_version='U001')
+            f.close()
+            self.expected[full_path] = filename.encode('us-ascii') * 100
+        self.stderr = sys.stderr
+        sys.stderr = FakeFileText()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.temp_dir)
+
+    def check_files(self, password, jenc_version):
+        for filename, plaintext in self.expected.items():
+            self.assertEqual(jenc_version, jenc.inspect(filename).jenc_version)
+            f = open(filename, 'rb')
+            self.assertEqual(plaintext, jenc.decrypt_file_handle(f, password))
+            f.close()
+        self.assertEqual([], [x for x in os.listdir(self.temp_dir) if x.endswith('.tmp')])
+
+    def test_migrate_command_line(self):
+        self.assertEqual(0, jenc.main(['jenc', '-p', hello_password, '--migrate-to', 'V001', '-r', '--jobs', '1', self.temp_dir]))
+        self.check_files(hello_password, 'V001')
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, jenc.rewrite.JOURNAL_FILENAME)))
+        # already migrated, header check only so any password works
+        self.assertEqual(0, jenc.main(['jenc', '-p', 'wrong password', '--migrate-to', 'V001', '-r', '--jobs', '1', self.temp_dir]))
+        self.assertTrue('0 rewritten, 2 skipped, 0 failed' in sys.stderr.getvalue())
+
+    def test_rekey_process_pool(self):
+        filenames = sorted(self.expected)
+        self.assertEqual(0, jenc.rewrite.rewrite_files(hello_password, filenames, new_password='new password', jobs=2))
+        self.check_files('new password', 'U001')
+        # re-run (e.g. after a crash before the journal was written) skips files that decrypt with the new password
+        self.assertEqual(0, jenc.rewrite.rewrite_files(hello_password, filenames, new_password='new password', jobs=1))
+        self.check_files('new password', 'U001')
+
+    def test_rekey_journal_resume(self):
+        filenames = sorted(self.expected)
+        journal_filename = os.path.join(self.temp_dir, jenc.rewrite.JOURNAL_FILENAME)
+        journal = jenc.rewrite.Journal(journal_filename, {'rekey': True, 'jenc_version': 'V001'})
+        journal.record(filenames[0])
+        journal.close()
+        self.assertEqual(0, jenc.rewrite.rewrite_files(hello_password, filenames, new_password='new password', jenc_version='V001', jobs=1, journal_filename=journal_filename))
+        self.assertEqual('U001', jenc.inspect(filenames[0]).jenc_version)  # recorded as completed, not touched
+        self.assertEqual('V001', jenc.inspect(filenames[1]).jenc_version)
+        self.assertFalse(os.path.exists(journal_filename))
+
+    def test_wrong_password_untouched(self):
+        filename = sorted(self.expected)[0]
+        f = open(filename, 'rb')
+        original_bytes = f.read()
+        f.close()
+        journal_filename = os.path.join(self.temp_dir, jenc.rewrite.JOURNAL_FILENAME)
+        self.assertEqual(1, jenc.rewrite.rewrite_files('bad password', [filename], new_password='new password', jobs=1, journal_filename=journal_filename))
+        f = open(filename, 'rb')
+        self.assertEqual(original_bytes, f.read())
+        f.close()
+        self.assertTrue(os.path.exists(journal_filename))  # kept for resume
+        self.check_files(hello_password, 'U001')
+
+    def test_atomic_file_writer_abort(self):
+        filename = sorted(self.expected)[0]
+        try:
+            with jenc.AtomicFileWriter(filename) as out_file:
+                out_file.write(b'partial')
+                raise ValueError('simulated failure')
+        except ValueError:
+            pass
+        self.check_files(hello_password, 'U001')
+
+
+class TestJencAgent(TestJencUtil):
+    def setUp(self):
+        import socket
+        import threading
+        import jenc.agent
+        if not hasattr(socket, 'AF_UNIX'):
+            self.skip('Unix domain sockets not supported on this platform')
+        self.temp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.temp_dir, 'agent.sock')
+        self.agent = jenc.agent.JencAgent(hello_password, socket_path=self.socket_path, ttl=60)
+        self.agent.bind()
+        self.thread = threading.Thread(target=self.agent.serve_forever)
+        self.thread.start()
+        self.client = jenc.agent.AgentClient(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.agent.stop()
+        self.thread.join()
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        self.assertEqual(hello_world_plaintext, self.client.decrypt(hello_world_v001))
+        for version in (None, 'U001', 'V001'):
+            encrypted_bytes = self.client.encrypt(hello_world_plaintext, jenc_version=version)
+            self.assertEqual((version or jenc.DEFAULT_JENC_VERSION).encode('us-ascii'), encrypted_bytes[:4])
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+            self.assertEqual(hello_world_plaintext, self.client.decrypt(encrypted_bytes))
+        self.assertRaises(jenc.UnsupportedMetaData, self.client.encrypt, b'x', jenc_version='X001')
+
+    def test_pipelined_and_key_cache(self):
+        tampered = hello_world_v001[:-1] + b'\x00'
+        results = self.client.decrypt_many([hello_world_v001, tampered, hello_world_v001] * 20, window=4)
+        self.assertEqual(60, len(results))
+        self.assertEqual(hello_world_plaintext, results[0])
+        self.assertTrue(isinstance(results[1], jenc.JencDecryptError))
+        self.assertEqual(hello_world_plaintext, results[-1])
+        self.assertEqual(1, self.client.status()['key_cache']['misses'])  # one PBKDF2 for the shared salt
+        encrypted = self.client.encrypt_many([b'one', b'two'])
+        self.assertEqual([b'one', b'two'], [jenc.decrypt(hello_password, x) for x in encrypted])
+
+    def test_command_line_uses_agent(self):
+        in_filename = os.path.join(self.temp_dir, 'in.md.jenc')
+        out_filename = os.path.join(self.temp_dir, 'out.md')
+        f = open(in_filename, 'wb')
+        f.write(hello_world_v001)
+        f.close()
+        saved_environ = dict(os.environ)
+        stderr = sys.stderr
+        sys.stderr = FakeFileText()
+        try:
+            os.environ.pop('JENC_PASSWORD', None)
+            os.environ['JENC_AGENT_SOCK'] = self.socket_path
+            self.assertEqual(0, jenc.main(['jenc', '-o', out_filename, in_filename]))
+        finally:
+            sys.stderr = stderr
+            os.environ.clear()
+            os.environ.update(saved_environ)
+        f = open(out_filename, 'rb')
+        self.assertEqual(hello_world_plaintext, f.read())
+        f.close()
+
+    def test_frames_allocated_as_data_arrives(self):
+        import socket
+        import tracemalloc
+        original_allocation = jenc.agent.INITIAL_FRAME_ALLOCATION
+        jenc.agent.INITIAL_FRAME_ALLOCATION = 1000
+        try:
+            plaintext_bytes = os.urandom(100 * 1000 + 7)  # buffer grows several times
+            self.assertEqual(plaintext_bytes, self.client.decrypt(self.client.encrypt(plaintext_bytes)))
+        finally:
+            jenc.agent.INITIAL_FRAME_ALLOCATION = original_allocation
+        sender, receiver = socket.socketpair()
+        try:
+            sender.sendall(jenc.agent._length_struct.pack(jenc.agent.MAX_FRAME_LENGTH) + b'x' * 10)
+            sender.close()
+            tracemalloc.start()
+            try:
+                self.assertRaises(jenc.agent.AgentError, jenc.agent._recv_frame, receiver)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertTrue(peak < 4 * jenc.agent.INITIAL_FRAME_ALLOCATION, peak)  # not MAX_FRAME_LENGTH
+        finally:
+            receiver.close()
+
+    def test_request_count_threads(self):
+        import threading
+        def worker():
+            client = jenc.agent.AgentClient(self.socket_path)
+            try:
+                for x in range(25):
+                    client.status()
+            finally:
+                client.close()
+        threads = [threading.Thread(target=worker) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(101, self.client.status()['requests'])  # counted before the status is built
+
+    def test_socket_directory_checks(self):
+        if not hasattr(os, 'getuid'):
+            self.skip('no POSIX permissions')
+        shared_dir = os.path.join(self.temp_dir, 'shared')
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0o777)  # e.g. created first by another user
+        socket_path = os.path.join(shared_dir, 'agent.sock')
+        self.assertRaises(jenc.agent.AgentError, jenc.agent.JencAgent(hello_password, socket_path=socket_path).bind)
+        self.assertRaises(jenc.agent.AgentError, jenc.agent.AgentClient, socket_path)
+        os.chmod(shared_dir, 0o700)
+        link_dir = os.path.join(self.temp_dir, 'link')
+        os.symlink(shared_dir, link_dir)
+        self.assertRaises(jenc.agent.AgentError, jenc.agent.JencAgent(hello_password, socket_path=os.path.join(link_dir, 'agent.sock')).bind)
+        self.assertRaises(jenc.agent.AgentError, jenc.agent.AgentClient, os.path.join(link_dir, 'agent.sock'))
+        new_dir = os.path.join(self.temp_dir, 'new')
+        agent = jenc.agent.JencAgent(hello_password, socket_path=os.path.join(new_dir, 'agent.sock'))
+        agent.bind()  # missing directory is created private
+        agent.close()
+        self.assertEqual(0o700, os.stat(new_dir).st_mode & 0o777)
+
+    def test_default_socket_path(self):
+        saved_environ = dict(os.environ)
+        try:
+            os.environ.pop('JENC_AGENT_SOCK', None)
+            os.environ['XDG_RUNTIME_DIR'] = self.temp_dir
+            self.assertEqual(os.path.join(self.temp_dir, 'jenc', 'agent.sock'), jenc.agent.default_socket_path())
+            os.environ['JENC_AGENT_SOCK'] = self.socket_path
+            self.assertEqual(self.socket_path, jenc.agent.default_socket_path())
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+    def test_stop(self):
+        self.client.stop_agent()
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertEqual(None, self.agent.password)
+
+
+class TestJencVault(TestJencUtil):
+    def setUp(self):
+        import jenc.vault
+        self.temp_dir = tempfile.mkdtemp()
+        self.vault = jenc.vault.JencVault(self.temp_dir, hello_password)
+
+    def tearDown(self):
+        self.vault.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_put_get(self):
+        self.vault.put('sub/note.md', hello_world_plaintext)
+        f = open(os.path.join(self.temp_dir, 'sub', 'note.md.jenc'), 'rb')
+        self.assertEqual(hello_world_plaintext, jenc.decrypt_file_handle(f, hello_password))
+        f.close()
+        self.assertEqual(['sub/note.md'], list(self.vault))
+        self.assertTrue('sub/note.md' in self.vault)
+        self.assertEqual(hello_world_plaintext, self.vault['sub/note.md'])
+        self.assertEqual(hello_world_plaintext, self.vault.get('sub/note.md'))
+        self.assertEqual((2, 0), (self.vault.hits, self.vault.misses))  # write-through
+        self.assertEqual(None, self.vault.get('missing.md'))
+        self.assertRaises(KeyError, self.vault.__getitem__, '../outside.md')
+        del self.vault['sub/note.md']
+        self.assertEqual(0, len(self.vault))
+
+    def test_external_change_invalidates(self):
+        self.vault['note.md'] = b'version one'
+        self.assertEqual(b'version one', self.vault['note.md'])
+        f = open(os.path.join(self.temp_dir, 'note.md.jenc'), 'wb')  # e.g. edited in Markor
+        jenc.encrypt_file_handle(f, hello_password, b'version two, longer')
+        f.close()
+        self.assertEqual(b'version two, longer', self.vault['note.md'])
+        self.assertEqual(1, self.vault.misses)
+
+    def test_cache_byte_budget(self):
+        self.vault.max_cache_bytes = 250
+        for name in ('a.md', 'b.md', 'c.md'):
+            self.vault[name] = b'x' * 100
+        self.assertEqual(200, self.vault.cache_bytes)
+        self.assertEqual(['b.md', 'c.md'], list(self.vault._cache))  # least recently used evicted
+
+    def test_sequential_prefetch(self):
+        expected = {}
+        for x in range(5):
+            expected['note%d.md' % x] = ('note %d' % x).encode('us-ascii')
+            self.vault[('note%d.md' % x)] = expected['note%d.md' % x]
+        vault = jenc.vault.JencVault(self.temp_dir, hello_password)
+        try:
+            self.assertEqual(expected, dict(vault.items()))
+            self.assertEqual(2, vault.misses)  # rest prefetched
+            self.assertEqual(3, vault.prefetches)
+            self.assertEqual(1, vault.stats()['key_cache']['misses'])  # files written by one session share salt
+        finally:
+            vault.close()
+
+
+    def test_path_list_maintained_without_rescan(self):
+        for name in ('b.md', 'd.md'):
+            self.vault[name] = b'x'
+        self.vault['b.md']
+        self.vault['d.md']  # first prefetch check scans once
+        scans = []
+        original_paths = self.vault.paths
+        self.vault.paths = lambda: scans.append(1) or original_paths()
+        try:
+            self.vault['a.md'] = b'a'
+            self.vault['c.md'] = b'c'
+            self.vault['c.md'] = b'c again'  # existing, not duplicated
+            del self.vault['d.md']
+            self.assertEqual(['a.md', 'b.md', 'c.md'], self.vault._paths)
+            for name in ('a.md', 'b.md', 'c.md'):
+                self.vault[name]
+            self.assertEqual([], scans)
+        finally:
+            del self.vault.paths
+        self.assertEqual(['a.md', 'b.md', 'c.md'], self.vault.paths())
+        for path in self.vault:
+            self.vault[path + '.bak'] = b'copy'  # iterating a copy
+        self.assertEqual(6, len(self.vault))
+
+class TestJencGrep(TestJencUtil):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        notes = {
+            'a.md': b'# shopping\n* milk\n* eggs\n* Milk chocolate\n',
+            'b.md': b'nothing here\n',
+            os.path.join('sub', 'c.md'): b'milk',  # no trailing newline
+        }
+        os.mkdir(os.path.join(self.temp_dir, 'sub'))
+        session = jenc.JencSession(hello_password)  # shared salt
+        for filename, plaintext_bytes in notes.items():
+            f = open(os.path.join(self.temp_dir, filename + '.jenc'), 'wb')
+            session.encrypt_file_handle(f, plaintext_bytes)
+            f.close()
+        session.close()
+        self.filename_a = os.path.join(self.temp_dir, 'a.md.jenc')
+        self.filename_c = os.path.join(self.temp_dir, 'sub', 'c.md.jenc')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_match_lines(self):
+        import jenc.grep
+        regex = jenc.grep.compile_pattern('o')
+        self.assertEqual([(1, b'one'), (2, b'two')], jenc.grep.match_lines(regex, b'one\ntwo\nthree\n'))
+        self.assertEqual([(6, b'one')], jenc.grep.match_lines(regex, b'one\ntwo\n', line_number=6, max_count=1))
+        self.assertEqual([(1, b'a'), (2, b'')], jenc.grep.match_lines(jenc.grep.compile_pattern(''), b'a\n\n'))
+        self.assertEqual([(2, b'a.b')], jenc.grep.match_lines(jenc.grep.compile_pattern('.', fixed_string=True), b'ab\na.b'))
+
+    def test_match_lines_newline_patterns(self):
+        import jenc.grep
+        for pattern, data, expected in (
+                ('[^a]', b'aaa\naa\n', []),
+                ('\\s', b'aaa\naa\n', []),
+                ('a\nb', b'a\nb\n', []),
+                ('[^a]', b'aaa\na b\n\naa', [(2, b'a b')]),
+                ('\\s', b'a\n\tb\n', [(2, b'\tb')]),
+                ('a$', b'ba\nab\na', [(1, b'ba'), (3, b'a')]),
+                ('^$', b'a\n\nb\n', [(2, b'')]),
+            ):
+            self.assertEqual(expected, jenc.grep.match_lines(jenc.grep.compile_pattern(pattern), data), pattern)
+        # buffered and streaming (matches never span chunks) agree
+        f = open(os.path.join(self.temp_dir, 'd.md.jenc'), 'wb')
+        f.write(jenc.encrypt(hello_password, b'aaa\naa\na b\naaaa\n\ta\n'))
+        f.close()
+        filename_d = os.path.join(self.temp_dir, 'd.md.jenc')
+        for pattern in ('[^a]', '\\s'):
+            expected = [(filename_d, 3, b'a b'), (filename_d, 5, b'\ta')]
+            self.assertEqual(expected, [match for match in jenc.search(pattern, [filename_d], hello_password, jobs=1)])
+            for chunk_size in (1, 3, 7, 1024):
+                self.assertEqual(expected, [match for match in jenc.search(pattern, [filename_d], hello_password, jobs=1, stream_threshold=0, chunk_size=chunk_size)])
+
+    def test_search(self):
+        expected = [
+            (self.filename_a, 2, b'* milk'),
+            (self.filename_a, 4, b'* Milk chocolate'),
+            (self.filename_c, 1, b'milk'),
+        ]
+        for jobs in (1, 2):
+            self.assertEqual(expected, list(jenc.search('milk', [self.temp_dir], hello_password, ignore_case=True, jobs=jobs)))
+            self.assertEqual(sorted(expected), sorted(jenc.search('milk', [self.temp_dir], hello_password, ignore_case=True, jobs=jobs, ordered=False)))
+        self.assertEqual(expected[:1] + expected[2:], list(jenc.search(b'milk', self.temp_dir, hello_password, jobs=1)))
+        self.assertEqual([self.filename_a, self.filename_c], [match.filename for match in jenc.search('milk', [self.temp_dir], hello_password, ignore_case=True, files_with_matches=True, jobs=1)])
+
+    def test_search_stream(self):
+        import jenc.grep
+        expected = list(jenc.search('[mM]ilk|eggs', [self.temp_dir], hello_password, jobs=1))
+        self.assertEqual(4, len(expected))
+        self.assertEqual(expected, list(jenc.search('[mM]ilk|eggs', [self.temp_dir], hello_password, jobs=1, stream_threshold=0, chunk_size=5)))
+        self.assertEqual(expected[:2] + expected[3:], list(jenc.search('[mM]ilk|eggs', [self.temp_dir], hello_password, jobs=1, stream_threshold=0, chunk_size=5, max_count=2)))
+
+    def test_search_errors(self):
+        self.assertRaises(jenc.JencDecryptError, list, jenc.search('milk', [self.temp_dir], 'wrong password', jobs=1))
+        errors = []
+        self.assertEqual([], list(jenc.search('milk', [self.temp_dir], 'wrong password', jobs=2, on_error=lambda filename, error: errors.append(filename))))
+        self.assertEqual(3, len(errors))
+
+    def test_command_line(self):
+        stdout = sys.stdout
+        sys.stdout = FakeFileText()
+        sys.stdout.buffer = FakeFile()
+        try:
+            self.assertEqual(0, jenc.main(['jenc', 'grep', '-p', hello_password, '-l', '--jobs', '1', 'eggs', self.temp_dir]))
+            self.assertEqual(self.filename_a.encode('utf-8') + b'\n', sys.stdout.buffer.getvalue())
+            self.assertEqual(1, jenc.main(['jenc', 'grep', '-p', hello_password, '--jobs', '1', 'bread', self.temp_dir]))
+        finally:
+            sys.stdout = stdout
+
+
+class TestJencIndex(TestJencUtil):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.session = jenc.JencSession(hello_password)
+        self.write_note('a.md', b'# Shopping\n* milk\n* eggs\n')
+        self.write_note('sub/b.md', b'Milk chocolate')
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.temp_dir)
+
+    def write_note(self, path, plaintext_bytes):
+        filename = os.path.join(self.temp_dir, path.replace('/', os.sep) + '.jenc')
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        f = open(filename, 'wb')
+        self.session.encrypt_file_handle(f, plaintext_bytes)
+        f.close()
+
+    def test_tokenize(self):
+        import jenc.index
+        self.assertEqual({b'milk': 2, b'eggs': 8, b'caf\xc3\xa9': 14}, jenc.index.tokenize(b'* Milk, eggs; Caf\xc3\xa9 milk'))
+
+    def test_index_query(self):
+        import jenc.index
+        index = jenc.index.JencIndex(self.temp_dir, hello_password)
+        self.assertEqual(2, index.update())
+        self.assertEqual(['a.md', 'sub/b.md'], index.search('MILK'))
+        self.assertEqual(['a.md'], index.search('milk eggs'))
+        self.assertEqual(['a.md', 'sub/b.md'], index.search('eggs chocolate', match_all=False))
+        self.assertEqual([], index.search('bread'))
+        self.assertEqual([('a.md', 13)], index.lookup('milk')[:1])
+
+    def test_persistent_incremental(self):
+        import jenc.index
+        index = jenc.index.JencIndex(self.temp_dir, hello_password)
+        index.update()
+        index.save()
+        f = open(index.index_filename, 'rb')
+        self.assertEqual(b'V001', f.read(4))  # encrypted
+        f.close()
+        self.assertEqual([], jenc.find_files([self.temp_dir], True)[2:])  # not picked up as a note
+
+        index = jenc.index.JencIndex(self.temp_dir, hello_password)
+        self.assertEqual(['a.md', 'sub/b.md'], index.search('milk'))
+        self.assertEqual(0, index.update())  # nothing changed, nothing decrypted
+        self.write_note('sub/b.md', b'very dark chocolate')
+        os.remove(os.path.join(self.temp_dir, 'a.md.jenc'))
+        self.write_note('c.md', b'bread and milk')
+        self.assertEqual(3, index.update())
+        self.assertEqual(['c.md'], index.search('milk'))
+        self.assertEqual(['sub/b.md'], index.search('dark'))
+        index.save()
+        index = jenc.index.JencIndex(self.temp_dir, hello_password)
+        self.assertEqual({'files': 2, 'terms': 6, 'postings': 6, 'removed': 0}, index.stats())
+        self.assertRaises(jenc.JencDecryptError, jenc.index.JencIndex, self.temp_dir, 'wrong password')
+
+
+    def test_same_size_and_mtime_rewrite(self):
+        import jenc.index
+        index = jenc.index.JencIndex(self.temp_dir, hello_password)
+        index.update()
+        filename = os.path.join(self.temp_dir, 'a.md.jenc')
+        stat_result = os.stat(filename)
+        f = open(filename, 'rb')
+        plaintext_bytes = jenc.decrypt(hello_password, f.read())
+        f.close()
+        self.write_note('a.md', b'x' * len(plaintext_bytes))  # same size, same session salt, new nonce
+        os.utime(filename, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))  # e.g. restored by rsync -t
+        self.assertEqual(stat_result.st_size, os.stat(filename).st_size)
+        self.assertEqual(1, index.update())
+        self.assertEqual(['sub/b.md'], index.search('milk'))  # stale entry for a.md replaced
+        self.assertEqual(0, index.update())
+        entry = index._files[index._file_ids['a.md']]
+        del entry[4]  # manifest from before nonces were recorded, salt is still checked
+        self.assertEqual(0, index.update())
+
+class TestJencSync(TestJencUtil):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.temp_dir, 'src')
+        self.dst = os.path.join(self.temp_dir, 'dst')
+        os.makedirs(os.path.join(self.src, 'sub'))
+        self.write_file('a.md', b'note a')
+        self.write_file('sub/b.md', b'note b')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, path, plaintext_bytes, mtime=None):
+        filename = os.path.join(self.src, path.replace('/', os.sep))
+        f = open(filename, 'wb')
+        f.write(plaintext_bytes)
+        f.close()
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+    def read_jenc(self, path):
+        f = open(os.path.join(self.dst, path.replace('/', os.sep) + '.jenc'), 'rb')
+        plaintext_bytes = jenc.decrypt_file_handle(f, hello_password)
+        f.close()
+        return plaintext_bytes
+
+    def check_counts(self, expected, counts):
+        self.assertEqual(expected, dict((action, counts[action]) for action in expected))
+
+    def test_sync(self):
+        import jenc.sync
+        for jobs in (1, 2):
+            with jenc.sync.Syncer(self.src, self.dst, hello_password, jobs=jobs) as syncer:
+                self.check_counts({'encrypted': 2, 'unchanged': 0}, syncer.sync_once())
+                self.check_counts({'encrypted': 0, 'unchanged': 2}, syncer.sync_once())  # metadata only
+            self.assertEqual(b'note a', self.read_jenc('a.md'))
+            self.assertEqual(b'note b', self.read_jenc('sub/b.md'))
+            shutil.rmtree(self.dst)
+
+    def test_incremental(self):
+        import jenc.sync
+        self.check_counts({'encrypted': 2}, jenc.sync.sync(self.src, self.dst, hello_password, jobs=1))
+        self.write_file('a.md', b'note A', mtime=1000000000)  # same size, different content
+        self.write_file('sub/b.md', b'note b', mtime=1000000000)  # touched only
+        self.write_file('c.md', b'note c')
+        os.remove(os.path.join(self.src, 'a.md'))
+        self.write_file('d.md', b'note d')
+
+        syncer = jenc.sync.Syncer(self.src, self.dst, hello_password, jobs=1)  # manifest loaded
+        try:
+            reported = []
+            self.check_counts({'encrypted': 2, 'unchanged': 1, 'deleted': 1, 'failed': 0}, syncer.sync_once(report=lambda path, action, error: reported.append((path, action))))
+            self.assertEqual([('a.md', 'deleted'), ('c.md', 'encrypted'), ('d.md', 'encrypted')], sorted(reported))
+            self.assertFalse(os.path.exists(os.path.join(self.dst, 'a.md.jenc')))
+            self.assertEqual(b'note c', self.read_jenc('c.md'))
+            self.check_counts({'encrypted': 0, 'unchanged': 3}, syncer.sync_once())
+        finally:
+            syncer.close()
+
+    def test_debounce(self):
+        import jenc.sync
+        with jenc.sync.Syncer(self.src, self.dst, hello_password, jobs=1, debounce=60) as syncer:
+            self.check_counts({'encrypted': 0, 'pending': 2}, syncer.sync_once())
+            self.write_file('a.md', b'note a', mtime=1000000000)
+            self.check_counts({'encrypted': 1, 'pending': 1}, syncer.sync_once())
+
+    def test_command_line(self):
+        self.assertEqual(0, jenc.main(['jenc', 'sync', '-p', hello_password, '--jobs', '1', self.src, self.dst]))
+        self.assertEqual(b'note b', self.read_jenc('sub/b.md'))
+
+
+class TestJencPipeline(TestJencUtil):
+    original_plaintext = b'0123456789abcdef' * 1000 + b'tail'
+
+    def test_round_trip(self):
+        import jenc.pipeline
+        for chunk_size in (1, 7, jenc.AUTH_TAG_LENGTH, 1024, jenc.pipeline.DEFAULT_CHUNK_SIZE):
+            encrypted_file = FakeFile()
+            jenc.pipeline.encrypt(hello_password, FakeFile(self.original_plaintext), encrypted_file, chunk_size=chunk_size)
+            encrypted_bytes = encrypted_file.getvalue()
+            self.assertEqual(self.original_plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+            for release in jenc.pipeline.RELEASE_POLICIES:
+                plaintext_file = FakeFile()
+                self.assertEqual(len(self.original_plaintext), jenc.pipeline.decrypt(hello_password, FakeFile(encrypted_bytes), plaintext_file, release=release, chunk_size=chunk_size))
+                self.assertEqual(self.original_plaintext, plaintext_file.getvalue())
+
+    def test_chunk_reader(self):
+        import itertools
+        import queue
+        import jenc.pipeline
+
+        class FakeReaderThread(object):
+            def __init__(self, chunks):
+                self.queue = queue.Queue()
+                for chunk in chunks:
+                    self.queue.put(chunk)
+                self.queue.put(jenc.pipeline._EOF)
+
+        chunks = [b'abc', b'', b'defgh', b'i', b'jklmnopqrstu']
+        data = b''.join(chunks)
+        for sizes in ((1,), (2,), (4,), (5, 3), (100,), (-1,)):
+            reader = jenc.pipeline._ChunkReader(FakeReaderThread(chunks), exact=True)
+            pieces = []
+            for size in itertools.cycle(sizes):
+                piece = reader.read(size)
+                if not piece:
+                    break
+                self.assertTrue(size < 0 or len(piece) == size or reader.eof, (sizes, piece))
+                pieces.append(piece)
+            self.assertEqual(data, b''.join(pieces))
+            self.assertEqual(0, reader.length)
+        reader = jenc.pipeline._ChunkReader(FakeReaderThread(chunks))
+        self.assertEqual([b'abc', b'defgh', b'i', b'jklmnopqrstu', b''], [reader.read(100) for x in range(5)])  # short reads, chunks as queued
+
+    def test_hello_world(self):
+        import jenc.pipeline
+        plaintext_file = FakeFile()
+        jenc.pipeline.decrypt(hello_password, FakeFile(hello_world_v001), plaintext_file, chunk_size=5)
+        self.assertEqual(hello_world_plaintext, plaintext_file.getvalue())
+
+    def test_encrypt_emits_before_eof(self):
+        import threading
+        import jenc.pipeline
+        more_input = threading.Event()
+
+        class SlowFile(object):
+            chunks = [b'first chunk', b'second chunk']
+            def read(self, size):
+                if len(self.chunks) == 1:
+                    more_input.wait(5)
+                return self.chunks and self.chunks.pop(0) or b''
+
+        class WatchedFile(FakeFile):
+            def write(self, data):
+                FakeFile.write(self, data)
+                if len(self.getvalue()) > 100:  # V001 header is 100 bytes
+                    more_input.set()  # first chunk written while input still open
+
+        encrypted_file = WatchedFile()
+        jenc.pipeline.encrypt(hello_password, SlowFile(), encrypted_file, chunk_size=1024)
+        self.assertTrue(more_input.is_set())
+        self.assertEqual(b'first chunksecond chunk', jenc.decrypt(hello_password, encrypted_file.getvalue()))
+
+    def test_verify_release_bad_bytes(self):
+        import jenc.pipeline
+        encrypted_bytes = jenc.encrypt(hello_password, self.original_plaintext)
+        bad_encrypted_bytes = encrypted_bytes[:-1] + bytes(bytearray([encrypted_bytes[-1] ^ 1]))
+        plaintext_file = FakeFile()
+        self.assertRaises(jenc.JencDecryptError, jenc.pipeline.decrypt, hello_password, FakeFile(bad_encrypted_bytes), plaintext_file, chunk_size=1024)
+        self.assertEqual(b'', plaintext_file.getvalue())  # nothing released
+        plaintext_file = FakeFile()
+        self.assertRaises(jenc.JencDecryptError, jenc.pipeline.decrypt, hello_password, FakeFile(bad_encrypted_bytes), plaintext_file, release=jenc.pipeline.RELEASE_STREAM, chunk_size=1024)
+        self.assertRaises(jenc.JencDecryptError, jenc.pipeline.decrypt, hello_password, FakeFile(encrypted_bytes[:50]), FakeFile())
+        self.assertRaises(ValueError, jenc.pipeline.decrypt, hello_password, FakeFile(encrypted_bytes), FakeFile(), release='later')
+
+    def test_command_line(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            in_filename = os.path.join(temp_dir, 'in.md')
+            encrypted_filename = os.path.join(temp_dir, 'in.md.jenc')
+            out_filename = os.path.join(temp_dir, 'out.md')
+            f = open(in_filename, 'wb')
+            f.write(self.original_plaintext)
+            f.close()
+            self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password, '--pipeline', '--chunk-size', '1K', '-o', encrypted_filename, in_filename]))
+            self.assertEqual(0, jenc.main(['jenc', '-d', '-p', hello_password, '--pipeline', '--release', 'stream', '-o', out_filename, encrypted_filename]))
+            f = open(out_filename, 'rb')
+            self.assertEqual(self.original_plaintext, f.read())
+            f.close()
+            self.assertEqual(1, jenc.main(['jenc', '-d', '-p', 'wrong password', '--pipeline', '-o', out_filename, encrypted_filename]))
+            f = open(out_filename, 'rb')
+            self.assertEqual(self.original_plaintext, f.read())  # untouched
+            f.close()
+            self.assertEqual(['in.md', 'in.md.jenc', 'out.md'], sorted(os.listdir(temp_dir)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class TestJencCommandLineOutput(TestJencUtil):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.encrypted_filename = os.path.join(self.temp_dir, 'in.md.jenc')
+        self.out_filename = os.path.join(self.temp_dir, 'out.md')
+        self.write_file(self.encrypted_filename, hello_world_v001)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_file(self, filename, data):
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+
+    def read_file(self, filename):
+        f = open(filename, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+    def test_decrypt_to_file(self):
+        self.assertEqual(0, jenc.main(['jenc', '-d', '-p', hello_password, '-o', self.out_filename, self.encrypted_filename]))
+        self.assertEqual(hello_world_plaintext, self.read_file(self.out_filename))
+        self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password, '-o', self.encrypted_filename, self.out_filename]))  # replace existing
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, self.read_file(self.encrypted_filename)))
+
+    def test_decrypt_to_file_bad_bytes(self):
+        spurious_byte_offset = 126
+        self.write_file(self.encrypted_filename, hello_world_v001[:spurious_byte_offset-1] + b'\x00' + hello_world_v001[spurious_byte_offset:])
+        self.assertEqual(1, jenc.main(['jenc', '-d', '-p', hello_password, '-o', self.out_filename, self.encrypted_filename]))
+        self.assertEqual(['in.md.jenc'], os.listdir(self.temp_dir))  # no partial output, no temporary file
+
+        self.write_file(self.out_filename, b'previous contents')
+        for extra_args in ([], ['--pipeline']):
+            self.assertEqual(1, jenc.main(['jenc', '-d', '-p', hello_password, '-o', self.out_filename] + extra_args + [self.encrypted_filename]))
+            self.assertEqual(b'previous contents', self.read_file(self.out_filename))
+            self.assertEqual(['in.md.jenc', 'out.md'], sorted(os.listdir(self.temp_dir)))
+
+
+class TestJencParallelGcm(TestJencUtil):
+    def check_same_as_serial(self, plaintext, nonce_length, call_sizes, jobs=2, segment_size=64):
+        from Crypto.Cipher import AES
+        import jenc.gcm
+        key = os.urandom(32)
+        nonce_bytes = os.urandom(nonce_length)
+        expected = AES.new(key, AES.MODE_GCM, nonce=nonce_bytes).encrypt_and_digest(plaintext)
+        cipher = jenc.gcm.ParallelAesGcm(key, nonce_bytes, jobs=jobs, segment_size=segment_size)
+        crypted_bytes = b''
+        offset = 0
+        for call_size in call_sizes:
+            crypted_bytes += cipher.encrypt(plaintext[offset:offset + call_size])
+            offset += call_size
+        crypted_bytes += cipher.encrypt(plaintext[offset:])
+        self.assertEqual(expected, (crypted_bytes, cipher.digest()))
+
+        cipher = jenc.gcm.ParallelAesGcm(key, nonce_bytes, jobs=jobs, segment_size=segment_size)
+        self.assertEqual(plaintext, cipher.decrypt_and_verify(crypted_bytes, expected[1]))
+        cipher = jenc.gcm.ParallelAesGcm(key, nonce_bytes, jobs=jobs, segment_size=segment_size)
+        self.assertRaises(ValueError, cipher.decrypt_and_verify, crypted_bytes, b'\x00' * 16)
+
+    def test_same_as_serial(self):
+        for length in (0, 1, 15, 16, 17, 64, 65, 1000, 10000):
+            plaintext = os.urandom(length)
+            for nonce_length in (12, 32):
+                self.check_same_as_serial(plaintext, nonce_length, [])
+                self.check_same_as_serial(plaintext, nonce_length, [5, 16, 100, 3])  # partial blocks across calls
+                self.check_same_as_serial(plaintext, nonce_length, [], jobs=1, segment_size=16)
+
+    def test_counter_wraps(self):
+        from Crypto.Cipher import AES
+        import jenc.gcm
+        key = os.urandom(16)
+        nonce_bytes = b'\x01' * 12
+        cipher = jenc.gcm.ParallelAesGcm(key, nonce_bytes, segment_size=32)
+        cipher._first_counter = 0xfffffffe  # only the low 32 bits of the counter block are incremented
+        plaintext = os.urandom(200)
+        self.assertEqual(AES.new(key, AES.MODE_CTR, nonce=nonce_bytes, initial_value=0xfffffffe).encrypt(plaintext), cipher.encrypt(plaintext))
+
+    def test_available_known_answer(self):
+        from Crypto.Cipher import _mode_gcm
+        import jenc.gcm
+        self.assertTrue(jenc.gcm.available())
+        original_ghash = _mode_gcm._GHASH
+
+        class ChangedGHASH(original_ghash):  # e.g. a pycryptodome release with different internals
+            def digest(self):
+                return b'\x00' * 16
+        _mode_gcm._GHASH = ChangedGHASH
+        jenc.gcm._known_answer.clear()
+        try:
+            self.assertFalse(jenc.gcm.available())
+            self.assertFalse('parallel' in jenc.backends.available_backends()['cipher'])
+            self.assertRaises(jenc.backends.BackendNotAvailable, jenc.backends.set_backend, cipher='parallel')
+        finally:
+            _mode_gcm._GHASH = original_ghash
+            jenc.gcm._known_answer.clear()
+        self.assertTrue(jenc.gcm.available())
+
+    def test_nested_no_deadlock(self):
+        # parallel cipher running inside workers of another parallel stage (e.g. segmented), all pools busy
+        import threading
+        from Crypto.Cipher import AES
+        import jenc.gcm
+        key, nonce_bytes = os.urandom(32), os.urandom(32)
+        plaintext = os.urandom(1000)
+        expected = AES.new(key, AES.MODE_GCM, nonce=nonce_bytes).encrypt_and_digest(plaintext)
+        results = []
+
+        def encrypt(index):
+            return jenc.gcm.ParallelAesGcm(key, nonce_bytes, jobs=2, segment_size=32).encrypt_and_digest(plaintext)
+
+        def run():
+            results.extend(jenc.gcm.parallel_map(encrypt, list(range(8)), 2))
+            results.extend(jenc.gcm.parallel_map(encrypt, list(range(8)), 2, stage='segmented'))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'deadlock')
+        self.assertEqual([expected] * 16, results)
+
+    def test_backend_opt_in(self):
+        import jenc.backends
+        original_active = dict(jenc.backends._active)
+        try:
+            jenc.backends.reset_backends()
+            self.assertNotEqual('parallel', jenc.backends.active_backends()['cipher'])
+            jenc.backends.set_backend(cipher='parallel')
+            plaintext = os.urandom(100000)
+            self.assertEqual(plaintext, jenc.decrypt(hello_password, jenc.encrypt(hello_password, plaintext)))
+        finally:
+            jenc.backends._active.update(original_active)
+
+
+class TestJencSegmented(TestJencUtil):
+    segment_size = 64  # small, so tests cover many segments
+
+    def setUp(self):
+        self.original_segment_size = jenc.jenc_version_details['S001']['segmentSize']
+        jenc.jenc_version_details['S001']['segmentSize'] = self.segment_size
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'test.md.jenc')
+
+    def tearDown(self):
+        jenc.jenc_version_details['S001']['segmentSize'] = self.original_segment_size
+        shutil.rmtree(self.temp_dir)
+
+    def test_lengths_all_apis(self):
+        for length in (0, 1, 63, 64, 65, 128, 1000):
+            plaintext = os.urandom(length)
+            encrypted_bytes = jenc.encrypt(hello_password, plaintext, jenc_version='S001')
+            self.assertEqual(jenc.encrypted_length(length, jenc_version='S001'), len(encrypted_bytes))
+            self.assertEqual(length, jenc.decrypted_length(encrypted_bytes))
+            self.assertEqual(length, jenc.inspect(encrypted_bytes).content_length)
+            self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+            self.assertEqual(plaintext, jenc.decrypt_file_handle(FakeFile(encrypted_bytes), hello_password))
+            for chunk_size in (1, 17, 100):
+                self.assertEqual(plaintext, b''.join(jenc.decrypt_stream_generator(hello_password, FakeFile(encrypted_bytes), chunk_size=chunk_size)))
+                encrypted_file = FakeFile()
+                jenc.encrypt_stream(hello_password, FakeFile(plaintext), encrypted_file, jenc_version='S001', chunk_size=chunk_size)
+                self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_file.getvalue()))
+            out_buffer = bytearray(length)
+            jenc.decrypt_into(hello_password, encrypted_bytes, out_buffer)
+            self.assertEqual(plaintext, out_buffer)
+
+    def test_tampered(self):
+        plaintext = os.urandom(200)
+        encrypted_bytes = jenc.encrypt(hello_password, plaintext, jenc_version='S001')
+        header_length = 100
+        frame_length = self.segment_size + 24
+        first_frame = encrypted_bytes[header_length:header_length + frame_length]
+        second_frame = encrypted_bytes[header_length + frame_length:header_length + 2 * frame_length]
+        bad_versions = [
+            encrypted_bytes[:150] + bytes(bytearray([encrypted_bytes[150:151][0] ^ 0xff])) + encrypted_bytes[151:],  # ciphertext, flipped (random data may already be 0x00)
+            encrypted_bytes[:header_length] + second_frame + first_frame + encrypted_bytes[header_length + 2 * frame_length:],  # reordered
+            encrypted_bytes[:header_length + 2 * frame_length],  # truncated at a frame boundary
+            encrypted_bytes[:-1],
+        ]
+        for bad_encrypted_bytes in bad_versions:
+            self.assertRaises(jenc.JencDecryptError, jenc.decrypt, hello_password, bad_encrypted_bytes)
+            self.assertRaises(jenc.JencDecryptError, b''.join, jenc.decrypt_stream_generator(hello_password, FakeFile(bad_encrypted_bytes), chunk_size=10))
+        self.assertFalse(jenc.inspect(encrypted_bytes[:header_length + 2 * frame_length]).valid)
+
+    def test_session_distinct_file_keys(self):
+        import jenc.segmented
+        original_random_bytes = jenc.get_random_bytes
+        try:
+            jenc.get_random_bytes = lambda length: b'\x01' * length
+            encrypted_bytes1 = jenc.encrypt(hello_password, hello_world_plaintext, jenc_version='S001')
+            jenc.get_random_bytes = lambda length: b'\x01' * (length - 1) + b'\x02'  # same salt and segment nonce, different header nonce
+            encrypted_bytes2 = jenc.encrypt(hello_password, hello_world_plaintext, jenc_version='S001')
+        finally:
+            jenc.get_random_bytes = original_random_bytes
+        self.assertNotEqual(encrypted_bytes1[-27:], encrypted_bytes2[-27:])
+
+    def test_random_access_read(self):
+        import jenc.segmented
+        plaintext = os.urandom(1000)
+        f = open(self.filename, 'wb')
+        f.write(jenc.encrypt(hello_password, plaintext, jenc_version='S001'))
+        f.close()
+        for jobs in (1, 2):
+            with jenc.segmented.SegmentedFile(self.filename, hello_password, jobs=jobs) as segmented_file:
+                self.assertEqual(1000, len(segmented_file))
+                self.assertEqual(1000, segmented_file.seek(0, 2))
+                for offset, length in ((0, 10), (60, 10), (500, 300), (990, 100), (2000, 1)):
+                    segmented_file.seek(offset)
+                    self.assertEqual(plaintext[offset:offset + length], segmented_file.read(length))
+                segmented_file.seek(0)
+                self.assertEqual(plaintext, segmented_file.read())
+                self.assertRaises(io.UnsupportedOperation, segmented_file.write, b'x')
+
+    def test_random_access_read_tampered_segment(self):
+        import jenc.segmented
+        encrypted_bytes = bytearray(jenc.encrypt(hello_password, os.urandom(1000), jenc_version='S001'))
+        encrypted_bytes[100 + 5 * (self.segment_size + 24) + 10] ^= 1  # segment 5
+        f = open(self.filename, 'wb')
+        f.write(encrypted_bytes)
+        f.close()
+        with jenc.segmented.SegmentedFile(self.filename, hello_password) as segmented_file:
+            self.assertEqual(64, len(segmented_file.read(64)))  # other segments still readable
+            segmented_file.seek(5 * self.segment_size)
+            self.assertRaises(jenc.JencDecryptError, segmented_file.read, 1)
+        self.assertRaises(jenc.JencDecryptError, jenc.segmented.SegmentedFile, FakeFile(bytes(encrypted_bytes[:100 + 2 * (self.segment_size + 24)])), hello_password)  # truncated at a frame boundary
+        self.assertRaises(jenc.UnsupportedMetaData, jenc.segmented.SegmentedFile, FakeFile(hello_world_v001), hello_password)
+
+    def test_write_and_partial_rewrite(self):
+        import jenc.segmented
+        expected = bytearray()
+        with jenc.segmented.SegmentedFile(self.filename, hello_password, mode='wb') as segmented_file:
+            for x in range(50):
+                data = os.urandom(37)
+                segmented_file.write(data)
+                expected += data
+        f = open(self.filename, 'rb')
+        encrypted_bytes = f.read()
+        f.close()
+        self.assertEqual(bytes(expected), jenc.decrypt(hello_password, encrypted_bytes))
+
+        with jenc.segmented.SegmentedFile(self.filename, hello_password, mode='r+b') as segmented_file:
+            segmented_file.seek(100)
+            segmented_file.write(b'X' * 10)
+            expected[100:110] = b'X' * 10
+            segmented_file.seek(len(expected) + 5)  # past the end, gap is zero filled
+            segmented_file.write(b'tail')
+            expected += b'\x00' * 5 + b'tail'
+            segmented_file.seek(0)
+            self.assertEqual(bytes(expected), segmented_file.read())
+        f = open(self.filename, 'rb')
+        rewritten_bytes = f.read()
+        f.close()
+        self.assertEqual(bytes(expected), jenc.decrypt(hello_password, rewritten_bytes))
+        frame_length = self.segment_size + 24
+        self.assertEqual(encrypted_bytes[:100 + frame_length], rewritten_bytes[:100 + frame_length])  # segment 0 untouched
+        self.assertNotEqual(encrypted_bytes[100 + frame_length:100 + 2 * frame_length], rewritten_bytes[100 + frame_length:100 + 2 * frame_length])
+
+        with jenc.segmented.SegmentedFile(self.filename, hello_password, mode='r+b') as segmented_file:
+            segmented_file.truncate(130)
+            segmented_file.truncate(200)
+        f = open(self.filename, 'rb')
+        self.assertEqual(bytes(expected[:130]) + b'\x00' * 70, jenc.decrypt(hello_password, f.read()))
+        f.close()
+
+    def test_migrate(self):
+        f = open(self.filename, 'wb')
+        f.write(hello_world_v001)
+        f.close()
+        self.assertEqual(0, jenc.main(['jenc', '-p', hello_password, '--migrate-to', 'S001', '--jobs', '1', '--journal', os.path.join(self.temp_dir, 'journal'), self.filename]))
+        self.assertEqual('S001', jenc.inspect(self.filename).jenc_version)
+        f = open(self.filename, 'rb')
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, f.read()))
+        f.close()
+
+
+class TestJencCompressed(TestJencUtil):
+    markdown_plaintext = b''.join(b'# Note %d\n\nSome *markdown* text, with a [link](https://example.com/%d).\n\n' % (i, i) for i in range(2000))
+
+    def setUp(self):
+        import jenc.compression
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        jenc.compression.set_algorithm()
+        jenc.compression.set_limits()
+        shutil.rmtree(self.temp_dir)
+
+    def test_all_apis_all_algorithms(self):
+        import jenc.pipeline
+        for algorithm in jenc.compression.available_algorithms():
+            jenc.compression.set_algorithm(algorithm)
+            for plaintext in (b'', hello_world_plaintext, self.markdown_plaintext):
+                encrypted_bytes = jenc.encrypt(hello_password, plaintext, jenc_version='C001')
+                self.assertEqual(b'C001', encrypted_bytes[:4])
+                self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+                self.assertEqual(plaintext, jenc.decrypt_file_handle(FakeFile(encrypted_bytes), hello_password))
+                for chunk_size in (1, 17, 4096):
+                    self.assertEqual(plaintext, b''.join(jenc.decrypt_stream_generator(hello_password, FakeFile(encrypted_bytes), chunk_size=chunk_size)))
+                    encrypted_file = FakeFile()
+                    jenc.encrypt_stream(hello_password, FakeFile(plaintext), encrypted_file, jenc_version='C001', chunk_size=chunk_size)
+                    self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_file.getvalue()))
+                with jenc.JencSession(hello_password, jenc_version='C001') as session:
+                    self.assertEqual(plaintext, jenc.decrypt(hello_password, session.encrypt(plaintext)))
+                out_file = FakeFile()
+                jenc.pipeline.encrypt(hello_password, FakeFile(plaintext), out_file, jenc_version='C001', chunk_size=100)
+                self.assertEqual(plaintext, jenc.decrypt(hello_password, out_file.getvalue()))
+
+    def test_smaller_than_uncompressed(self):
+        encrypted_bytes = jenc.encrypt(hello_password, self.markdown_plaintext, jenc_version='C001')
+        self.assertTrue(len(encrypted_bytes) * 3 < jenc.encrypted_length(len(self.markdown_plaintext), jenc_version='V001'))
+
+    def test_algorithm_detected_on_decrypt(self):
+        jenc.compression.set_algorithm('lzma')
+        encrypted_bytes = jenc.encrypt(hello_password, self.markdown_plaintext, jenc_version='C001')
+        jenc.compression.set_algorithm('zlib')
+        self.assertEqual(self.markdown_plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+        self.assertRaises(jenc.UnsupportedMetaData, jenc.compression.set_algorithm, 'bogus')
+
+    def test_lengths_unknown(self):
+        encrypted_bytes = jenc.encrypt(hello_password, hello_world_plaintext, jenc_version='C001')
+        header = jenc.inspect(encrypted_bytes)
+        self.assertTrue(header.valid)
+        self.assertEqual(None, header.content_length)
+        self.assertRaises(jenc.UnsupportedMetaData, jenc.decrypted_length, encrypted_bytes)
+        self.assertRaises(jenc.UnsupportedMetaData, jenc.decrypt_into, hello_password, encrypted_bytes, bytearray(100))
+        self.assertRaises(jenc.UnsupportedMetaData, jenc.encrypt_into, hello_password, hello_world_plaintext, bytearray(1000), jenc_version='C001')
+
+    def pipe_file(self, encrypted_bytes):
+        """Returns non-seekable file-like object, like stdin"""
+        class PipeFile(object):
+            def __init__(self, data):
+                self._file = FakeFile(data)
+
+            def read(self, size=-1):
+                return self._file.read(size)
+        return PipeFile(encrypted_bytes)
+
+    def decrypt_pipe(self, password, encrypted_bytes, chunk_size=4096):
+        return b''.join(jenc.decrypt_stream_generator(password, self.pipe_file(encrypted_bytes), chunk_size=chunk_size))
+
+    def test_decompression_bomb(self):
+        plaintext = b'\x00' * (1024 * 1024)
+        encrypted_bytes = jenc.encrypt(hello_password, plaintext, jenc_version='C001')
+        jenc.compression.set_limits(min_limit=64 * 1024)
+        # authenticated before decompressing, no limit
+        self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+        self.assertEqual(plaintext, b''.join(jenc.decrypt_stream_generator(hello_password, FakeFile(encrypted_bytes), chunk_size=100)))
+        # not seekable, limited
+        plaintext_length = 0
+        try:
+            for plaintext_bytes in jenc.decrypt_stream_generator(hello_password, self.pipe_file(encrypted_bytes), chunk_size=100):
+                plaintext_length += len(plaintext_bytes)
+            self.fail('DecompressionLimitExceeded not raised')
+        except jenc.compression.DecompressionLimitExceeded:
+            pass
+        self.assertTrue(plaintext_length <= 64 * 1024)
+        self.assertEqual(self.markdown_plaintext, self.decrypt_pipe(hello_password, jenc.encrypt(hello_password, self.markdown_plaintext, jenc_version='C001')))
+        jenc.compression.set_limits(max_ratio=0, min_limit=64 * 1024)
+        self.assertEqual(plaintext, self.decrypt_pipe(hello_password, encrypted_bytes))
+        jenc.compression.set_limits(max_ratio=2000, min_limit=64 * 1024)
+        self.assertEqual(plaintext, self.decrypt_pipe(hello_password, encrypted_bytes))
+        jenc.compression.set_limits(min_limit=64 * 1024)
+        os.environ['JENC_MAX_EXPANSION_RATIO'] = '0'
+        try:
+            self.assertEqual(plaintext, self.decrypt_pipe(hello_password, encrypted_bytes))
+        finally:
+            del os.environ['JENC_MAX_EXPANSION_RATIO']
+
+    def test_large_compressible_round_trip(self):
+        plaintext = b'\x00' * (32 * 1024 * 1024)  # more than MIN_LIMIT and MAX_EXPANSION_RATIO times the compressed size
+        encrypted_bytes = jenc.encrypt(hello_password, plaintext, jenc_version='C001')
+        self.assertTrue(len(encrypted_bytes) * jenc.compression.MAX_EXPANSION_RATIO < len(plaintext))
+        self.assertEqual(plaintext, jenc.decrypt(hello_password, encrypted_bytes))
+        self.assertEqual(plaintext, jenc.decrypt_file_handle(FakeFile(encrypted_bytes), hello_password))
+        self.assertEqual(plaintext, b''.join(jenc.decrypt_stream_generator(hello_password, FakeFile(encrypted_bytes))))
+        encrypted_filename = os.path.join(self.temp_dir, 'zeros.jenc')
+        out_filename = os.path.join(self.temp_dir, 'zeros')
+        f = open(encrypted_filename, 'wb')
+        f.write(encrypted_bytes)
+        f.close()
+        self.assertEqual(0, jenc.main(['jenc', '-d', '-p', hello_password, '-o', out_filename, encrypted_filename]))
+        self.assertEqual(len(plaintext), os.path.getsize(out_filename))
+
+    def test_unauthenticated_errors_after_tag_check(self):
+        # decompression errors for data that fails the tag check are reported as a tag failure
+        encrypted_bytes = jenc.encrypt(hello_password, b'\x00' * (1024 * 1024), jenc_version='C001')
+        jenc.compression.set_limits(min_limit=64 * 1024)
+        bad_encrypted_bytes = encrypted_bytes[:-1] + bytes(bytearray([encrypted_bytes[-1] ^ 1]))  # bad tag, content intact
+        for decrypt in (self.decrypt_pipe, jenc.decrypt):
+            for password, data in (('bad password', encrypted_bytes), (hello_password, bad_encrypted_bytes)):
+                try:
+                    decrypt(password, data)
+                    self.fail('JencDecryptError not raised')
+                except jenc.JencDecryptError as info:
+                    self.assertEqual(jenc.JencDecryptError, type(info))
+        for algorithm_id in range(256):  # first content byte; unknown, unavailable or wrong algorithm
+            bad_encrypted_bytes = encrypted_bytes[:100] + bytes(bytearray([algorithm_id])) + encrypted_bytes[101:]
+            if bad_encrypted_bytes == encrypted_bytes:
+                continue
+            self.assertRaises(jenc.JencDecryptError, self.decrypt_pipe, hello_password, bad_encrypted_bytes)
+            self.assertRaises(jenc.JencDecryptError, jenc.decrypt, hello_password, bad_encrypted_bytes)
+
+    def test_bad_bytes(self):
+        encrypted_bytes = jenc.encrypt(hello_password, self.markdown_plaintext, jenc_version='C001')
+        self.assertRaises(jenc.JencDecryptError, jenc.decrypt, 'bad password', encrypted_bytes)
+        for offset in (100, 101, len(encrypted_bytes) // 2, len(encrypted_bytes) - 1):
+            bad_encrypted_bytes = encrypted_bytes[:offset] + bytes(bytearray([encrypted_bytes[offset] ^ 1])) + encrypted_bytes[offset + 1:]
+            self.assertRaises(jenc.JencDecryptError, jenc.decrypt, hello_password, bad_encrypted_bytes)
+        # truncated compressed stream with a valid auth tag
+        cipher = jenc._new_cipher(hello_password, b'\x01' * 64, b'\x02' * 32, jenc.jenc_version_details['C001'])
+        crypted_bytes = cipher.encrypt(self.markdown_plaintext)  # compressor never flushed
+        truncated_bytes = b'C001' + b'\x02' * 32 + b'\x01' * 64 + crypted_bytes + cipher._cipher.digest()
+        try:
+            jenc.decrypt(hello_password, truncated_bytes)
+            self.fail('JencDecryptError not raised')
+        except jenc.JencDecryptError as info:
+            self.assertTrue('truncated compressed stream' in str(info))
+
+    def test_command_line(self):
+        in_filename = os.path.join(self.temp_dir, 'in.md')
+        encrypted_filename = os.path.join(self.temp_dir, 'in.md.jenc')
+        out_filename = os.path.join(self.temp_dir, 'out.md')
+        f = open(in_filename, 'wb')
+        f.write(self.markdown_plaintext)
+        f.close()
+        self.assertEqual(0, jenc.main(['jenc', '-e', '-p', hello_password, '--compression', 'lzma', '-o', encrypted_filename, in_filename]))
+        self.assertEqual('C001', jenc.inspect(encrypted_filename).jenc_version)
+        self.assertEqual(0, jenc.main(['jenc', '-d', '-p', hello_password, '-o', out_filename, encrypted_filename]))
+        f = open(out_filename, 'rb')
+        self.assertEqual(self.markdown_plaintext, f.read())
+        f.close()
+        self.assertRaises(SystemExit, jenc.main, ['jenc', '-e', '-p', hello_password, '--compression', 'zlib', '-j', 'V001', in_filename])
+        self.assertRaises(SystemExit, jenc.main, ['jenc', '-d', '-p', hello_password, '--max-expansion-ratio', '-1', encrypted_filename])
+        self.assertEqual(0, jenc.main(['jenc', '-d', '-p', hello_password, '--max-expansion-ratio', '0', '-o', out_filename, encrypted_filename]))
+        self.assertEqual(0, jenc.compression.current_limits()[0])
+
+
+class TestJencKdf(TestJencUtil):
+    def setUp(self):
+        import jenc.kdf
+        if not jenc.kdf.available():
+            self.skip('pycryptodome PBKDF2-HMAC assist not available')
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        jenc.kdf.clear_engines()
+        jenc.backends.reset_backends()
+        shutil.rmtree(self.temp_dir)
+
+    def test_same_as_reference(self):
+        from Crypto.Protocol.KDF import PBKDF2
+        from Crypto.Hash import SHA1, SHA512
+        salt_bytes = b'\x05' * 64
+        for hash_name, hash_module in ((jenc.backends.KDF_SHA1, SHA1), (jenc.backends.KDF_SHA512, SHA512)):
+            for key_length in (1, 20, 21, 32, 64, 65):
+                for iterations in (1, 2, 100):
+                    expected = PBKDF2(hello_password, salt_bytes, key_length, count=iterations, hmac_hash_module=hash_module)
+                    self.assertEqual(expected, jenc.kdf.pbkdf2(hello_password, salt_bytes, key_length, iterations, hash_name))
+                    for jobs in (1, 3):
+                        engine = jenc.kdf.Pbkdf2Engine(hello_password, hash_name, jobs=jobs)
+                        self.assertEqual([expected, expected], engine.derive_many([salt_bytes, salt_bytes], key_length, iterations))
+
+    def test_jenc_versions(self):
+        for version in ('U001', 'V001'):
+            this_file_meta = jenc.jenc_version_details[version]
+            salts = [os.urandom(this_file_meta['keySaltLength']) for x in range(3)]
+            jenc.backends.set_backend(kdf='pycryptodome')
+            expected = [jenc._pbkdf2_derive_key(hello_password, salt_bytes, this_file_meta) for salt_bytes in salts]
+            jenc.backends.set_backend(kdf='parallel')
+            self.assertEqual(expected, [jenc._pbkdf2_derive_key(hello_password, salt_bytes, this_file_meta) for salt_bytes in salts])
+            hash_name = jenc._key_factory_hash_names[this_file_meta['keyFactory']]
+            self.assertEqual(expected, jenc.kdf.pbkdf2_many(hello_password, salts, this_file_meta['keyLength'] // 8, this_file_meta['keyIterationCount'], hash_name))
+        self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, hello_world_v001))
+
+    def test_opt_in_and_engine_cache(self):
+        jenc.backends.reset_backends()
+        self.assertNotEqual('parallel', jenc.backends.active_backends()['kdf'])
+        self.assertTrue(jenc.kdf.engine(hello_password, 'sha1') is jenc.kdf.engine(hello_password.encode('latin-1'), 'sha1'))
+        self.assertFalse(jenc.kdf.engine(hello_password, 'sha1') is jenc.kdf.engine('other', 'sha1'))
+        for x in range(jenc.kdf.MAX_ENGINES + 2):
+            jenc.kdf.engine('password %d' % x, 'sha512')
+        self.assertEqual(jenc.kdf.MAX_ENGINES, len(jenc.kdf._engines))
+        jenc.kdf.clear_engines()
+        self.assertEqual(0, len(jenc.kdf._engines))
+        self.assertRaises(jenc.backends.BackendNotAvailable, jenc.kdf.Pbkdf2Engine, hello_password, 'md5')
+
+    def test_available_known_answer(self):
+        import hashlib
+        from Crypto.Hash import HMAC
+        self.assertTrue(jenc.kdf.available())
+        original_assist = HMAC.HMAC._pbkdf2_hmac_assist
+        HMAC.HMAC._pbkdf2_hmac_assist = lambda mac, first_digest, iterations: b'\x00' * len(first_digest)  # e.g. a pycryptodome release with different internals
+        jenc.kdf._known_answer.clear()
+        try:
+            self.assertFalse(jenc.kdf.available())
+            self.assertRaises(jenc.backends.BackendNotAvailable, jenc.backends.set_backend, kdf='parallel')
+            # single block keys (V001) do not use the engine internals
+            engine = jenc.kdf.Pbkdf2Engine(hello_password, 'sha512', jobs=1)
+            self.assertEqual(hashlib.pbkdf2_hmac('sha512', b'geheim', b'\x05' * 64, 100, 32), engine.derive(b'\x05' * 64, 32, 100))
+        finally:
+            HMAC.HMAC._pbkdf2_hmac_assist = original_assist
+            jenc.kdf._known_answer.clear()
+        self.assertTrue(jenc.kdf.available())
+
+    def test_nested_no_deadlock(self):
+        import threading
+        import jenc.gcm
+        salts = [os.urandom(64) for x in range(4)]
+        expected = [jenc.backends.hashlib_pbkdf2(b'geheim', salt_bytes, 32, 100, 'sha1') for salt_bytes in salts]
+        results = []
+
+        def derive(index):
+            return jenc.kdf.Pbkdf2Engine(hello_password, 'sha1', jobs=2).derive_many(salts, 32, 100)
+
+        def run():
+            results.extend(jenc.gcm.parallel_map(derive, list(range(6)), 2, stage='kdf'))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'deadlock')
+        self.assertEqual([expected] * 6, results)
+
+    def test_prime_key_cache(self):
+        filenames = []
+        for version in ('U001', 'V001', 'U001'):
+            filename = os.path.join(self.temp_dir, 'note%d.md.jenc' % len(filenames))
+            f = open(filename, 'wb')
+            f.write(jenc.encrypt(hello_password, hello_world_plaintext, jenc_version=version))
+            f.close()
+            filenames.append(filename)
+        self.assertRaises(jenc.JencException, jenc.kdf.prime_key_cache, hello_password, filenames, key_cache=None)
+        key_cache = jenc.DerivedKeyCache()
+        self.assertEqual(3, jenc.kdf.prime_key_cache(hello_password, filenames + [hello_world_plaintext], key_cache=key_cache))  # invalid skipped
+        self.assertEqual(0, jenc.kdf.prime_key_cache(hello_password, filenames, key_cache=key_cache))  # already cached
+        self.assertEqual((0, 0), (key_cache.hits, key_cache.misses))  # priming does not skew stats
+        hits = key_cache.hits
+        for filename in filenames:
+            f = open(filename, 'rb')
+            self.assertEqual(hello_world_plaintext, jenc.decrypt(hello_password, f.read(), key_cache=key_cache))
+            f.close()
+        self.assertEqual(hits + 3, key_cache.hits)
+
+
 class TestJencFiles(TestJencUtil):
     data_folder = os.path.join(
                     os.path.dirname(jenc.tests.__file__),
@@ -263,6 +2088,29 @@ class TestJencFiles(TestJencUtil):
 
         self.assertEqual(plaintext, test_plaintext_bytes)
 
+        test_plaintext_file = FakeFile()
+        jenc.decrypt_stream(self.password, FakeFile(encrypted), test_plaintext_file, chunk_size=100)
+        self.assertEqual(plaintext, test_plaintext_file.getvalue().replace(b'\r', b''))
+
+    def test_inspect_files(self):
+        for filename, version in (('Test3.md.jenc', 'V001'), ('test.u001_winnewlines.md.jenc', 'U001')):
+            header = jenc.inspect(os.path.join(self.data_folder, filename))
+            self.assertTrue(header.valid)
+            self.assertEqual(version, header.jenc_version)
+            self.assertEqual(version == 'U001', header.deprecated)
+            self.assertEqual(os.path.getsize(os.path.join(self.data_folder, filename)) - 100 - jenc.AUTH_TAG_LENGTH, header.content_length)
+
+    def test_scan_command_line(self):
+        out_file = FakeFileText()
+        stderr = sys.stderr
+        sys.stderr = FakeFileText()
+        try:
+            self.assertEqual(0, jenc.scan_files(jenc.find_files([self.data_folder], True), out_file=out_file))
+        finally:
+            sys.stderr = stderr
+        report = out_file.getvalue().splitlines()
+        self.assertEqual(3, len(report))
+        self.assertTrue(report[0].endswith('\tV001\t32\t64\t133\tok'))
 
     def test_jpencconverter_test3(self):
         self.check_decrypt_file('Test3.md.jenc', 'Test3.md')  # NOTE jpencconverter trims off newline at EOF!
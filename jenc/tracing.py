@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Debug tracing for jenc internals (header fields, buffer sizes).
+
+Call sites check the module level `enabled` flag before building any
+fields, so with tracing off (the default) the cost is one attribute lookup.
+When enabled, fields are only formatted if the jenc.trace logger actually
+emits the record; bytes-like fields are shown as length plus a hex prefix
+truncated to max_bytes, secrets (password, keys, plaintext) are always
+redacted to their length.
+
+Sample code:
+
+    import logging
+    import jenc
+    import jenc.tracing
+
+    logging.basicConfig()
+    jenc.tracing.enable_tracing(max_bytes=16)
+    jenc.decrypt('geheim', jenc.encrypt('geheim', b'Hello World'))
+    jenc.tracing.disable_tracing()
+
+Command line, set OS environment variable JENC_TRACE=1 to trace to stderr.
+
+"""
+
+import logging
+
+
+DEFAULT_MAX_BYTES = 32  # bytes of each buffer shown (as hex) in trace output
+SECRET_FIELDS = frozenset(('password', 'derived_key', 'key', 'plaintext'))  # never shown, only their length
+
+enabled = False  # checked by call sites before tracing anything
+_max_bytes = DEFAULT_MAX_BYTES
+log = logging.getLogger('jenc.trace')
+
+
+def _format_value(name, value):
+    if name in SECRET_FIELDS:
+        try:
+            return '<redacted %d bytes>' % len(value)
+        except TypeError:
+            return '<redacted>'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value_view = memoryview(value).cast('B')
+        length = value_view.nbytes
+        hex_str = bytes(value_view[:_max_bytes]).hex()
+        if length > _max_bytes:
+            hex_str += '...'
+        return '<%d bytes %s>' % (length, hex_str)
+    return repr(value)
+
+
+class _Fields(object):
+    """Formats fields only when converted to str (i.e. when the log record is emitted)"""
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('%s=%s' % (name, _format_value(name, value)) for name, value in sorted(self.fields.items()))
+
+
+def trace(event, **fields):
+    """Log event with fields at DEBUG level, callers should check `enabled` first"""
+    if enabled and log.isEnabledFor(logging.DEBUG):
+        log.debug('%s %s', event, _Fields(fields))
+
+
+def enable_tracing(max_bytes=DEFAULT_MAX_BYTES):
+    """Enable tracing, sets jenc.trace log level to DEBUG (handlers are up to the caller, see jenc.setup_logging())"""
+    global enabled, _max_bytes
+    _max_bytes = max_bytes
+    log.setLevel(logging.DEBUG)
+    enabled = True
+
+
+def disable_tracing():
+    global enabled
+    enabled = False
+    log.setLevel(logging.NOTSET)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""Dict-like view of a directory of .jenc files (e.g. Markor notes).
+
+Files are decrypted on first access and plaintext is cached in memory,
+least recently used entries are evicted once the cache exceeds
+max_cache_bytes. Cached entries are invalidated when the file's
+(mtime, size, inode) changes, so edits made by other programs (Markor,
+sync tools) are picked up. Derived keys are reused per salt, and when
+notes are read in order (e.g. iterating) the following notes are
+decrypted in the background.
+
+Sample code:
+
+    import jenc.vault
+
+    with jenc.vault.JencVault('my_notes_dir', 'geheim') as vault:
+        vault.put('todo.md', b'* buy milk')  # writes my_notes_dir/todo.md.jenc atomically
+        print(vault.get('todo.md'))
+        for path in vault:
+            print(path, len(vault[path]))
+
+"""
+
+import bisect
+import collections
+import os
+import threading
+
+import jenc
+
+
+DEFAULT_MAX_CACHE_BYTES = 64 * 1024 * 1024  # in bytes, plaintext cache budget
+DEFAULT_PREFETCH_DEPTH = 2  # number of following files decrypted in the background on sequential access
+
+
+class JencVault(object):
+    """Lazily decrypting, caching, dict-like view of the .jenc files under root.
+
+    Keys are paths relative to root without the .jenc extension, using / as separator,
+    e.g. 'sub/todo.md' for root/sub/todo.md.jenc.
+    """
+
+    def __init__(self, root, password, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES, jenc_version=None, prefetch_depth=DEFAULT_PREFETCH_DEPTH, prefetch_workers=2):
+        self.root = os.path.abspath(root)
+        self.password = password
+        self.max_cache_bytes = max_cache_bytes
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_workers = prefetch_workers
+        self.key_cache = jenc.DerivedKeyCache()
+        self.session = jenc.JencSession(password, jenc_version=jenc_version)
+        self._cache = collections.OrderedDict()  # path -> (stat signature, plaintext bytes)
+        self.cache_bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # path -> Future, prefetch in progress
+        self._executor = None
+        self._paths = None  # sorted list of paths, for prefetch order. Kept up to date by put()/del, bisect for lookups
+        self._last_path = None
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+
+    def _filename(self, path):
+        """Returns full .jenc filename for path, refuses paths outside root"""
+        if path.endswith(jenc.JENC_FILENAME_EXTENSION):
+            path = path[:-len(jenc.JENC_FILENAME_EXTENSION)]
+        relative_path = os.path.normpath(path.replace('/', os.sep))
+        if os.path.isabs(relative_path) or relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+            raise KeyError(path)
+        return os.path.join(self.root, relative_path + jenc.JENC_FILENAME_EXTENSION)
+
+    def _path(self, filename):
+        relative_path = os.path.relpath(filename, self.root)[:-len(jenc.JENC_FILENAME_EXTENSION)]
+        return relative_path.replace(os.sep, '/')
+
+    def paths(self):
+        """Returns sorted list of paths (rescans root)"""
+        paths = sorted(self._path(filename) for filename in jenc.find_files([self.root], True, recursive=True))
+        self._paths = paths
+        return list(paths)  # copy, put()/del update self._paths in place
+
+    @staticmethod
+    def _signature(stat_result):
+        return (getattr(stat_result, 'st_mtime_ns', stat_result.st_mtime), stat_result.st_size, stat_result.st_ino)
+
+    def _cache_get(self, path, signature):
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry is None:
+                return None
+            if entry[0] != signature:
+                self._cache_discard(path)
+                return None
+            self._cache.move_to_end(path)
+            return entry[1]
+
+    def _cache_discard(self, path):
+        signature, plaintext_bytes = self._cache.pop(path)
+        self.cache_bytes -= len(plaintext_bytes)
+
+    def _cache_put(self, path, signature, plaintext_bytes):
+        if len(plaintext_bytes) > self.max_cache_bytes:
+            return
+        with self._lock:
+            if path in self._cache:
+                self._cache_discard(path)
+            self._cache[path] = (signature, plaintext_bytes)
+            self.cache_bytes += len(plaintext_bytes)
+            while self.cache_bytes > self.max_cache_bytes:
+                self._cache_discard(next(iter(self._cache)))
+
+    def _load(self, path, filename):
+        """Read and decrypt filename, caching the plaintext. Returns plaintext bytes"""
+        f = open(filename, 'rb')
+        try:
+            signature = self._signature(os.fstat(f.fileno()))  # of the bytes actually read
+            encrypt_bytes = f.read()
+        finally:
+            f.close()
+        plaintext_bytes = jenc.decrypt(self.password, encrypt_bytes, key_cache=self.key_cache)
+        self._cache_put(path, signature, plaintext_bytes)
+        return plaintext_bytes
+
+    def __getitem__(self, path):
+        filename = self._filename(path)
+        path = self._path(filename)  # normalized cache key
+        try:
+            signature = self._signature(os.stat(filename))
+        except EnvironmentError:
+            raise KeyError(path)
+        plaintext_bytes = self._cache_get(path, signature)
+        if plaintext_bytes is None:
+            with self._lock:
+                future = self._pending.get(path)
+            if future is not None:
+                future.result()  # wait for in progress prefetch, then re-check
+                plaintext_bytes = self._cache_get(path, signature)
+        if plaintext_bytes is None:
+            self.misses += 1
+            plaintext_bytes = self._load(path, filename)
+        else:
+            self.hits += 1
+        self._maybe_prefetch(path)
+        return plaintext_bytes
+
+    def get(self, path, default=None):
+        """Returns plaintext bytes for path, default if there is no such .jenc file"""
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def put(self, path, plaintext_bytes):
+        """Encrypt and write path atomically (write-through, plaintext is cached)"""
+        filename = self._filename(path)
+        path = self._path(filename)  # normalized cache key
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        plaintext_bytes = bytes(plaintext_bytes)
+        out_file = jenc.AtomicFileWriter(filename)
+        try:
+            self.session.encrypt_file_handle(out_file, plaintext_bytes)
+        except:
+            out_file.abort()
+            raise
+        out_file.commit()
+        self._cache_put(path, self._signature(os.stat(filename)), plaintext_bytes)
+        with self._lock:
+            if self._paths is not None and self._path_index(path) is None:
+                bisect.insort(self._paths, path)
+
+    __setitem__ = put
+
+    def __delitem__(self, path):
+        filename = self._filename(path)
+        path = self._path(filename)  # normalized cache key
+        try:
+            os.remove(filename)
+        except EnvironmentError:
+            raise KeyError(path)
+        self.invalidate(path)
+        with self._lock:
+            index = self._path_index(path)
+            if index is not None:
+                del self._paths[index]
+
+    def __contains__(self, path):
+        try:
+            return os.path.isfile(self._filename(path))
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.paths())
+
+    def __len__(self):
+        return len(self.paths())
+
+    def keys(self):
+        return self.paths()
+
+    def items(self):
+        """Yields (path, plaintext bytes), following files are prefetched"""
+        for path in self.paths():
+            plaintext_bytes = self.get(path)
+            if plaintext_bytes is not None:
+                yield path, plaintext_bytes
+
+    def invalidate(self, path=None):
+        """Drop cached plaintext for path (all paths if None)"""
+        with self._lock:
+            if path is None:
+                self._cache.clear()
+                self.cache_bytes = 0
+            elif path in self._cache:
+                self._cache_discard(path)
+
+    def _path_index(self, path):
+        """Returns index of path in self._paths, None if not known. O(log n)"""
+        if self._paths is None:
+            return None
+        index = bisect.bisect_left(self._paths, path)
+        if index < len(self._paths) and self._paths[index] == path:
+            return index
+        return None
+
+    def _maybe_prefetch(self, path):
+        """Prefetch the next files in sorted order when access is sequential"""
+        last_path, self._last_path = self._last_path, path
+        if not self.prefetch_depth or last_path is None:
+            return
+        if self._paths is None:
+            self.paths()  # first scan only, put()/del keep the list current
+        with self._lock:
+            index = self._path_index(path)
+            if index is None or index == 0 or self._paths[index - 1] != last_path:
+                return  # unknown or not sequential
+            next_paths = self._paths[index + 1:index + 1 + self.prefetch_depth]
+        for next_path in next_paths:
+            self._prefetch(next_path)
+
+    def _prefetch(self, path):
+        filename = self._filename(path)
+        try:
+            signature = self._signature(os.stat(filename))
+        except EnvironmentError:
+            return
+        with self._lock:
+            entry = self._cache.get(path)
+            if path in self._pending or (entry is not None and entry[0] == signature):
+                return
+            if self._executor is None:
+                import concurrent.futures
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix='jenc-vault')
+            self._pending[path] = self._executor.submit(self._prefetch_load, path, filename)
+
+    def _prefetch_load(self, path, filename):
+        loaded = False
+        try:
+            self._load(path, filename)
+            loaded = True
+        except Exception:
+            pass  # e.g. deleted or not decryptable, reported when accessed
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
+                if loaded:
+                    self.prefetches += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._cache),
+            'cache_bytes': self.cache_bytes,
+            'max_cache_bytes': self.max_cache_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'prefetches': self.prefetches,
+            'key_cache': self.key_cache.stats(),
+        }
+
+    def close(self):
+        """Stop prefetching, drop cached plaintext and zeroize keys"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.invalidate()
+        self.key_cache.zeroize()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()